@@ -0,0 +1,51 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is part of whipper.
+#
+# whipper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# whipper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with whipper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measure how long accurip.OffsetChecksums takes to calculate the
+# AccurateRip v1 checksums of a track of random audio at all read offsets
+# in a range, against calculating the checksums offset by offset.
+#
+# usage: python misc/benchmark_offsets.py [seconds] [margin]
+
+import os
+import sys
+import time
+
+from whipper.common import accurip
+
+seconds = len(sys.argv) > 1 and int(sys.argv[1]) or 240
+margin = len(sys.argv) > 2 and int(sys.argv[2]) or accurip.OFFSET_SEARCH
+
+samples = seconds * 44100
+data = os.urandom((samples + 2 * margin) * 4)
+arcs = accurip.OffsetChecksums(data, margin, samples, 2, 3)
+
+began = time.time()
+v1 = arcs.v1(-margin, margin)
+sliding = time.time() - began
+print('%d offsets of a %d second track: %.3f seconds' % (
+    len(v1), seconds, sliding))
+
+# one at a time, which also calculates v2; extrapolate from a few
+count = 20
+began = time.time()
+for offset in range(count):
+    arcs.checksums(offset)
+single = (time.time() - began) / count
+print('one offset at a time: %.3f seconds each, %.1f seconds for all' % (
+    single, single * len(v1)))
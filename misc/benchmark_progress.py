@@ -0,0 +1,57 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is part of whipper.
+#
+# whipper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# whipper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with whipper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measure how many cdparanoia progress lines per second
+# cdparanoia.ProgressParser gets through, fed the test fixtures in chunks
+# the way ReadTrackTask reads them from the pipe.
+#
+# usage: python misc/benchmark_progress.py [rounds]
+
+import os
+import sys
+import time
+
+from whipper.program import cdparanoia
+
+# fixture name -> (start, stop) of the ripped range
+FIXTURES = {
+    'cdparanoia.progress': (45990, 47719),
+    'cdparanoia.progress.error': (0, 10800),
+    'cdparanoia.progress.strokes': (0, 0),
+}
+
+CHUNK = 1024
+
+rounds = len(sys.argv) > 1 and int(sys.argv[1]) or 100
+testdir = os.path.join(os.path.dirname(__file__), '..', 'whipper', 'test')
+
+for name, (start, stop) in sorted(FIXTURES.items()):
+    with open(os.path.join(testdir, name)) as f:
+        data = f.read()
+
+    lines = 0
+    began = time.time()
+    for i in range(rounds):
+        parser = cdparanoia.ProgressParser(start, stop)
+        for j in range(0, len(data), CHUNK):
+            lines += parser.feed(data[j:j + CHUNK])
+    duration = time.time() - began
+
+    print('%-28s %8d lines/s, %6.1f MiB/s' % (
+        name, lines / duration,
+        len(data) * rounds / duration / 1024 / 1024))
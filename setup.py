@@ -1,4 +1,4 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 from whipper import __version__ as whipper_version
 
 setup(
@@ -10,6 +10,12 @@ setup(
     url='https://github.com/whipper-team/whipper',
     license='GPL3',
     packages=find_packages(),
+    ext_modules=[
+        Extension('accuraterip',
+                  libraries=['sndfile'],
+                  sources=['src/accuraterip-checksum.c'],
+                  extra_compile_args=['-std=c99'])
+    ],
     entry_points={
         'console_scripts': [
             'whipper = whipper.command.main:main'
@@ -5,20 +5,26 @@
  Git         : http://leo.bogert.de/accuraterip-checksum
  Version     : See global variable "version"
  Copyright   : GPL
- Description : A C99 commandline program to compute the AccurateRip checksum of singletrack WAV files.
+ Description : A C99 Python extension to compute the AccurateRip checksums of singletrack WAV/FLAC files.
  	 	 	   Implemented according to http://www.hydrogenaudio.org/forums/index.php?showtopic=97603
  ============================================================================
  */
 
+#include <Python.h>
+
 #include <stdbool.h>
-#include <stdio.h>
-#include <stdlib.h>
-#include <errno.h>
-#include <string.h>
 #include <stdint.h>
+#include <stdlib.h>
 #include <sndfile.h>
 
-const char *const version = "1.4";
+const char *const version = "2.0";
+
+// each sector is 2352 bytes, or 588 stereo samples of 4 bytes
+#define SECTOR_SAMPLES 588
+// the first and the last track skip 5 sectors at the start and end
+#define SKIPPED_SAMPLES (SECTOR_SAMPLES * 5)
+// number of stereo samples read from the file at once
+#define CHUNK_SAMPLES (SECTOR_SAMPLES * 64)
 
 bool check_fileformat(const SF_INFO* sfinfo) {
 #ifdef DEBUG
@@ -30,8 +36,10 @@ bool check_fileformat(const SF_INFO* sfinfo) {
 	printf("Seekable: %i\n", sfinfo->seekable);
 #endif
 
+	const int major_format = sfinfo->format & SF_FORMAT_TYPEMASK;
+
 	if(sfinfo->channels != 2) return false;
-	if((sfinfo->format & SF_FORMAT_TYPEMASK & SF_FORMAT_WAV) != SF_FORMAT_WAV) return false;
+	if(major_format != SF_FORMAT_WAV && major_format != SF_FORMAT_FLAC) return false;
 	if((sfinfo->format & SF_FORMAT_SUBMASK & SF_FORMAT_PCM_16) != SF_FORMAT_PCM_16) return false;
 	//if((sfinfo->format & SF_FORMAT_ENDMASK & SF_ENDIAN_LITTLE) != SF_ENDIAN_LITTLE) return false;
 	if(sfinfo->samplerate != 44100) return false;
@@ -39,152 +47,125 @@ bool check_fileformat(const SF_INFO* sfinfo) {
 	return true;
 }
 
-size_t get_full_audiodata_size(const SF_INFO* sfinfo) {
-	// 16bit = samplesize, 8 bit = bitcount in byte
-	return sfinfo->frames * sfinfo->channels * (16 / 8);
-}
-
-uint32_t* load_full_audiodata(SNDFILE* sndfile, const SF_INFO* sfinfo) {
-	uint32_t* data = (uint32_t*)malloc(get_full_audiodata_size(sfinfo));
-
-	if(data == NULL)
-		return NULL;
-
-	if(sf_readf_short(sndfile, (short*)data, sfinfo->frames) !=  sfinfo->frames) {
-		free(data);
-		return NULL;
+/*
+ * Add the contribution of the sample at the given 1-based position in the
+ * track to both checksums, if it lies in [check_from, check_to].
+ * v1 is the sum of position * sample, v2 additionally folds the high 32
+ * bits of each 64 bit product back in.
+ */
+static inline void add_sample(const uint32_t sample, const uint32_t position, const uint32_t check_from, const uint32_t check_to, uint32_t* AR_CRC, uint32_t* AC_CRCNEW) {
+	if (position >= check_from && position <= check_to)
+	{
+		const uint64_t CalcCRCNEW = (uint64_t)sample * (uint64_t)position;
+		const uint32_t LOCalcCRCNEW = (uint32_t)(CalcCRCNEW & (uint64_t)0xFFFFFFFF);
+		const uint32_t HICalcCRCNEW = (uint32_t)(CalcCRCNEW >> 32);
+		*AR_CRC += LOCalcCRCNEW;
+		*AC_CRCNEW += HICalcCRCNEW;
+		*AC_CRCNEW += LOCalcCRCNEW;
 	}
-
-	return data;
 }
 
-uint32_t compute_v1_checksum(const uint32_t* audio_data, const size_t audio_data_size, const int track_number, const int total_tracks) {
-#define DWORD uint32_t
-
-	const DWORD *pAudioData = audio_data;	// this should point entire track audio data
-	int DataSize = 	audio_data_size;	// size of the data
-	int TrackNumber = track_number;	// actual track number on disc, note that for the first & last track the first and last 5 sectors are skipped
-	int AudioTrackCount = total_tracks;	// CD track count
-
-	//---------AccurateRip CRC checks------------
-	DWORD AR_CRC = 0, AR_CRCPosMulti = 1;
-	DWORD AR_CRCPosCheckFrom = 0;
-	DWORD AR_CRCPosCheckTo = DataSize / sizeof(DWORD);
-#define SectorBytes 2352		// each sector
-	if (TrackNumber == 1)			// first?
-		AR_CRCPosCheckFrom+= ((SectorBytes * 5) / sizeof(DWORD));
-	if (TrackNumber == AudioTrackCount)		// last?
-		AR_CRCPosCheckTo-=((SectorBytes * 5) / sizeof(DWORD));
-
-
-	int DataDWORDSize = DataSize / sizeof(DWORD);
-	for (int i = 0; i < DataDWORDSize; i++)
-	{
-		if (AR_CRCPosMulti >= AR_CRCPosCheckFrom && AR_CRCPosMulti <= AR_CRCPosCheckTo)
-			AR_CRC+=(AR_CRCPosMulti * pAudioData[i]);
+/*
+ * Add the contribution of a run of native endian samples to both checksums.
+ *
+ * position is the 1-based position of the first sample of the run in the
+ * track.
+ */
+void update_checksums(const uint32_t* audio_data, const size_t count, uint32_t position, const uint32_t check_from, const uint32_t check_to, uint32_t* v1, uint32_t* v2) {
+	uint32_t AR_CRC = *v1;
+	uint32_t AC_CRCNEW = *v2;
 
-		AR_CRCPosMulti++;
-	}
+	for (size_t i = 0; i < count; i++, position++)
+		add_sample(audio_data[i], position, check_from, check_to, &AR_CRC, &AC_CRCNEW);
 
-	return AR_CRC;
+	*v1 = AR_CRC;
+	*v2 = AC_CRCNEW;
 }
 
-uint32_t compute_v2_checksum(const uint32_t* audio_data, const size_t audio_data_size, const int track_number, const int total_tracks) {
-#define DWORD uint32_t
-#define __int64 uint64_t
-
-	const DWORD *pAudioData = audio_data;	// this should point entire track audio data
-	int DataSize = 	audio_data_size;	// size of the data
-	int TrackNumber = track_number;	// actual track number on disc, note that for the first & last track the first and last 5 sectors are skipped
-	int AudioTrackCount = total_tracks;	// CD track count
-
-	//---------AccurateRip CRC checks------------
-	DWORD AR_CRCPosCheckFrom = 0;
-	DWORD AR_CRCPosCheckTo = DataSize / sizeof(DWORD);
-#define SectorBytes 2352		// each sector
-	if (TrackNumber == 1)			// first?
-		AR_CRCPosCheckFrom+= ((SectorBytes * 5) / sizeof(DWORD));
-	if (TrackNumber == AudioTrackCount)		// last?
-		AR_CRCPosCheckTo-=((SectorBytes * 5) / sizeof(DWORD));
-
-	int DataDWORDSize = DataSize / sizeof(DWORD);
-
-    DWORD AC_CRCNEW = 0;
-	DWORD MulBy = 1;
-	for (int i = 0; i < DataDWORDSize; i++)
-	{
-		if (MulBy >= AR_CRCPosCheckFrom && MulBy <= AR_CRCPosCheckTo)
-		{
-			DWORD Value = pAudioData[i];
-
-			uint64_t CalcCRCNEW = (uint64_t)Value * (uint64_t)MulBy;
-			DWORD LOCalcCRCNEW = (DWORD)(CalcCRCNEW & (uint64_t)0xFFFFFFFF);
-			DWORD HICalcCRCNEW = (DWORD)(CalcCRCNEW / (uint64_t)0x100000000);
-			AC_CRCNEW+=HICalcCRCNEW;
-			AC_CRCNEW+=LOCalcCRCNEW;
-		}
-        MulBy++;
+/*
+ * Same as update_checksums, for little endian 16 bit stereo PCM bytes, as
+ * found in the data chunk of a WAV file.
+ */
+void update_checksums_pcm(const unsigned char* pcm, const size_t count, uint32_t position, const uint32_t check_from, const uint32_t check_to, uint32_t* v1, uint32_t* v2) {
+	uint32_t AR_CRC = *v1;
+	uint32_t AC_CRCNEW = *v2;
+
+	for (size_t i = 0; i < count; i++, position++, pcm += 4) {
+		const uint32_t sample = (uint32_t)pcm[0] | ((uint32_t)pcm[1] << 8) |
+			((uint32_t)pcm[2] << 16) | ((uint32_t)pcm[3] << 24);
+		add_sample(sample, position, check_from, check_to, &AR_CRC, &AC_CRCNEW);
 	}
 
-	return AC_CRCNEW;
+	*v1 = AR_CRC;
+	*v2 = AC_CRCNEW;
 }
 
-void print_syntax_to_stderr() {
-	fprintf(stderr, "Syntax: accuraterip-checksum [--version / --accuraterip-v1 / --accuraterip-v2 (default)] filename track_number total_tracks\n");
+/*
+ * Return the 1-based range of sample positions that count towards the
+ * checksums of a track of the given length.
+ */
+void get_check_range(const uint32_t total_samples, const int track_number, const int total_tracks, uint32_t* check_from, uint32_t* check_to) {
+	*check_from = 0;
+	*check_to = total_samples;
+	if (track_number == 1)			// first?
+		*check_from += SKIPPED_SAMPLES;
+	if (track_number == total_tracks)		// last?
+		*check_to -= SKIPPED_SAMPLES;
 }
 
-int main(int argc, const char** argv) {
-	int arg_offset;
-	bool use_v1;
-
-	switch(argc) {
-		case 2:
-			if(strcmp(argv[1], "--version") != 0) {
-				print_syntax_to_stderr();
-				return EXIT_FAILURE;
-			}
-			printf("accuraterip-checksum version %s\n", version);
-			return EXIT_SUCCESS;
-		case 4:
-			arg_offset = 0;
-			use_v1 = false;
-			break;
-		case 5:
-			arg_offset = 1;
-			if(!strcmp(argv[1], "--accuraterip-v1")) {
-				use_v1 = true;
-			} else if(!strcmp(argv[1], "--accuraterip-v2")) {
-				use_v1 = false;
-			} else {
-				print_syntax_to_stderr();
-				return EXIT_FAILURE;
-			}
-			break;
-		default:
-			print_syntax_to_stderr();
-			return EXIT_FAILURE;
+/*
+ * Stream the audio data of sndfile once, computing v1 and v2 together.
+ * Returns false if the file could not be read completely.
+ */
+bool compute_checksums(SNDFILE* sndfile, const SF_INFO* sfinfo, const int track_number, const int total_tracks, uint32_t* v1, uint32_t* v2) {
+	uint32_t* chunk = (uint32_t*)malloc(CHUNK_SAMPLES * sizeof(uint32_t));
+	uint32_t check_from, check_to;
+	uint32_t position = 1;
+	sf_count_t remaining = sfinfo->frames;
+
+	get_check_range((uint32_t)sfinfo->frames, track_number, total_tracks, &check_from, &check_to);
+
+	if (chunk == NULL)
+		return false;
+
+	*v1 = 0;
+	*v2 = 0;
+	while (remaining > 0) {
+		sf_count_t wanted = remaining < CHUNK_SAMPLES ? remaining : CHUNK_SAMPLES;
+		// a stereo frame of two 16 bit samples is read as one 32 bit value
+		if (sf_readf_short(sndfile, (short*)chunk, wanted) != wanted) {
+			free(chunk);
+			return false;
+		}
+		update_checksums(chunk, (size_t)wanted, position, check_from, check_to, v1, v2);
+		position += (uint32_t)wanted;
+		remaining -= wanted;
 	}
 
-	const char* filename = argv[1 + arg_offset];
-	const char* track_number_string = argv[2 + arg_offset];
-	const char* total_tracks_string = argv[3 + arg_offset];
+	free(chunk);
+	return true;
+}
 
-	const int track_number = atoi(track_number_string);
-	const int total_tracks = atoi(total_tracks_string);
+static PyObject* accuraterip_compute(PyObject* self, PyObject* args) {
+	char* filename = NULL;
+	int track_number, total_tracks;
+	uint32_t v1, v2;
+	bool ok;
 
-	if(track_number < 1 || track_number > total_tracks) {
-		fprintf(stderr, "Invalid track_number!\n");
-		return EXIT_FAILURE;
-	}
+	if (!PyArg_ParseTuple(args, "etii", Py_FileSystemDefaultEncoding, &filename, &track_number, &total_tracks))
+		return NULL;
 
-	if(total_tracks < 1 || total_tracks > 99) {
-		fprintf(stderr, "Invalid total_tracks!\n");
-		return EXIT_FAILURE;
+	if (track_number < 1 || track_number > total_tracks) {
+		PyMem_Free(filename);
+		PyErr_SetString(PyExc_ValueError, "invalid track_number");
+		return NULL;
 	}
 
-#ifdef DEBUG
-	printf("Reading %s\n", filename);
-#endif
+	if (total_tracks < 1 || total_tracks > 99) {
+		PyMem_Free(filename);
+		PyErr_SetString(PyExc_ValueError, "invalid total_tracks");
+		return NULL;
+	}
 
 	SF_INFO sfinfo;
 	sfinfo.channels = 0;
@@ -195,33 +176,86 @@ int main(int argc, const char** argv) {
 	sfinfo.seekable = 0;
 
 	SNDFILE* sndfile = sf_open(filename, SFM_READ, &sfinfo);
-
-	if(sndfile == NULL) {
-		fprintf(stderr, "sf_open failed! sf_error==%i\n", sf_error(NULL));
-		return EXIT_FAILURE;
+	if (sndfile == NULL) {
+		PyErr_Format(PyExc_IOError, "sf_open failed for %s: %s", filename, sf_strerror(NULL));
+		PyMem_Free(filename);
+		return NULL;
 	}
+	PyMem_Free(filename);
 
-	if(!check_fileformat(&sfinfo)) {
-		fprintf(stderr, "check_fileformat failed!\n");
+	if (!check_fileformat(&sfinfo)) {
 		sf_close(sndfile);
-		return EXIT_FAILURE;
+		PyErr_SetString(PyExc_ValueError, "check_fileformat failed");
+		return NULL;
 	}
 
-	uint32_t* audio_data = load_full_audiodata(sndfile, &sfinfo);
-	if(audio_data == NULL) {
-		fprintf(stderr, "load_full_audiodata failed!\n");
-		sf_close(sndfile);
-		return EXIT_FAILURE;
+	Py_BEGIN_ALLOW_THREADS
+	ok = compute_checksums(sndfile, &sfinfo, track_number, total_tracks, &v1, &v2);
+	Py_END_ALLOW_THREADS
+
+	sf_close(sndfile);
+
+	if (!ok) {
+		PyErr_SetString(PyExc_IOError, "could not read all audio data");
+		return NULL;
 	}
 
-	const int checksum = use_v1 ?
-			compute_v1_checksum(audio_data, get_full_audiodata_size(&sfinfo), track_number, total_tracks)
-			: compute_v2_checksum(audio_data, get_full_audiodata_size(&sfinfo), track_number, total_tracks);
+	return Py_BuildValue("(kk)", (unsigned long)v1, (unsigned long)v2);
+}
 
-	printf("%08X\n", checksum);
+static PyObject* accuraterip_update(PyObject* self, PyObject* args) {
+	Py_buffer data;
+	unsigned long position, check_from, check_to, v1, v2;
+	uint32_t v1_32, v2_32;
 
-	sf_close(sndfile);
-	free(audio_data);
+	if (!PyArg_ParseTuple(args, "s*kkkkk", &data, &position, &check_from, &check_to, &v1, &v2))
+		return NULL;
 
-	return EXIT_SUCCESS;
+	if (data.len % 4 != 0) {
+		PyBuffer_Release(&data);
+		PyErr_SetString(PyExc_ValueError, "data does not hold whole stereo samples");
+		return NULL;
+	}
+
+	v1_32 = (uint32_t)v1;
+	v2_32 = (uint32_t)v2;
+	Py_BEGIN_ALLOW_THREADS
+	update_checksums_pcm((const unsigned char*)data.buf, (size_t)data.len / 4, (uint32_t)position, (uint32_t)check_from, (uint32_t)check_to, &v1_32, &v2_32);
+	Py_END_ALLOW_THREADS
+
+	PyBuffer_Release(&data);
+
+	return Py_BuildValue("(kk)", (unsigned long)v1_32, (unsigned long)v2_32);
 }
+
+static PyMethodDef accuraterip_methods[] = {
+	{ "compute", accuraterip_compute, METH_VARARGS,
+	  "compute(path, track_number, total_tracks) -> (v1, v2)\n\n"
+	  "Compute the AccurateRip v1 and v2 checksums of a single track file "
+	  "in one pass." },
+	{ "update", accuraterip_update, METH_VARARGS,
+	  "update(data, position, check_from, check_to, v1, v2) -> (v1, v2)\n\n"
+	  "Add little endian 16 bit stereo PCM data, starting at the 1-based "
+	  "sample position in the track, to the running v1 and v2 checksums. "
+	  "Only samples with a position in [check_from, check_to] count." },
+	{ NULL, NULL, 0, NULL }
+};
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef accuraterip_module = {
+	PyModuleDef_HEAD_INIT, "accuraterip", NULL, -1, accuraterip_methods
+};
+
+PyMODINIT_FUNC PyInit_accuraterip(void) {
+	PyObject* module = PyModule_Create(&accuraterip_module);
+	if (module != NULL)
+		PyModule_AddStringConstant(module, "version", version);
+	return module;
+}
+#else
+PyMODINIT_FUNC initaccuraterip(void) {
+	PyObject* module = Py_InitModule("accuraterip", accuraterip_methods);
+	if (module != NULL)
+		PyModule_AddStringConstant(module, "version", version);
+}
+#endif
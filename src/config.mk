@@ -1,11 +0,0 @@
-VERSION = 1.4
-
-# paths
-PREFIX = /usr/local
-
-# flags
-CFLAGS   = -std=c99
-LDFLAGS  = -lsndfile
-
-# compiler and linker
-CC = cc
@@ -21,7 +21,8 @@
 import sys
 
 from whipper.command.basecommand import BaseCommand
-from whipper.common.accurip import get_db_entry, ACCURATERIP_URL
+from whipper.common import config
+from whipper.common.accurip import get_db_entry, open_cache, ACCURATERIP_URL
 
 import logging
 logger = logging.getLogger(__name__)
@@ -38,7 +39,9 @@ retrieves and display accuraterip data from the given URL
                                  help="accuraterip URL to load data from")
 
     def do(self):
-        responses = get_db_entry(self.options.url.lstrip(ACCURATERIP_URL))
+        responses = get_db_entry(self.options.url.lstrip(ACCURATERIP_URL),
+                                 open_cache(config.Config()),
+                                 offline=self.options.offline)
 
         count = responses[0].num_tracks
 
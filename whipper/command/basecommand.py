@@ -38,6 +38,9 @@ class BaseCommand():
     Provides self.epilog() formatting command for argparse.
 
     device_option = True adds -d / --device option to current command
+    multiple_devices = True allows giving -d / --device more than once;
+    all of them end up in self.options.devices, the first one also in
+    self.options.device
     no_add_help = True removes -h / --help option from current command
 
     Overriding formatter_class sets the argparse formatter class.
@@ -49,6 +52,7 @@ class BaseCommand():
     name.
     """
     device_option = False
+    multiple_devices = False
     no_add_help = False  # for rip.main.Whipper
     formatter_class = argparse.RawDescriptionHelpFormatter
 
@@ -85,21 +89,42 @@ class BaseCommand():
                 logger.critical(msg)
                 # whipper exited with return code 3 here
                 raise IOError(msg)
-            self.parser.add_argument('-d', '--device',
-                                     action="store",
-                                     dest="device",
-                                     default=drives[0],
-                                     help="CD-DA device")
+            if self.multiple_devices:
+                self.parser.add_argument('-d', '--device',
+                                         action="append",
+                                         dest="devices",
+                                         help="CD-DA device; can be given "
+                                         "more than once to use several "
+                                         "drives at the same time")
+            else:
+                self.parser.add_argument('-d', '--device',
+                                         action="store",
+                                         dest="device",
+                                         default=drives[0],
+                                         help="CD-DA device")
 
         self.options = self.parser.parse_args(argv, namespace=opts)
 
         if self.device_option:
-            # this can be a symlink to another device
-            self.options.device = os.path.realpath(self.options.device)
-            if not os.path.exists(self.options.device):
-                msg = 'CD-DA device %s not found!' % self.options.device
-                logger.critical(msg)
-                raise IOError(msg)
+            if self.multiple_devices:
+                devices = self.options.devices or [drives[0]]
+            else:
+                devices = [self.options.device]
+            # these can be symlinks to other devices, or the same one twice
+            paths = []
+            for d in devices:
+                d = os.path.realpath(d)
+                if d not in paths:
+                    paths.append(d)
+            devices = paths
+            for device in devices:
+                if not os.path.exists(device):
+                    msg = 'CD-DA device %s not found!' % device
+                    logger.critical(msg)
+                    raise IOError(msg)
+            self.options.device = devices[0]
+            if self.multiple_devices:
+                self.options.devices = devices
 
         self.handle_arguments()
 
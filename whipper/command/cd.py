@@ -20,13 +20,15 @@
 
 import argparse
 import cdio
+import multiprocessing
 import os
 import glob
 import sys
+import time
 import logging
 from whipper.command.basecommand import BaseCommand
 from whipper.common import (
-    accurip, config, drive, program, task
+    accurip, config, drive, mbngs, pipeline, program, task
 )
 from whipper.common.common import validate_template
 from whipper.program import cdrdao, cdparanoia, utils
@@ -66,6 +68,8 @@ disc and track template are:
 
 class _CD(BaseCommand):
     eject = True
+    prefetch_accuraterip = False  # whether the command verifies the rip
+    resume = False  # whether the command picks up tracks ripped before
 
     @staticmethod
     def add_arguments(parser):
@@ -80,12 +84,17 @@ class _CD(BaseCommand):
         parser.add_argument('-c', '--country',
                             action="store", dest="country",
                             help="Filter releases by country")
+        parser.add_argument('--refresh',
+                            action="store_true", dest="refresh",
+                            help="Look up the disc on MusicBrainz again "
+                            "even if it was looked up recently")
 
     def do(self):
         self.config = config.Config()
         self.program = program.Program(self.config,
                                        record=self.options.record,
-                                       stdout=sys.stdout)
+                                       stdout=sys.stdout,
+                                       offline=self.options.offline)
         self.runner = task.SyncRunner()
 
         # if the device is mounted (data session), unmount it
@@ -97,8 +106,15 @@ class _CD(BaseCommand):
         # first, read the normal TOC, which is fast
         self.ittoc = self.program.getFastToc(self.runner, self.device)
 
-        # already show us some info based on this
-        self.program.getRipResult(self.ittoc.getCDDBDiscId())
+        # already show us some info based on this; tracks ripped before
+        # only count if they were ripped the same way
+        if self.resume:
+            self.program.getRipResult(self.ittoc.getCDDBDiscId(),
+                                      offset=int(self.options.offset),
+                                      overread=self.options.overread)
+        else:
+            self.program.getRipResult(self.ittoc.getCDDBDiscId(),
+                                      resume=False)
         sys.stdout.write("CDDB disc id: %s\n" % self.ittoc.getCDDBDiscId())
         self.mbdiscid = self.ittoc.getMusicBrainzDiscId()
         sys.stdout.write("MusicBrainz disc id %s\n" % self.mbdiscid)
@@ -106,25 +122,11 @@ class _CD(BaseCommand):
         sys.stdout.write("MusicBrainz lookup URL %s\n" %
                          self.ittoc.getMusicBrainzSubmitURL())
 
-        self.program.metadata = (
-            self.program.getMusicBrainz(self.ittoc, self.mbdiscid,
-                                        release=self.options.release_id,
-                                        country=self.options.country,
-                                        prompt=self.options.prompt)
-        )
-
-        if not self.program.metadata:
-            # fall back to FreeDB for lookup
-            cddbid = self.ittoc.getCDDBValues()
-            cddbmd = self.program.getCDDB(cddbid)
-            if cddbmd:
-                sys.stdout.write('FreeDB identifies disc as %s\n' % cddbmd)
-
-            # also used by rip cd info
-            if not getattr(self.options, 'unknown', False):
-                logger.critical("unable to retrieve disc metadata, "
-                                "--unknown not passed")
-                return -1
+        # the lookups only need the fast TOC, so they can go on while the
+        # complete table is read
+        self.program.prefetch(self.ittoc, country=self.options.country,
+                              refresh=self.options.refresh,
+                              accuraterip=self.prefetch_accuraterip)
 
         self.program.result.isCdr = cdrdao.DetectCdr(self.device)
         if (self.program.result.isCdr and
@@ -133,21 +135,23 @@ class _CD(BaseCommand):
                             "--cdr not passed")
             return -1
 
+        # without --unknown, a disc without metadata is refused before the
+        # slow read of the full table; otherwise the lookups go on while it
+        # is read
+        unknown = getattr(self.options, 'unknown', False)
+        if not unknown and not self._getMetadata():
+            return -1
+
         # Change working directory before cdrdao's task
         if self.options.working_directory is not None:
             os.chdir(os.path.expanduser(self.options.working_directory))
-        out_bpath = self.options.output_directory.decode('utf-8')
-        # Needed to preserve cdrdao's tocfile
-        out_fpath = self.program.getPath(out_bpath,
-                                         self.options.disc_template,
-                                         self.mbdiscid,
-                                         self.program.metadata)
-        # now, read the complete index table, which is slower
+        # now, read the complete index table, which is slower; cdrdao's
+        # tocfile is saved once the metadata tells where
         self.itable = self.program.getTable(self.runner,
                                             self.ittoc.getCDDBDiscId(),
                                             self.ittoc.getMusicBrainzDiscId(),
                                             self.device, self.options.offset,
-                                            out_fpath)
+                                            ittoc=self.ittoc)
 
         assert self.itable.getCDDBDiscId() == self.ittoc.getCDDBDiscId(), \
             "full table's id %s differs from toc id %s" % (
@@ -162,6 +166,17 @@ class _CD(BaseCommand):
             "full table's AR URL %s differs from toc AR URL %s" % (
             self.itable.accuraterip_url(), self.ittoc.accuraterip_url())
 
+        if unknown and not self._getMetadata():
+            return -1
+
+        out_bpath = self.options.output_directory.decode('utf-8')
+        # Needed to preserve cdrdao's tocfile
+        out_fpath = self.program.getPath(out_bpath,
+                                         self.options.disc_template,
+                                         self.mbdiscid,
+                                         self.program.metadata)
+        self.program.saveToc(out_fpath)
+
         if self.program.metadata:
             self.program.metadata.discid = self.ittoc.getMusicBrainzDiscId()
 
@@ -192,6 +207,35 @@ class _CD(BaseCommand):
         if self.options.eject in ('success', 'always'):
             utils.eject_device(self.device)
 
+    def _getMetadata(self):
+        """
+        Look up the disc's metadata, falling back to FreeDB for a name.
+
+        @returns: False if there is none and --unknown was not passed
+        """
+        self.program.metadata = (
+            self.program.getMusicBrainz(self.ittoc, self.mbdiscid,
+                                        release=self.options.release_id,
+                                        country=self.options.country,
+                                        prompt=self.options.prompt,
+                                        refresh=self.options.refresh)
+        )
+
+        if not self.program.metadata:
+            # fall back to FreeDB for lookup
+            cddbid = self.ittoc.getCDDBValues()
+            cddbmd = self.program.getCDDB(cddbid)
+            if cddbmd:
+                sys.stdout.write('FreeDB identifies disc as %s\n' % cddbmd)
+
+            # also used by rip cd info
+            if not getattr(self.options, 'unknown', False):
+                logger.critical("unable to retrieve disc metadata, "
+                                "--unknown not passed")
+                self.program.saveToc(None)
+                return False
+        return True
+
     def doCommand(self):
         pass
 
@@ -223,6 +267,8 @@ All files will be created relative to the given output directory.
 Log files will log the path to tracks relative to this directory.
 """ % TEMPLATE_DESCRIPTION
     formatter_class = argparse.RawTextHelpFormatter
+    prefetch_accuraterip = True
+    resume = True
 
     # Requires opts.record
     # Requires opts.device
@@ -291,6 +337,25 @@ Log files will log the path to tracks relative to this directory.
                                  help="whether to continue ripping if "
                                  "the disc is a CD-R",
                                  default=False)
+        self.parser.add_argument('--stream',
+                                 action="store_true", dest="stream",
+                                 help="stream audio from cd-paranoia "
+                                 "straight into checksumming and encoding "
+                                 "instead of writing temporary .wav files",
+                                 default=False)
+        self.parser.add_argument('--pipeline',
+                                 action="store_true", dest="pipeline",
+                                 help="encode, checksum and tag each track "
+                                 "in the background while the drive reads "
+                                 "the next one; streaming already encodes "
+                                 "while reading",
+                                 default=False)
+        self.parser.add_argument('--encode-jobs',
+                                 action="store", dest="encode_jobs",
+                                 type=int,
+                                 help="number of tracks to encode at the "
+                                 "same time with --pipeline "
+                                 "(default: number of CPUs)")
 
     def handle_arguments(self):
         self.options.output_directory = os.path.expanduser(
@@ -345,9 +410,17 @@ Log files will log the path to tracks relative to this directory.
             print("creating output directory %s" % dirname.encode('utf-8'))
             os.makedirs(dirname)
 
+        worker = None
+        if self.options.pipeline and not self.options.stream:
+            # keep at most one more track waiting to be encoded
+            worker = pipeline.Worker(
+                size=1,
+                threads=self.options.encode_jobs or
+                multiprocessing.cpu_count())
+
         # FIXME: turn this into a method
 
-        def _ripIfNotRipped(number):
+        def _ripIfNotRipped(number, worker=None):
             logger.debug('ripIfNotRipped for track %d' % number)
             # we can have a previous result
             trackResult = self.program.result.getTrackResult(number)
@@ -383,12 +456,19 @@ Log files will log the path to tracks relative to this directory.
                     logger.debug('previous result %r, expected %r' % (
                         trackResult.filename, path))
 
-                sys.stdout.write('Verifying track %d of %d: %s\n' % (
-                    number, len(self.itable.tracks),
-                    os.path.basename(path).encode('utf-8')))
-                if not self.program.verifyTrack(self.runner, trackResult):
-                    sys.stdout.write('Verification failed, reripping...\n')
-                    os.unlink(path)
+                if self.program.trackUnchanged(trackResult):
+                    sys.stdout.write('Track %d of %d already ripped: %s\n' % (
+                        number, len(self.itable.tracks),
+                        os.path.basename(path).encode('utf-8')))
+                else:
+                    sys.stdout.write('Verifying track %d of %d: %s\n' % (
+                        number, len(self.itable.tracks),
+                        os.path.basename(path).encode('utf-8')))
+                    if not self.program.verifyTrack(self.runner,
+                                                    trackResult):
+                        sys.stdout.write(
+                            'Verification failed, reripping...\n')
+                        os.unlink(path)
 
             if not os.path.exists(path):
                 logger.debug('path %r does not exist, ripping...' % path)
@@ -413,10 +493,16 @@ Log files will log the path to tracks relative to this directory.
                                               taglist=self.program.getTagList(
                                                   number, self.mbdiscid),
                                               overread=self.options.overread,
+                                              stream=self.options.stream,
                                               what='track %d of %d%s' % (
                                                   number,
                                                   len(self.itable.tracks),
-                                                  extra))
+                                                  extra),
+                                              worker=worker,
+                                              callback=lambda: _encoded(
+                                                  number, trackResult),
+                                              errback=lambda e: _failed(
+                                                  number, e))
                         break
                     except Exception as e:
                         logger.debug('Got exception %r on try %d',
@@ -435,12 +521,33 @@ Log files will log the path to tracks relative to this directory.
                         "CRCs did not match for track %d\n" % number
                     )
 
+                if worker:
+                    sys.stdout.write(
+                        'Rip quality: {:.2%}\n'.format(trackResult.quality))
+                    # the rest is done once the track is encoded
+                    return
+
                 sys.stdout.write(
                     'Peak level: {}\n'.format(trackResult.peak))
 
                 sys.stdout.write(
                     'Rip quality: {:.2%}\n'.format(trackResult.quality))
 
+            _overlay(number, trackResult)
+
+        def _encoded(number, trackResult):
+            sys.stdout.write('Encoded track {}, peak level: {}\n'.format(
+                number, trackResult.peak))
+            _overlay(number, trackResult)
+
+        def _failed(number, exception):
+            # the worker removed what it encoded; rip the track again, and
+            # encode it right away, retrying as often as any other rip
+            sys.stdout.write('Encoding track %d failed (%s), reripping...\n'
+                             % (number, exception))
+            _ripIfNotRipped(number)
+
+        def _overlay(number, trackResult):
             # overlay this rip onto the Table
             if number == 0:
                 # HTOA goes on index 0 of track 1
@@ -471,7 +578,7 @@ Log files will log the path to tracks relative to this directory.
             start, stop = htoa
             print('found Hidden Track One Audio from frame %d to %d' % (
                   start, stop))
-            _ripIfNotRipped(0)
+            _ripIfNotRipped(0, worker)
 
         for i, track in enumerate(self.itable.tracks):
             # FIXME: rip data tracks differently
@@ -480,7 +587,12 @@ Log files will log the path to tracks relative to this directory.
                 # FIXME: make it work for now
                 track.indexes[1].relative = 0
                 continue
-            _ripIfNotRipped(i + 1)
+            if worker:
+                worker.collect()
+            _ripIfNotRipped(i + 1, worker)
+
+        if worker:
+            worker.join()
 
         logger.debug('writing cue file for %r', discName)
         self.program.writeCue(discName)
@@ -498,14 +610,126 @@ Log files will log the path to tracks relative to this directory.
         self.program.saveRipResult()
 
         self.program.writeLog(discName, self.logger)
+        self.program.removeRipResult()
+
+
+class _DeviceOutput(object):
+    """
+    I prefix each line written to me with the device it is about, so that
+    the output of several drives working at once can be told apart.
+
+    Progress updates, which normally overwrite each other on a single line,
+    are written as lines of their own, at most every PROGRESS_INTERVAL
+    seconds.
+    """
+
+    PROGRESS_INTERVAL = 10.0
+
+    def __init__(self, out, device):
+        self._out = out
+        self._prefix = '%s: ' % os.path.basename(device)
+        self._buffer = ''
+        self._lastProgress = 0
+
+    def write(self, data):
+        self._buffer += data
+        while True:
+            newline = self._buffer.find('\n')
+            ret = self._buffer.find('\r')
+            if newline == -1 and ret == -1:
+                break
+            if ret == -1 or -1 < newline < ret:
+                line, self._buffer = self._buffer[:newline], \
+                    self._buffer[newline + 1:]
+            else:
+                line, self._buffer = self._buffer[:ret], \
+                    self._buffer[ret + 1:]
+                now = time.time()
+                if now - self._lastProgress < self.PROGRESS_INTERVAL:
+                    continue
+                self._lastProgress = now
+            line = line.rstrip()
+            if line:
+                self._out.write(self._prefix + line + '\n')
+        self._out.flush()
+
+    def flush(self):
+        self._out.flush()
+
+    def isatty(self):
+        return False
 
 
 class CD(BaseCommand):
     summary = "handle CDs"
-    description = "Display and rip CD-DA and metadata."
+    description = """Display and rip CD-DA and metadata.
+
+Given more than one device, the command runs for all of them at the same
+time, each in a process of its own."""
     device_option = True
+    multiple_devices = True
 
     subcommands = {
         'info': Info,
         'rip': Rip
     }
+
+    def handle_arguments(self):
+        # the options as they are before the subcommand adds its own
+        self._options = dict(vars(self.options))
+
+    def do(self):
+        if len(self.options.devices) == 1:
+            return self.cmd.do()
+
+        # the drives look up their discs at the same time, but together
+        # keep to the rate MusicBrainz allows
+        mbngs.share_rate_limit()
+        processes = []
+        for device in self.options.devices:
+            p = multiprocessing.Process(target=self._doDevice,
+                                        args=(device, ),
+                                        name=device)
+            p.start()
+            processes.append(p)
+
+        ret = 0
+        for p in processes:
+            p.join()
+            if p.exitcode:
+                logger.critical('%s failed with exit code %d',
+                                p.name, p.exitcode)
+                ret = 1
+        return ret
+
+    def _doDevice(self, device):
+        stderr = sys.stderr
+        sys.stdout = _DeviceOutput(sys.stdout, device)
+        sys.stderr = _DeviceOutput(sys.stderr, device)
+        # log records are prefixed too, whether they go to stderr or to
+        # the log file
+        for handler in logging.getLogger().handlers:
+            if getattr(handler, 'stream', None) is stderr:
+                handler.stream = sys.stderr
+            else:
+                handler.setFormatter(logging.Formatter(
+                    '%s: %s' % (os.path.basename(device),
+                                logging.BASIC_FORMAT)))
+
+        # set up the subcommand again for this device, so that e.g. its
+        # configured read offset is used
+        options = argparse.Namespace(**self._options)
+        options.device = device
+        options.devices = [device]
+        name = options.remainder[0]
+        cmd = self.subcommands[name](options.remainder[1:],
+                                     self.prog_name + " " + name,
+                                     options)
+        try:
+            ret = cmd.do()
+        except Exception as e:
+            logger.debug('%s failed: %r', device, e)
+            sys.stderr.write('whipper: error: %s\n' % e)
+            ret = 1
+        sys.stdout.flush()
+        sys.exit(ret or 0)
@@ -18,61 +18,333 @@
 # You should have received a copy of the GNU General Public License
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
+import os
 import sys
+import time
+from StringIO import StringIO
 
 from whipper.command.basecommand import BaseCommand
-from whipper.common import accurip, config, program
+from whipper.common import accurip, config, directory, program
 from whipper.extern.task import task
 from whipper.image import image
-from whipper.result import result
+from whipper.result import database, result
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+def _verify(prog, runner, cuePath, stdout=None):
+    """
+    Verify an image against the AccurateRip database, and print the report.
+
+    @type cuePath: unicode
+    @param stdout: the file to print to instead of sys.stdout
+
+    @returns: whether the image verified, and the image
+    @rtype:   tuple of (bool, L{image.Image})
+    """
+    stdout = stdout or sys.stdout
+    cueImage = image.Image(cuePath)
+    cueImage.setup(runner)
+
+    # FIXME: this feels like we're poking at internals.
+    prog.cuePath = cuePath
+    prog.result = result.RipResult()
+    for track in cueImage.table.tracks:
+        tr = result.TrackResult()
+        tr.number = track.number
+        prog.result.tracks.append(tr)
+
+    verified = False
+    try:
+        verified = prog.verifyImage(runner, cueImage.table, cueImage)
+    except accurip.EntryNotFound:
+        stdout.write('AccurateRip entry not found\n')
+    accurip.print_report(prog.result, stdout)
+    return verified, cueImage
+
+
+def _searchOffset(cuePath, cueImage, offline, stdout=None):
+    stdout = stdout or sys.stdout
+    try:
+        responses = accurip.get_db_entry(
+            cueImage.table.accuraterip_path(),
+            accurip.open_cache(config.Config()),
+            offline=offline)
+    except accurip.EntryNotFound:
+        return
+
+    tracks = [t for t in cueImage.cue.table.tracks if t.number != 0]
+    paths = [os.path.join(os.path.dirname(cuePath), t.indexes[1].path)
+             for t in tracks]
+    stdout.write('Searching AccurateRip matches up to %d samples either '
+                 'way\n' % accurip.OFFSET_SEARCH)
+    found = None
+    for track, offsets in zip(tracks, accurip.search_offsets(paths,
+                                                             responses)):
+        if offsets is None:
+            stdout.write('track %2d: could not be read\n' % track.number)
+            continue
+        stdout.write('track %2d: %s\n' % (track.number, ', '.join(
+            '%+d' % offset for offset in offsets) or 'no match'))
+        if found is None:
+            found = set(offsets)
+        else:
+            found &= set(offsets)
+
+    for offset in sorted(found or ()):
+        if offset:
+            stdout.write('Image matches AccurateRip at offset %+d: it was '
+                         'likely ripped with a read offset %d samples too '
+                         '%s\n' % (offset, abs(offset),
+                                   'low' if offset > 0 else 'high'))
+
+
+def _findCueFiles(directories):
+    """
+    Return the .cue files under the given directories, sorted.
+
+    @type directories: list of unicode
+
+    @rtype: list of unicode
+    """
+    cuePaths = []
+    for top in directories:
+        for dirpath, dirnames, filenames in os.walk(top):
+            cuePaths.extend(os.path.join(dirpath, name)
+                            for name in filenames
+                            if name.lower().endswith('.cue'))
+    return sorted(cuePaths)
+
+
+def _imageFiles(cuePath):
+    """
+    Return the paths of the .cue file of an image and of its audio files.
+
+    @type cuePath: unicode
+
+    @rtype: list of unicode
+    """
+    cueImage = image.Image(cuePath)
+    paths = [cuePath]
+    for track in cueImage.cue.table.tracks:
+        for number in sorted(track.indexes):
+            path = cueImage.getRealPath(track.indexes[number].path)
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+# the state of a worker process of Verify --recursive
+_worker = {}
+
+
+def _initWorker(offline, offset_search):
+    _worker['prog'] = program.Program(config.Config(), offline=offline)
+    _worker['runner'] = task.SyncRunner(verbose=False)
+    _worker['offline'] = offline
+    _worker['offset_search'] = offset_search
+
+
+def _verifyDisc(args):
+    """
+    Verify an image in a worker process, unless it verified before and its
+    files have not changed since.
+
+    @param args: the path of the .cue file, and the files it had when it
+                 verified before, or None
+
+    @returns: the path of the .cue file, the files of the image, whether
+              it verified (None if it was skipped), and the report printed
+              (or the error if it could not be verified)
+    """
+    cuePath, files = args
+    try:
+        fingerprint = database.fingerprint(_imageFiles(cuePath))
+        if fingerprint == files:
+            return cuePath, fingerprint, None, None
+
+        stdout = StringIO()
+        verified, cueImage = _verify(_worker['prog'], _worker['runner'],
+                                     cuePath, stdout)
+        if not verified and _worker['offset_search']:
+            _searchOffset(cuePath, cueImage, _worker['offline'], stdout)
+        return cuePath, fingerprint, verified, stdout.getvalue()
+    except Exception as e:
+        logger.debug('could not verify %s', cuePath, exc_info=True)
+        if isinstance(e, task.TaskException):
+            e = e.exception
+        return cuePath, None, False, 'could not be verified: %s: %s\n' % (
+            e.__class__.__name__, e)
+
+
 class Verify(BaseCommand):
     summary = "verify image"
     description = """
 Verifies the image from the given .cue files against the AccurateRip database.
+
+With --recursive, verifies the images of all .cue files under the given
+directories, several at the same time. The results are kept in a database,
+and images that verified before are skipped as long as their files have not
+changed in size or modification time, or until they are older than
+--max-age.
 """
 
     def add_arguments(self):
         self.parser.add_argument('cuefile', nargs='+', action='store',
-                                 help="cue file to load rip image from")
+                                 help="cue file to load rip image from, "
+                                 "or directory with --recursive")
+        self.parser.add_argument('--offset-search',
+                                 action="store_true", dest="offset_search",
+                                 help="if an image does not verify, look "
+                                 "for AccurateRip matches up to %d samples "
+                                 "either way, to detect a rip made with the "
+                                 "wrong read offset" % accurip.OFFSET_SEARCH)
+        self.parser.add_argument('-r', '--recursive',
+                                 action="store_true", dest="recursive",
+                                 help="verify the images of all .cue files "
+                                 "under the given directories")
+        self.parser.add_argument('-j', '--jobs',
+                                 action="store", dest="jobs", type=int,
+                                 help="with --recursive, number of images to "
+                                 "verify at the same time (default: number "
+                                 "of CPUs)")
+        self.parser.add_argument('--database',
+                                 action="store", dest="database",
+                                 help="with --recursive, database to keep "
+                                 "results in, by the size and modification "
+                                 "time of the image's files only (default: "
+                                 "verify.sqlite3 in whipper's data "
+                                 "directory)")
+        self.parser.add_argument('-f', '--force',
+                                 action="store_true", dest="force",
+                                 help="with --recursive, also verify images "
+                                 "that verified before and have not changed")
+        self.parser.add_argument('--max-age',
+                                 action="store", dest="max_age", type=float,
+                                 help="with --recursive, verify images that "
+                                 "verified more than this many days ago "
+                                 "again, even if they have not changed, to "
+                                 "catch audio that rotted")
 
     def do(self):
-        prog = program.Program(config.Config())
+        if self.options.recursive:
+            return self._doRecursive()
+
+        prog = program.Program(config.Config(),
+                               offline=self.options.offline)
         runner = task.SyncRunner()
 
         for arg in self.options.cuefile:
             arg = arg.decode('utf-8')
-            cueImage = image.Image(arg)
-            cueImage.setup(runner)
-
-            # FIXME: this feels like we're poking at internals.
-            prog.cuePath = arg
-            prog.result = result.RipResult()
-            for track in cueImage.table.tracks:
-                tr = result.TrackResult()
-                tr.number = track.number
-                prog.result.tracks.append(tr)
-
-            verified = False
-            try:
-                verified = prog.verifyImage(runner, cueImage.table)
-            except accurip.EntryNotFound:
-                print('AccurateRip entry not found')
-            accurip.print_report(prog.result)
+            verified, cueImage = _verify(prog, runner, arg)
+            if not verified and self.options.offset_search:
+                _searchOffset(arg, cueImage, self.options.offline)
             if not verified:
                 sys.exit(1)
 
+    def _doRecursive(self):
+        cuePaths = _findCueFiles([os.path.abspath(arg.decode('utf-8'))
+                                  for arg in self.options.cuefile])
+        path = self.options.database
+        if path:
+            path = os.path.expanduser(path).decode('utf-8')
+        else:
+            path = os.path.join(directory.data_path(), u'verify.sqlite3')
+        db = database.VerifyDatabase(path)
+
+        # only images that verified recently enough can be skipped; others
+        # are verified again, as the AccurateRip database may have caught up
+        # with them
+        oldest = None
+        if self.options.max_age is not None:
+            oldest = time.time() - self.options.max_age * 24 * 60 * 60
+        jobs = []
+        for cuePath in cuePaths:
+            disc = db.get(cuePath)
+            files = None
+            if (disc and disc.verified and not self.options.force and
+                    (oldest is None or disc.checked >= oldest)):
+                files = disc.files
+            jobs.append((cuePath, files))
+
+        counts = {'verified': 0, 'not verified': 0, 'unchanged': 0}
+        pool = multiprocessing.Pool(
+            self.options.jobs, _initWorker,
+            (self.options.offline, self.options.offset_search))
+        try:
+            for cuePath, files, verified, report in pool.imap_unordered(
+                    _verifyDisc, jobs):
+                if verified is None:
+                    logger.debug('%s unchanged since it verified', cuePath)
+                    counts['unchanged'] += 1
+                    continue
+                status = verified and 'verified' or 'not verified'
+                counts[status] += 1
+                sys.stdout.write('%s: %s\n' % (cuePath.encode('utf-8'),
+                                               status))
+                if not verified:
+                    sys.stdout.write(report)
+                if files is not None:
+                    db.store(cuePath, files, verified, report)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            db.close()
+
+        sys.stdout.write('%(verified)d verified, %(not verified)d not '
+                         'verified, %(unchanged)d unchanged since they '
+                         'verified\n' % counts)
+        if counts['not verified']:
+            sys.exit(1)
+
+
+class Encode(BaseCommand):
+    summary = "encode image"
+    description = """
+Encodes the tracks of the images from the given .cue files to FLAC,
+several tracks at the same time.
+"""
+
+    def add_arguments(self):
+        self.parser.add_argument('cuefile', nargs='+', action='store',
+                                 help="cue file to load rip image from")
+        self.parser.add_argument('-O', '--output-directory',
+                                 action="store", dest="output_directory",
+                                 default=os.path.relpath(os.getcwd()),
+                                 help="output directory for the encoded "
+                                 "tracks")
+        self.parser.add_argument('--encode-jobs',
+                                 action="store", dest="encode_jobs",
+                                 type=int,
+                                 help="number of tracks to encode at the "
+                                 "same time (default: number of CPUs)")
+
+    def do(self):
+        runner = task.SyncRunner()
+        outdir = os.path.expanduser(
+            self.options.output_directory).decode('utf-8')
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+        for arg in self.options.cuefile:
+            arg = arg.decode('utf-8')
+            cueImage = image.Image(arg)
+            runner.run(image.ImageEncodeTask(
+                cueImage, outdir, jobs=self.options.encode_jobs))
+
 
 class Image(BaseCommand):
     summary = "handle images"
     description = """
 Handle disc images.  Disc images are described by a .cue file.
-Disc images can be verified.
+Disc images can be verified and encoded.
 """
     subcommands = {
+        'encode': Encode,
         'verify': Verify,
     }
@@ -10,7 +10,7 @@ import whipper
 
 from whipper.command import cd, offset, drive, image, accurip, mblookup
 from whipper.command.basecommand import BaseCommand
-from whipper.common import common, directory, config
+from whipper.common import common, directory, config, mbngs
 from whipper.extern.task import task
 from whipper.program.utils import eject_device
 
@@ -21,11 +21,13 @@ logger = logging.getLogger(__name__)
 def main():
     try:
         server = config.Config().get_musicbrainz_server()
+        rate = config.Config().get_musicbrainz_rate()
     except KeyError as e:
         sys.stderr.write('whipper: %s\n' % str(e))
         sys.exit()
 
     musicbrainzngs.set_hostname(server)
+    mbngs.set_rate_limit(rate)
     # register plugins with pkg_resources
     distributions, _ = pkg_resources.working_set.find_plugins(
         pkg_resources.Environment([directory.data_path('plugins')])
@@ -87,6 +89,10 @@ You can get help on subcommands by using the -h option to the subcommand.
         self.parser.add_argument('-R', '--record',
                                  action='store_true', dest='record',
                                  help="record API requests for playback")
+        self.parser.add_argument('--offline',
+                                 action='store_true', dest='offline',
+                                 help="don't query online databases, only "
+                                 "use what was cached earlier")
         self.parser.add_argument('-v', '--version',
                                  action="store_true", dest="version",
                                  help="show version information")
@@ -1,5 +1,6 @@
 from whipper.command.basecommand import BaseCommand
-from whipper.common.mbngs import musicbrainz
+from whipper.common import config
+from whipper.common.mbngs import musicbrainz, open_cache
 
 
 class MBLookup(BaseCommand):
@@ -14,6 +15,10 @@ Example disc id: KnpGsLhvH.lPrNc1PBL21lb9Bg4-"""
         self.parser.add_argument(
             'mbdiscid', action='store', help="MB disc id to look up"
         )
+        self.parser.add_argument(
+            '--refresh', action='store_true', dest='refresh',
+            help="look up the disc again even if it was looked up recently"
+        )
 
     def do(self):
         try:
@@ -22,7 +27,9 @@ Example disc id: KnpGsLhvH.lPrNc1PBL21lb9Bg4-"""
             print('Please specify a MusicBrainz disc id.')
             return 3
 
-        metadatas = musicbrainz(discId)
+        metadatas = musicbrainz(discId, cache=open_cache(config.Config()),
+                                refresh=self.options.refresh,
+                                offline=self.options.offline)
 
         print('%d releases' % len(metadatas))
         for i, md in enumerate(metadatas):
@@ -19,14 +19,13 @@
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import os
 import sys
-import tempfile
 import logging
 from whipper.command.basecommand import BaseCommand
-from whipper.common import accurip, common, config, drive
+from whipper.common import accurip, checksum, common, config, drive
+from whipper.common import pipeline
 from whipper.common import task as ctask
-from whipper.program import arc, cdrdao, cdparanoia, utils
+from whipper.program import cdrdao, cdparanoia, utils
 from whipper.extern.task import task
 
 logger = logging.getLogger(__name__)
@@ -47,10 +46,66 @@ OFFSETS = ("+6, +667, +48, +102, +12, +30, +103, +618, +96, +594, "
            "+1127")
 
 
+def match(arcs, track, index, offsets):
+    """
+    Return the given offsets a track read once matches the AccurateRip
+    responses at.
+
+    The v1 checksums of all offsets are compared first; only if none of
+    them match are the v2 checksums calculated.
+
+    @type  arcs:  L{accurip.OffsetChecksums}
+    @param track: the number of the track
+    @type  index: L{accurip.ResponseIndex}
+
+    @rtype: list of int
+    """
+    lowest, highest = arcs.offsets()
+    readable = [o for o in offsets if lowest <= o <= highest]
+    for offset in offsets:
+        if offset not in readable:
+            logger.debug('cannot check track %d at offset %d', track,
+                         offset)
+    if not readable:
+        return []
+
+    v1 = arcs.v1(min(readable), max(readable))
+    matched = [o for o in readable if index.lookup(track - 1, v1[o])]
+    if not matched:
+        matched = [o for o in readable
+                   if index.lookup(track - 1, arcs.checksums(o)[1])]
+    logger.debug('track %d matched at offsets %r', track, matched)
+    return matched
+
+
+class _MatchJob(object):
+    """
+    I match a track read once against the AccurateRip responses, so that
+    it can be done in a worker thread while the next track is read.
+
+    @ivar matched: the offsets the track matched at
+    """
+
+    matched = None
+
+    def __init__(self, arcs, track, index, offsets):
+        self.track = track
+        self._arcs = arcs
+        self._index = index
+        self._offsets = offsets
+
+    def run(self):
+        self.matched = match(self._arcs, self.track, self._index,
+                             self._offsets)
+        # let go of the audio as soon as possible
+        self._arcs = None
+
+
 class Find(BaseCommand):
     summary = "find drive read offset"
-    description = """Find drive's read offset by ripping tracks from a
-CD in the AccurateRip database."""
+    description = """Find drive's read offset by reading tracks from a
+CD in the AccurateRip database. Each track is read only once, and checked at
+all offsets. An offset is confirmed once enough tracks match at it."""
     formatter_class = argparse.ArgumentDefaultsHelpFormatter
     device_option = True
 
@@ -60,6 +115,11 @@ CD in the AccurateRip database."""
             action="store", dest="offsets", default=OFFSETS,
             help="list of offsets, comma-separated, colon-separated for ranges"
         )
+        self.parser.add_argument(
+            '--confirm',
+            action="store", dest="confirm", type=int, default=3,
+            help="number of tracks that need to match to confirm an offset"
+        )
 
     def handle_arguments(self):
         self._offsets = []
@@ -85,13 +145,17 @@ CD in the AccurateRip database."""
         utils.unmount_device(device)
 
         # first get the Table Of Contents of the CD
-        t = cdrdao.ReadTOCTask(device)
-        table = t.table
+        t = cdrdao.ReadTOC_Task(device)
+        runner.run(t)
+        table = t.toc.table
 
         logger.debug("CDDB disc id: %r", table.getCDDBDiscId())
         responses = None
         try:
-            responses = accurip.get_db_entry(table.accuraterip_path())
+            responses = accurip.get_db_entry(
+                table.accuraterip_path(),
+                accurip.open_cache(config.Config()),
+                offline=self.options.offline)
         except accurip.EntryNotFound:
             logger.warning("AccurateRip entry not found: drive offset "
                            "can't be determined, try again with another disc")
@@ -103,106 +167,94 @@ CD in the AccurateRip database."""
                 logger.warning("AccurateRip response discid different: %s",
                                responses[0].cddbDiscId)
 
-        # now rip the first track at various offsets, calculating AccurateRip
-        # CRC, and matching it against the retrieved ones
-
-        # archecksums is a tuple of accuraterip checksums: (v1, v2)
-        def match(archecksums, track, responses):
-            for i, r in enumerate(responses):
-                for checksum in archecksums:
-                    if checksum == r.checksums[track - 1]:
-                        return checksum, i
-
-            return None, None
-
-        for offset in self._offsets:
-            sys.stdout.write('Trying read offset %d ...\n' % offset)
-            try:
-                archecksums = self._arcs(runner, table, 1, offset)
-            except task.TaskException as e:
-
-                # let MissingDependency fall through
-                if isinstance(e.exception,
-                              common.MissingDependencyException):
-                    raise e
-
-                if isinstance(e.exception, cdparanoia.FileSizeError):
-                    sys.stdout.write(
-                        'WARNING: cannot rip with offset %d...\n' % offset)
+        # now read the tracks once each, except for the last one (to avoid
+        # readers that can't do overread), and match their AccurateRip
+        # checksums at all offsets against the retrieved ones; matching is
+        # done in a worker while the next track is read
+        tracks = range(1, max(2, len(table.tracks)))
+        threshold = min(self.options.confirm, len(tracks))
+        margin = max(abs(offset) for offset in self._offsets)
+        counts = dict((offset, 0) for offset in self._offsets)
+        first = {}
+        index = accurip.ResponseIndex(responses)
+
+        def matched(job):
+            if job.track == 1:
+                first['offsets'] = job.matched
+                for offset in job.matched:
+                    sys.stdout.write('Offset of device is likely %d, '
+                                     'confirming ...\n' % offset)
+            for offset in job.matched:
+                counts[offset] += 1
+                logger.debug('track %d matched at offset %d, %d of %d',
+                             job.track, offset, counts[offset], threshold)
+
+        def confirmed():
+            return [o for o in self._offsets if counts[o] >= threshold]
+
+        worker = pipeline.Worker()
+        try:
+            for track in tracks:
+                worker.collect()
+                # stop once an offset is confirmed, or the first track
+                # matched none
+                if confirmed() or first.get('offsets') == []:
+                    break
+                try:
+                    arcs = self._read(runner, table, track, margin)
+                except task.TaskException as e:
+                    # let MissingDependency fall through
+                    if isinstance(e.exception,
+                                  common.MissingDependencyException):
+                        raise e
+                    logger.warning("Task exception while reading track %d: "
+                                   "%r", track, e)
+                    sys.stdout.write('WARNING: cannot read track %d\n' %
+                                     track)
                     continue
-
-                logger.warning("Unknown task exception for offset %d: %r" % (
-                    offset, e))
-                sys.stdout.write(
-                    'WARNING: cannot rip with offset %d...\n' % offset)
-                continue
-
-            logger.debug('AR checksums calculated: %s %s' % archecksums)
-
-            c, i = match(archecksums, 1, responses)
-            if c:
-                count = 1
-                logger.debug('MATCHED against response %d' % i)
-                sys.stdout.write(
-                    'Offset of device is likely %d, confirming ...\n' %
-                    offset)
-
-                # now try and rip all other tracks as well, except for the
-                # last one (to avoid readers that can't do overread
-                for track in range(2, (len(table.tracks) + 1) - 1):
-                    try:
-                        archecksums = self._arcs(runner, table, track, offset)
-                    except task.TaskException as e:
-                        if isinstance(e.exception, cdparanoia.FileSizeError):
-                            sys.stdout.write(
-                                'WARNING: cannot rip with offset %d...\n' %
-                                offset)
-                            continue
-
-                    c, i = match(archecksums, track, responses)
-                    if c:
-                        logger.debug('MATCHED track %d against response %d' % (
-                            track, i))
-                        count += 1
-
-                if count == len(table.tracks) - 1:
-                    self._foundOffset(device, offset)
-                    return 0
-                else:
-                    sys.stdout.write(
-                        'Only %d of %d tracks matched, continuing ...\n' % (
-                            count, len(table.tracks)))
-
+                worker.put(_MatchJob(arcs, track, index, self._offsets),
+                           matched)
+        finally:
+            worker.join()
+
+        offsets = confirmed()
+        if offsets:
+            self._foundOffset(device, offsets[0])
+            return 0
+
+        for offset in first.get('offsets', []):
+            sys.stdout.write('Only %d of %d tracks matched offset %d\n' % (
+                counts[offset], threshold, offset))
         sys.stdout.write('No matching offset found.\n')
         sys.stdout.write('Consider trying again with a different disc.\n')
 
-    def _arcs(self, runner, table, track, offset):
-        # rips the track with the given offset, return the arcs checksums
-        logger.debug('Ripping track %r with offset %d ...', track, offset)
-
-        fd, path = tempfile.mkstemp(
-            suffix=u'.track%02d.offset%d.whipper.wav' % (
-                track, offset))
-        os.close(fd)
-
-        t = cdparanoia.ReadTrackTask(path, table,
-                                     table.getTrackStart(
-                                         track), table.getTrackEnd(track),
-                                     overread=False, offset=offset,
-                                     device=self.options.device)
-        t.description = 'Ripping track %d with read offset %d' % (
-            track, offset)
+    def _read(self, runner, table, track, margin):
+        """
+        Read the track once with a read offset of 0, with margin samples
+        more on both sides where the disc allows.
+
+        @rtype: L{accurip.OffsetChecksums}
+        """
+        frames = -(-margin // common.SAMPLES_PER_FRAME)
+        start = table.getTrackStart(track)
+        stop = table.getTrackEnd(track)
+        readStart = max(0, start - frames)
+        readStop = min(stop + frames, table.getTrackEnd(len(table.tracks)))
+        logger.debug('Reading track %r from %d to %d ...', track,
+                     readStart, readStop)
+
+        digest = checksum.BufferDigest()
+        t = cdparanoia.ReadTrackTask(None, table, readStart, readStop,
+                                     overread=False,
+                                     device=self.options.device,
+                                     digest=digest)
+        t.description = 'Reading track %d' % track
         runner.run(t)
 
-        v1 = arc.accuraterip_checksum(
-                path, track, len(table.tracks), wave=True, v2=False
-            )
-        v2 = arc.accuraterip_checksum(
-                path, track, len(table.tracks), wave=True, v2=True
-            )
-
-        os.unlink(path)
-        return ("%08x" % v1, "%08x" % v2)
+        return accurip.OffsetChecksums(
+            digest.data, (start - readStart) * common.SAMPLES_PER_FRAME,
+            (stop - start + 1) * common.SAMPLES_PER_FRAME, track,
+            len(table.tracks))
 
     def _foundOffset(self, device, offset):
         sys.stdout.write('\nRead offset of device is: %d.\n' %
@@ -19,10 +19,15 @@
 # You should have received a copy of the GNU General Public License
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import os
 import requests
 import struct
+import sys
 
-from whipper.program.arc import accuraterip_checksum
+from accuraterip import compute, update
+
+from whipper.common import cache, common, pcm
 
 import logging
 logger = logging.getLogger(__name__)
@@ -30,11 +35,21 @@ logger = logging.getLogger(__name__)
 
 ACCURATERIP_URL = "http://www.accuraterip.com/accuraterip/"
 
+# defaults for the [accuraterip] section of the config file
+CACHE_TTL = 30  # days an entry is used without asking accuraterip.com again
+CACHE_SIZE = 32  # MiB the cached entries may take up
+
+# how far to search around the read offset of a rip, in samples
+OFFSET_SEARCH = 3000
+
 
 class EntryNotFound(Exception):
     pass
 
 
+_HEADER = struct.Struct('<BLLL')
+
+
 class _AccurateRipResponse(object):
     """
     An AccurateRip response contains a collection of metadata identifying a
@@ -48,48 +63,113 @@ class _AccurateRipResponse(object):
     HTOA).
 
     The response is stored as a packed binary structure.
+
+    @ivar nbytes: the size of the response in the entry, in bytes
     """
-    def __init__(self, data):
+    def __init__(self, data, offset=0):
         """
         The checksums and confidences arrays are indexed by relative track
         position, so track 1 will have array index 0, track 2 will have array
         index 1, and so forth. HTOA and other hidden tracks are not included.
+
+        @param data:   the entry holding the response
+        @param offset: where the response starts in data
+        """
+        (self.num_tracks, discId1, discId2,
+         cddbDiscId) = _HEADER.unpack_from(data, offset)
+        self.discId1 = "%08x" % discId1
+        self.discId2 = "%08x" % discId2
+        self.cddbDiscId = "%08x" % cddbDiscId
+
+        # per track: the confidence, the checksum, and a checksum of frame
+        # 450 that whipper does not use
+        tracks = struct.unpack_from('<' + 'BL4x' * self.num_tracks, data,
+                                    offset + _HEADER.size)
+        self.nbytes = _HEADER.size + self.num_tracks * 9
+        self.confidences = array.array('B', tracks[0::2])
+        self.crcs = array.array('I', tracks[1::2])
+
+    @property
+    def checksums(self):
+        """
+        The checksums of the tracks, as hex strings.
         """
-        self.num_tracks = struct.unpack("B", data[0])[0]
-        self.discId1 = "%08x" % struct.unpack("<L", data[1:5])[0]
-        self.discId2 = "%08x" % struct.unpack("<L", data[5:9])[0]
-        self.cddbDiscId = "%08x" % struct.unpack("<L", data[9:13])[0]
-
-        self.confidences = []
-        self.checksums = []
-        pos = 13
-        for _ in range(self.num_tracks):
-            confidence = struct.unpack("B", data[pos])[0]
-            checksum = "%08x" % struct.unpack("<L", data[pos + 1:pos + 5])[0]
-            self.confidences.append(confidence)
-            self.checksums.append(checksum)
-            pos += 9
+        return ["%08x" % crc for crc in self.crcs]
 
     def __eq__(self, other):
         return [
             self.num_tracks, self.discId1, self.discId2, self.cddbDiscId,
-            self.confidences, self.checksums
+            self.confidences, self.crcs
         ] == [
             other.num_tracks, other.discId1, other.discId2, other.cddbDiscId,
-            other.confidences, other.checksums
+            other.confidences, other.crcs
         ]
 
 
 def _split_responses(raw_entry):
     responses = []
-    while raw_entry:
-        track_count = struct.unpack("B", raw_entry[0])[0]
-        nbytes = 1 + 12 + track_count * (1 + 8)
-        responses.append(_AccurateRipResponse(raw_entry[:nbytes]))
-        raw_entry = raw_entry[nbytes:]
+    offset = 0
+    while offset < len(raw_entry):
+        response = _AccurateRipResponse(raw_entry, offset)
+        responses.append(response)
+        offset += response.nbytes
     return responses
 
 
+class ResponseIndex(object):
+    """
+    I index the checksums of all AccurateRip responses for a disc by track,
+    so that a checksum can be looked up in one step, however many
+    responses there are.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        # per track: checksum -> (highest confidence, response index)
+        self._tracks = []
+        # per track: (highest confidence, its checksum)
+        self._max = []
+        for n, r in enumerate(responses):
+            for i in range(r.num_tracks):
+                if i == len(self._tracks):
+                    self._tracks.append({})
+                    self._max.append((None, None))
+                confidence = r.confidences[i]
+                crc = r.crcs[i]
+                found = self._tracks[i].get(crc)
+                if found is None or confidence > found[0]:
+                    self._tracks[i][crc] = (confidence, n)
+                if confidence > self._max[i][0]:
+                    self._max[i] = (confidence, crc)
+
+    def lookup(self, i, crc):
+        """
+        Look up a checksum of a track.
+
+        @param i:   the index of the track, as in the responses
+        @param crc: the checksum, as an int or a hex string
+
+        @returns: the highest confidence of the checksum and the index of
+                  the response it is in, or None if no response has it
+        @rtype:   tuple of (int, int) or None
+        """
+        if crc is None or i >= len(self._tracks):
+            return None
+        if not isinstance(crc, (int, long)):
+            crc = int(crc, 16)
+        return self._tracks[i].get(crc)
+
+    def maxConfidence(self, i):
+        """
+        Return the highest confidence of any checksum of a track, and that
+        checksum as a hex string.
+
+        @rtype: tuple of (int, str)
+        """
+        confidence, crc = self._max[i]
+        return confidence, "%08x" % crc
+
+
 def calculate_checksums(track_paths):
     """
     Return ARv1 and ARv2 checksums as two arrays of character strings in a
@@ -105,39 +185,232 @@ def calculate_checksums(track_paths):
     logger.debug('checksumming %d tracks' % track_count)
     # This is done sequentially because it is very fast.
     for i, path in enumerate(track_paths):
-        v1_sum = accuraterip_checksum(
-            path, i+1, track_count, wave=True, v2=False
-        )
-        if not v1_sum:
+        try:
+            v1_sum, v2_sum = compute(path, i+1, track_count)
+        except (IOError, ValueError) as e:
             logger.error(
-                'could not calculate AccurateRip v1 checksum for track %d %r' %
-                (i+1, path)
+                'could not calculate AccurateRip checksums for track %d %r: '
+                '%s' % (i+1, path, e)
             )
             v1_checksums.append(None)
-        else:
-            v1_checksums.append("%08x" % v1_sum)
-        v2_sum = accuraterip_checksum(
-            path, i+1, track_count, wave=True, v2=True
-        )
-        if not v2_sum:
-            logger.error(
-                'could not calculate AccurateRip v2 checksum for track %d %r' %
-                (i+1, path)
-            )
             v2_checksums.append(None)
-        else:
-            v2_checksums.append("%08x" % v2_sum)
+            continue
+        v1_checksums.append("%08x" % v1_sum)
+        v2_checksums.append("%08x" % v2_sum)
     return {'v1': v1_checksums, 'v2': v2_checksums}
 
 
+class OffsetChecksums(object):
+    """
+    I calculate the AccurateRip checksums a track would have when read with
+    any of a range of read offsets, from a single read of the track with a
+    margin of samples around it.
+
+    The v1 checksum is a sum of sample values weighted by their position in
+    the track, so when the track is moved by one sample, only the samples
+    at both ends of the window and the plain sum of the samples in between
+    need to be taken into account. This makes calculating the v1 checksums
+    of all offsets in a range about as fast as calculating one. The v2
+    checksum does not allow this, and is calculated for one offset at a
+    time.
+    """
+
+    def __init__(self, data, before, sampleCount, trackNumber, trackCount):
+        """
+        @param data:        the audio data read with a read offset of 0,
+                            starting before the track
+        @type  data:        str or bytearray
+        @param before:      the number of samples in data before the track
+        @param sampleCount: length of the track, in samples
+        @param trackNumber: number of the track on the disc (1-based)
+        @param trackCount:  number of audio tracks on the disc
+        """
+        self._data = data
+        self._samples = len(data) / 4
+        self._before = before
+        self.sampleCount = sampleCount
+        # the 1-based range of positions in the track that count
+        skip = common.SAMPLES_PER_FRAME * 5
+        self._checkFrom = 1
+        self._checkTo = sampleCount
+        if trackNumber == 1:
+            self._checkFrom = skip
+        if trackNumber == trackCount:
+            self._checkTo -= skip
+
+    def _index(self, position, offset):
+        # index in data of the sample at the given position in the track
+        return self._before + offset + position - 1
+
+    def _samplesAt(self, index, count):
+        # count samples as 32 bit unsigned integers
+        samples = array.array('I')
+        samples.fromstring(str(buffer(self._data, index * 4, count * 4)))
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        return samples
+
+    def offsets(self):
+        """
+        Return the lowest and highest read offsets the data covers all
+        samples that count for.
+
+        @rtype: tuple of (int, int)
+        """
+        return (-self._index(self._checkFrom, 0),
+                self._samples - 1 - self._index(self._checkTo, 0))
+
+    def checksums(self, offset):
+        """
+        Return the v1 and v2 checksums of the track at the given read offset.
+
+        @rtype: tuple of (int, int)
+        """
+        lowest, highest = self.offsets()
+        if not lowest <= offset <= highest:
+            raise ValueError('offset %d not in %d..%d' % (
+                offset, lowest, highest))
+        start = self._index(self._checkFrom, offset)
+        count = self._checkTo - self._checkFrom + 1
+        return update(buffer(self._data, start * 4, count * 4),
+                      self._checkFrom, self._checkFrom, self._checkTo, 0, 0)
+
+    def v1(self, first, last):
+        """
+        Return the v1 checksums of the track at the read offsets from first
+        to last.
+
+        @returns: the checksums, by offset
+        @rtype:   dict of int -> int
+        """
+        lowest, highest = self.offsets()
+        if not lowest <= first <= last <= highest:
+            raise ValueError('offsets %d..%d not in %d..%d' % (
+                first, last, lowest, highest))
+
+        lo, hi = self._checkFrom, self._checkTo
+        count = hi - lo + 1
+        start = self._index(lo, first)
+        window = buffer(self._data, start * 4, count * 4)
+        # the weighted sum, and the same with each weight one higher; the
+        # difference is the plain sum
+        v1, _ = update(window, lo, lo, hi, 0, 0)
+        shifted, _ = update(window, lo + 1, lo + 1, hi + 1, 0, 0)
+        total = (shifted - v1) & 0xffffffff
+
+        steps = last - first
+        leaving = self._samplesAt(start, steps)
+        entering = self._samplesAt(start + count, steps)
+        checksums = {first: v1}
+        for i in range(steps):
+            # moving the window up by one sample drops its first sample,
+            # adds the next one at the end, and lowers the weights of the
+            # ones in between by one
+            total = (total - leaving[i] + entering[i]) & 0xffffffff
+            v1 = (v1 - lo * leaving[i] + (hi + 1) * entering[i] -
+                  total) & 0xffffffff
+            checksums[first + i + 1] = v1
+        return checksums
+
+
+def _read(path, sampleStart=0, sampleLength=-1):
+    source = pcm.open(path, sampleStart, sampleLength)
+    data = bytearray(source.samples * 4)
+    view = memoryview(data)
+    read = 0
+    try:
+        while read < len(data):
+            size = source.readinto(view[read:])
+            if not size:
+                break
+            read += size
+        source.close()
+    except Exception:
+        source.abort()
+        raise
+    return data
+
+
+def search_offsets(track_paths, responses, margin=OFFSET_SEARCH):
+    """
+    Return the read offsets, relative to the one the tracks were ripped
+    with, at which each track would match one of the responses, by its v1
+    checksum.
+
+    Audio from the neighbouring tracks is used to move each track by up to
+    margin samples either way. A rip made with the wrong read offset
+    matches at the same non-zero offset for all tracks.
+
+    @param track_paths: the .wav or FLAC files of all tracks, in order
+    @param margin:      how far to move the tracks, in samples
+
+    @returns: the sorted offsets, or None if the track could not be read,
+              for each track
+    @rtype:   list of (list of int or None)
+    """
+    lengths = []
+    for path in track_paths:
+        try:
+            lengths.append(pcm.length(path))
+        except Exception as e:
+            logger.error('could not read %r: %s', path, e)
+            lengths.append(None)
+
+    count = len(track_paths)
+    index = ResponseIndex(responses)
+    offsets = []
+    for i, path in enumerate(track_paths):
+        if lengths[i] is None:
+            offsets.append(None)
+            continue
+        logger.debug('searching offsets of track %d', i + 1)
+        try:
+            data = bytearray()
+            before = 0
+            if i > 0 and lengths[i - 1]:
+                before = min(margin, lengths[i - 1])
+                data += _read(track_paths[i - 1], lengths[i - 1] - before)
+            data += _read(path)
+            if i < count - 1 and lengths[i + 1]:
+                data += _read(track_paths[i + 1], 0,
+                              min(margin, lengths[i + 1]))
+        except Exception as e:
+            logger.error('could not read %r: %s', path, e)
+            offsets.append(None)
+            continue
+
+        arcs = OffsetChecksums(data, before, lengths[i], i + 1, count)
+        lowest, highest = arcs.offsets()
+        v1 = arcs.v1(max(-margin, lowest), min(margin, highest))
+        offsets.append(sorted(offset for offset, checksum in v1.items()
+                              if index.lookup(i, checksum)))
+    return offsets
+
+
+_session = {}  # process id -> requests.Session
+
+
+def _get_session():
+    # one session per process, so that connections to accuraterip.com are
+    # kept open between entries, but not shared with forked processes
+    pid = os.getpid()
+    if pid not in _session:
+        _session.clear()
+        _session[pid] = requests.Session()
+    return _session[pid]
+
+
 def _download_entry(path):
     url = ACCURATERIP_URL + path
     logger.debug('downloading AccurateRip entry from %s', url)
     try:
-        resp = requests.get(url)
+        resp = _get_session().get(url)
     except requests.exceptions.ConnectionError as e:
         logger.error('error retrieving AccurateRip entry: %r' % e)
         return None
+    if resp.status_code == 404:
+        # the disc is not in the database, which is worth remembering too
+        return ''
     if not resp.ok:
         logger.error('error retrieving AccurateRip entry: %s %s %r' % (
             resp.status_code, resp.reason, resp
@@ -146,30 +419,56 @@ def _download_entry(path):
     return resp.content
 
 
-def get_db_entry(path):
+def open_cache(conf):
+    """
+    Return the cache for AccurateRip entries, as set up in the
+    [accuraterip] section of the config file (cache_ttl in days,
+    cache_size in MiB).
+
+    @type conf: L{whipper.common.config.Config}
+    @rtype:     L{cache.FileCache}
+    """
+    return cache.from_config(conf, 'accuraterip', 'accurip',
+                             CACHE_TTL, CACHE_SIZE)
+
+
+def get_db_entry(path, cache=None, offline=False):
     """
     Downloads entry from accuraterip.com.
 
     `path' is in the format of the output of table.accuraterip_path().
+
+    With a cache, a fresh entry from it is used instead of downloading it,
+    and downloaded entries are stored in it; an expired one is still used
+    when accuraterip.com can't be reached. Offline, only the cache is used.
+
+    @type cache:   L{whipper.common.cache.FileCache} or None
+    @type offline: bool
     """
-    raw_entry = _download_entry(path)
+    raw_entry = cache and cache.get(path)
+    if raw_entry is None and not offline:
+        raw_entry = _download_entry(path)
+        if cache and raw_entry is not None:
+            cache.put(path, raw_entry)
+    if raw_entry is None and cache:
+        raw_entry = cache.get(path, stale=True)
+        if raw_entry is not None:
+            logger.warning('using expired AccurateRip entry from cache')
     if not raw_entry:
         logger.warning('entry not found in AccurateRip database')
         raise EntryNotFound
     return _split_responses(raw_entry)
 
 
-def _assign_checksums_and_confidences(tracks, checksums, responses):
+def _assign_checksums_and_confidences(tracks, checksums, index):
     for i, track in enumerate(tracks):
         for v in ('v1', 'v2'):
             track.AR[v]['CRC'] = checksums[v][i]
-        track.AR['DBMaxConfidence'], track.AR['DBMaxConfidenceCRC'] = max(
-            [(r.confidences[i], r.checksums[i]) for r in responses],
-            key=lambda t: t[0]
-        )
+        track.AR['DBMaxConfidence'], track.AR['DBMaxConfidenceCRC'] = \
+            index.maxConfidence(i)
 
 
-def _match_responses(tracks, responses):
+def _match_responses(tracks, index):
     """
     Match and save track accuraterip response checksums against
     all non-hidden tracks.
@@ -177,19 +476,18 @@ def _match_responses(tracks, responses):
     Returns True if every track has a match for every entry for either
     AccurateRip version.
     """
-    for r in responses:
-        for i, track in enumerate(tracks):
-            for v in ('v1', 'v2'):
-                if track.AR[v]['CRC'] == r.checksums[i]:
-                    if r.confidences[i] > track.AR[v]['DBConfidence']:
-                        track.AR[v]['DBCRC'] = r.checksums[i]
-                        track.AR[v]['DBConfidence'] = r.confidences[i]
-                        logger.debug(
-                            'track %d matched response %s in AccurateRip'
-                            ' database: %s crc %s confidence %s' %
-                            (i, r.cddbDiscId, v, track.AR[v]['DBCRC'],
-                             track.AR[v]['DBConfidence'])
-                        )
+    for i, track in enumerate(tracks):
+        for v in ('v1', 'v2'):
+            found = index.lookup(i, track.AR[v]['CRC'])
+            if found:
+                track.AR[v]['DBCRC'] = track.AR[v]['CRC']
+                track.AR[v]['DBConfidence'] = found[0]
+                logger.debug(
+                    'track %d matched response %s in AccurateRip'
+                    ' database: %s crc %s confidence %s' %
+                    (i, index.responses[found[1]].cddbDiscId, v,
+                     track.AR[v]['DBCRC'], track.AR[v]['DBConfidence'])
+                )
     return any((
         all([t.AR['v1']['DBCRC'] for t in tracks]),
         all([t.AR['v2']['DBCRC'] for t in tracks])
@@ -209,14 +507,18 @@ def verify_result(result, responses, checksums):
     tracks = [t for t in result.tracks if t.number != 0]
     if not tracks:
         return False
-    _assign_checksums_and_confidences(tracks, checksums, responses)
-    return _match_responses(tracks, responses)
+    index = ResponseIndex(responses)
+    _assign_checksums_and_confidences(tracks, checksums, index)
+    return _match_responses(tracks, index)
 
 
-def print_report(result):
+def print_report(result, stdout=None):
     """
     Print AccurateRip verification results to stdout.
+
+    @param stdout: the file to print to instead of sys.stdout
     """
+    stdout = stdout or sys.stdout
     for i, track in enumerate(result.tracks):
         status = 'rip NOT accurate'
         conf = '(not found)'
@@ -240,15 +542,17 @@ def print_report(result):
                     )
         # htoa tracks (i == 0) do not have an ARCRC
         if track.number == 0:
-            print('track  0: unknown          (not tracked)')
+            stdout.write('track  0: unknown          (not tracked)\n')
             continue
         if not (track.AR['v1']['CRC'] or track.AR['v2']['CRC']):
             logger.error(
                 'no track AR CRC on non-HTOA track %d' % track.number
             )
-            print('track %2d: unknown          (error)' % track.number)
+            stdout.write('track %2d: unknown          (error)\n' %
+                         track.number)
         else:
-            print('track %2d: %-16s %-23s v1 [%s], v2 [%s], DB [%s]' % (
-                track.number, status, conf,
-                track.AR['v1']['CRC'], track.AR['v2']['CRC'], db
-            ))
+            stdout.write(
+                'track %2d: %-16s %-23s v1 [%s], v2 [%s], DB [%s]\n' % (
+                    track.number, status, conf,
+                    track.AR['v1']['CRC'], track.AR['v2']['CRC'], db
+                ))
@@ -0,0 +1,162 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_cache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is part of whipper.
+#
+# whipper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# whipper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with whipper.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import tempfile
+import time
+
+from whipper.common import directory
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def from_config(conf, section, name, ttl, size):
+    """
+    Return a cache in the named directory of whipper's cache directory,
+    with cache_ttl (in days) and cache_size (in MiB) read from the given
+    section of the config file.
+
+    @type  conf: L{whipper.common.config.Config}
+    @param ttl:  days an entry is fresh if not configured
+    @param size: MiB the entries may take up if not configured
+
+    @rtype: L{FileCache}
+    """
+    configured = conf.getint(section, 'cache_ttl')
+    if configured is not None:
+        ttl = configured
+    configured = conf.getint(section, 'cache_size')
+    if configured is not None:
+        size = configured
+    return FileCache(directory.cache_path(name), ttl=ttl * 24 * 60 * 60,
+                     size=size * 1024 * 1024)
+
+
+class FileCache(object):
+    """
+    I keep data downloaded from a web service in files under a directory,
+    one file per key, so it does not need to be downloaded again.
+
+    An entry is fresh for ttl seconds after it was stored. Once the files
+    take up more than size bytes, the least recently used ones are removed.
+    """
+
+    def __init__(self, path, ttl=None, size=None):
+        """
+        @param path: the directory to keep the files in
+        @type  path: unicode
+        @param ttl:  how long an entry is fresh, in seconds; None for ever
+        @type  ttl:  int or None
+        @param size: how many bytes the files may take up; None for no limit
+        @type  size: int or None
+        """
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+
+    def _path(self, key):
+        # keys are relative paths like the ones of the web service, so
+        # they can't be used to get out of the directory
+        parts = key.split('/')
+        for part in parts:
+            if part in ('', '.', '..') or os.sep in part:
+                raise ValueError('invalid cache key %r' % key)
+        return os.path.join(self.path, *parts)
+
+    def get(self, key, stale=False):
+        """
+        Get the data stored for key.
+
+        @param stale: whether to return an entry that is no longer fresh
+
+        @returns: the data, or None if there is no (fresh) entry
+        @rtype:   str or None
+        """
+        path = self._path(key)
+        try:
+            mtime = os.stat(path).st_mtime
+            if not stale and self.ttl is not None and \
+                    time.time() - mtime > self.ttl:
+                logger.debug('cache entry %s expired', key)
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # the access time orders entries for eviction, the modification
+            # time is when they were stored
+            os.utime(path, (time.time(), mtime))
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                logger.warning('could not read cache entry %s: %s', key, e)
+            return None
+
+        logger.debug('cache entry %s found', key)
+        return data
+
+    def put(self, key, data):
+        """
+        Store data for key, replacing what was stored before.
+        """
+        path = self._path(key)
+        try:
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            # so that no one reads a half written entry
+            fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmppath, path)
+        except (IOError, OSError) as e:
+            logger.warning('could not write cache entry %s: %s', key, e)
+            return
+
+        logger.debug('cache entry %s stored', key)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the files take up no
+        more than size bytes.
+        """
+        if self.size is None:
+            return
+
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_atime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.size:
+                break
+            logger.debug('evicting cache entry %s', path)
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
@@ -18,14 +18,15 @@
 # You should have received a copy of the GNU General Public License
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
+import accuraterip
+import audioop
 import binascii
-import wave
-import tempfile
-import subprocess
-import os
+import hashlib
 
 
+from whipper.common import common, pcm
 from whipper.extern.task import task as etask
+from whipper.program import flac
 
 import logging
 logger = logging.getLogger(__name__)
@@ -34,31 +35,431 @@ logger = logging.getLogger(__name__)
 
 
 class CRC32Task(etask.Task):
-    # TODO: Support sampleStart, sampleLength later on (should be trivial, just
-    # add change the read part in _crc32 to skip some samples and/or not
-    # read too far)
+    """
+    I calculate the CRC32 checksum of a .wav file, or of the audio data of
+    a FLAC file, as a whole and per block, or of a range of samples of it.
+
+    The audio is read in pieces into the same buffer, so memory use does not
+    grow with the length of the track.
+
+    @ivar checksum:       CRC32 checksum of the audio data
+    @ivar blockchecksums: the checksums of the blocks of L{BLOCK_FRAMES} CD
+                          frames completed so far; filled in while running,
+                          so it can be handed out beforehand
+    """
+
+    description = 'Calculating checksum'
+
+    checksum = None
+
     def __init__(self, path, sampleStart=0, sampleLength=-1, is_wave=True):
+        """
+        @param path:         the file to checksum
+        @param sampleStart:  the first sample to checksum
+        @param sampleLength: the number of samples to checksum; -1 for all
+                             samples up to the end
+        @param is_wave:      whether path is a .wav file rather than a FLAC
+                             file
+        """
         self.path = path
+        self.sampleStart = sampleStart
+        self.sampleLength = sampleLength
         self.is_wave = is_wave
+        self._crc = CRC32Digest()
+        self._blocks = BlockCRC32Digest()
+        self.blockchecksums = self._blocks.checksums
 
     def start(self, runner):
         etask.Task.start(self, runner)
+        try:
+            self._source = pcm.open(self.path, self.sampleStart,
+                                    self.sampleLength, is_wave=self.is_wave)
+        except Exception as e:
+            self.setException(e)
+            self.stop()
+            return
+
+        self._reader = _Reader(self._source, [self._crc, self._blocks])
         self.schedule(0.0, self._crc32)
 
     def _crc32(self):
-        if not self.is_wave:
-            fd, tmpf = tempfile.mkstemp()
+        try:
+            if self._reader.read():
+                if self._source.samples:
+                    self.setProgress(float(self._reader.samples) /
+                                     self._source.samples)
+                self.schedule(0.0, self._crc32)
+                return
+            self._source.close()
+        except Exception as e:
+            self._source.abort()
+            self.setException(e)
+            self.stop()
+            return
+
+        self.checksum = self._crc.checksum
+        self.stop()
+
+
+class _Reader(object):
+    """
+    I read audio from a source into a buffer I reuse, and feed each piece to
+    a number of digests.
+
+    @ivar samples: the number of samples read so far
+    """
+
+    def __init__(self, source, digests):
+        self._source = source
+        self._digests = digests
+        self._buffer = bytearray(DIGEST_FRAMES * common.BYTES_PER_FRAME)
+        self.samples = 0
+
+    def read(self):
+        """
+        Read and feed the next piece.
+
+        @returns: whether anything was read
+        """
+        size = self._source.readinto(self._buffer)
+        if not size:
+            return False
+        data = buffer(self._buffer, 0, size)
+        for digest in self._digests:
+            digest.update(data)
+        self.samples += size / 4
+        return True
+
+
+# number of CD frames read at once when digesting a track
+DIGEST_FRAMES = 256
+# number of CD frames covered by each block checksum
+BLOCK_FRAMES = 75
+
+
+class CRC32Digest(object):
+    """
+    I calculate the CRC32 checksum of data fed to me in pieces.
+    """
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = binascii.crc32(data, self._crc)
+
+    @property
+    def checksum(self):
+        return self._crc & 0xffffffff
+
+
+class BlockCRC32Digest(object):
+    """
+    I calculate the CRC32 checksums of consecutive blocks of
+    L{BLOCK_FRAMES} CD frames of data fed to me in pieces, so that two reads
+    of the same range can be compared while they are still going on.
+
+    @ivar checksums: the checksums of the blocks completed so far; a
+                     trailing partial block is not included
+    """
+
+    blockSize = BLOCK_FRAMES * common.BYTES_PER_FRAME
+
+    def __init__(self):
+        self.checksums = []
+        self._crc = 0
+        self._size = 0
+
+    def update(self, data):
+        offset = 0
+        while offset < len(data):
+            size = min(self.blockSize - self._size, len(data) - offset)
+            self._crc = binascii.crc32(buffer(data, offset, size), self._crc)
+            self._size += size
+            offset += size
+            if self._size == self.blockSize:
+                self.checksums.append(self._crc & 0xffffffff)
+                self._crc = 0
+                self._size = 0
+
+
+class AccurateRipDigest(object):
+    """
+    I calculate the AccurateRip v1 and v2 checksums of a track from its
+    PCM data, fed to me in pieces holding whole stereo samples.
+
+    @ivar v1: the AccurateRip v1 checksum of the data fed so far
+    @ivar v2: the AccurateRip v2 checksum of the data fed so far
+    """
+
+    v1 = 0
+    v2 = 0
+
+    def __init__(self, trackNumber, trackCount, sampleCount):
+        """
+        @param trackNumber: number of the track on the disc (1-based)
+        @param trackCount:  number of audio tracks on the disc
+        @param sampleCount: length of the track, in samples
+        """
+        # the first and last track skip their first and last 5 frames
+        skip = common.SAMPLES_PER_FRAME * 5
+        self._checkFrom = 0
+        self._checkTo = sampleCount
+        if trackNumber == 1:
+            self._checkFrom += skip
+        if trackNumber == trackCount:
+            self._checkTo -= skip
+        self._position = 1
+
+    def update(self, data):
+        self.v1, self.v2 = accuraterip.update(data, self._position,
+                                              self._checkFrom, self._checkTo,
+                                              self.v1, self.v2)
+        self._position += len(data) / 4
+
+
+class MD5Digest(object):
+    """
+    I calculate the MD5 sum of data fed to me in pieces.
+
+    For 16 bit stereo audio, this is the MD5 sum FLAC stores in its
+    STREAMINFO block, so it can be checked against an encoded file without
+    decoding it.
+    """
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+
+    def update(self, data):
+        self._md5.update(data)
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+
+class BufferDigest(object):
+    """
+    I keep the data fed to me in pieces in memory.
+
+    @ivar data: the data fed so far
+    @type data: bytearray
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def update(self, data):
+        self.data.extend(data)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        self.data = bytearray()
+
+
+class PeakDigest(object):
+    """
+    I track the peak level, as the maximum absolute 16 bit sample value, of
+    data fed to me in pieces.
+    """
+
+    peak = 0
+
+    def update(self, data):
+        self.peak = max(self.peak, audioop.max(data, 2))
+
+
+class TrackDigest(object):
+    """
+    I calculate everything whipper needs to know about a track from its PCM
+    data, fed to me in pieces: its CRC32 checksum, as a whole and per block,
+    its MD5 sum, its AccurateRip checksums and its peak level, while also
+    feeding it to the FLAC encoder.
+
+    The encoder is only started when the first data arrives.
+    """
+
+    def __init__(self, sampleCount, encodePath=None, trackNumber=None,
+                 trackCount=None):
+        """
+        @param sampleCount: length of the track, in samples
+        @param encodePath:  where to encode the track to FLAC, if given
+        @param trackNumber: number of the track, for AccurateRip
+        @param trackCount:  number of audio tracks on the disc
+        """
+        self.sampleCount = sampleCount
+        self.encodePath = encodePath
+        self._crc = CRC32Digest()
+        self._peak = PeakDigest()
+        self._blocks = BlockCRC32Digest()
+        self._md5 = MD5Digest()
+        self._digests = [self._crc, self._peak, self._blocks, self._md5]
+        self._ar = None
+        if trackNumber:
+            self._ar = AccurateRipDigest(trackNumber, trackCount,
+                                         sampleCount)
+            self._digests.append(self._ar)
+        self._encoder = None
+        self.samples = 0
+
+    def update(self, data):
+        for digest in self._digests:
+            digest.update(data)
+        if self.encodePath:
+            if not self._encoder:
+                self._encoder = flac.PipeEncoder(self.encodePath)
+            self._encoder.write(data)
+        self.samples += len(data) / 4
+
+    def close(self):
+        """
+        Finish encoding.
+
+        @raises common.MissingFrames: if less data was fed than expected
+        """
+        if self.samples != self.sampleCount:
+            self.abort()
+            raise common.MissingFrames('read %d of %d samples' % (
+                self.samples, self.sampleCount))
+        if self.encodePath:
+            if not self._encoder:
+                self._encoder = flac.PipeEncoder(self.encodePath)
+            self._encoder.close()
+
+    def abort(self):
+        """
+        Stop the encoder, if any, without finishing the output file.
+        """
+        if self._encoder:
+            self._encoder.abort()
+            self._encoder = None
+
+    @property
+    def checksum(self):
+        return self._crc.checksum
+
+    @property
+    def blockchecksums(self):
+        return self._blocks.checksums
+
+    @property
+    def md5(self):
+        return self._md5.md5
+
+    @property
+    def archecksums(self):
+        if self._ar:
+            return (self._ar.v1, self._ar.v2)
+        return None
+
+    @property
+    def peak(self):
+        return self._peak.peak
+
+
+def digestFile(path, encodePath=None, trackNumber=None, trackCount=None):
+    """
+    Read a .wav or FLAC file once and feed it to a L{TrackDigest}, without a
+    task runner, e.g. from a worker thread.
+
+    @param path:        the .wav or FLAC file to read
+    @param encodePath:  where to encode the track to FLAC, if given
+    @param trackNumber: number of the track, for AccurateRip
+    @param trackCount:  number of audio tracks on the disc
+
+    @rtype: L{TrackDigest}
+    """
+    source = pcm.open(path)
+    digest = TrackDigest(source.samples, encodePath=encodePath,
+                         trackNumber=trackNumber, trackCount=trackCount)
+    reader = _Reader(source, [digest])
+    try:
+        while reader.read():
+            pass
+        source.close()
+        digest.close()
+    except Exception:
+        source.abort()
+        digest.abort()
+        raise
+    return digest
+
+
+class TrackDigestTask(etask.Task):
+    """
+    I read a ripped .wav track, or a FLAC file, once and feed it to a
+    L{TrackDigest}, so that its CRC32 checksum, AccurateRip checksums and
+    peak level are calculated in a single pass, while also encoding it.
+
+    @ivar checksum:     CRC32 checksum of the audio data
+    @ivar md5:          MD5 sum of the audio data
+    @ivar archecksums:  tuple of AccurateRip v1 and v2 checksums, or None
+                        if no track number was given (e.g. for HTOA)
+    @ivar peak:         peak level of the track
+    """
+
+    description = 'Digesting track'
+
+    checksum = None
+    md5 = None
+    archecksums = None
+    peak = None
+
+    def __init__(self, path, encodePath=None, trackNumber=None,
+                 trackCount=None, what="track"):
+        """
+        @param path:        the .wav or FLAC file to read
+        @param encodePath:  where to encode the track to FLAC, if given
+        @param trackNumber: number of the track, for AccurateRip
+        @param trackCount:  number of audio tracks on the disc
+        """
+        self.path = path
+        self.encodePath = encodePath
+        self._trackNumber = trackNumber
+        self._trackCount = trackCount
+        if encodePath:
+            self.description = 'Encoding %s to FLAC' % what
+
+    def start(self, runner):
+        etask.Task.start(self, runner)
+        try:
+            self._source = pcm.open(self.path)
+        except Exception as e:
+            self.setException(e)
+            self.stop()
+            return
+
+        self._digest = TrackDigest(self._source.samples,
+                                   encodePath=self.encodePath,
+                                   trackNumber=self._trackNumber,
+                                   trackCount=self._trackCount)
+        self._reader = _Reader(self._source, [self._digest])
 
-            try:
-                subprocess.check_call(['flac', '-d', self.path, '-fo', tmpf])
+        self.schedule(0.0, self._read)
 
-                w = wave.open(tmpf)
-            finally:
-                os.remove(tmpf)
-        else:
-            w = wave.open(self.path)
+    def _read(self):
+        digest = self._digest
+        try:
+            if self._reader.read():
+                if digest.sampleCount:
+                    self.setProgress(float(digest.samples) /
+                                     digest.sampleCount)
+                self.schedule(0.0, self._read)
+                return
 
-        d = w._data_chunk.read()
+            self._source.close()
+            digest.close()
+        except Exception as e:
+            self._source.abort()
+            digest.abort()
+            self.setException(e)
+            self.stop()
+            return
 
-        self.checksum = binascii.crc32(d) & 0xffffffff
+        self.checksum = digest.checksum
+        self.md5 = digest.md5
+        self.peak = digest.peak
+        self.archecksums = digest.archecksums
         self.stop()
@@ -73,6 +73,9 @@ class Config:
     def getboolean(self, section, option):
         return self._getter('boolean', section, option)
 
+    def getint(self, section, option):
+        return self._getter('int', section, option)
+
     # musicbrainz section
 
     def get_musicbrainz_server(self):
@@ -82,6 +85,20 @@ class Config:
             raise KeyError('Invalid MusicBrainz server: %s' % server)
         return server
 
+    def get_musicbrainz_rate(self):
+        """
+        Get how many requests per second may be made to the MusicBrainz
+        server; self-hosted mirrors can allow more than musicbrainz.org.
+        """
+        try:
+            rate = float(self.get('musicbrainz', 'rate') or 1.0)
+        except ValueError:
+            rate = 0
+        if rate <= 0:
+            raise KeyError('Invalid MusicBrainz rate: %s' %
+                           self.get('musicbrainz', 'rate'))
+        return rate
+
     # drive sections
 
     def setReadOffset(self, vendor, model, release, offset):
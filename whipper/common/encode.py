@@ -19,33 +19,21 @@
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import errno
+import multiprocessing
+from subprocess import CalledProcessError, Popen
+
 from mutagen.flac import FLAC
 
+from whipper.common import common
 from whipper.extern.task import task
 
-from whipper.program import sox
 from whipper.program import flac
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-class SoxPeakTask(task.Task):
-    description = 'Calculating peak level'
-
-    def __init__(self, track_path):
-        self.track_path = track_path
-        self.peak = None
-
-    def start(self, runner):
-        task.Task.start(self, runner)
-        self.schedule(0.0, self._sox_peak)
-
-    def _sox_peak(self):
-        self.peak = sox.peak_level(self.track_path)
-        self.stop()
-
-
 class FlacEncodeTask(task.Task):
     description = 'Encoding to FLAC'
 
@@ -64,6 +52,68 @@ class FlacEncodeTask(task.Task):
         self.stop()
 
 
+class FlacEncodePoolTask(task.Task):
+    """
+    I encode several files to FLAC, running up to a given number of flac
+    processes at the same time.
+    """
+
+    description = 'Encoding to FLAC'
+
+    def __init__(self, paths, jobs=None):
+        """
+        @param paths: list of (track_path, track_out_path) tuples
+        @param jobs:  number of flac processes to run at once; defaults to
+                      the number of CPUs
+        """
+        self.paths = paths
+        self.jobs = jobs or multiprocessing.cpu_count()
+
+    def start(self, runner):
+        task.Task.start(self, runner)
+        self._waiting = list(self.paths)
+        self._running = []
+        self._encoded = 0
+        self.schedule(0.0, self._poll)
+
+    def _poll(self):
+        try:
+            for popen, command in self._running[:]:
+                returncode = popen.poll()
+                if returncode is None:
+                    continue
+                self._running.remove((popen, command))
+                if returncode != 0:
+                    logger.error('flac failed with return code %d',
+                                 returncode)
+                    raise CalledProcessError(returncode, command)
+                self._encoded += 1
+
+            while self._waiting and len(self._running) < self.jobs:
+                command = flac.encode_command(*self._waiting.pop(0))
+                logger.debug('executing %r', command)
+                try:
+                    self._running.append((Popen(command), command))
+                except OSError as e:
+                    if e.errno == errno.ENOENT:
+                        raise common.MissingDependencyException('flac')
+                    raise
+        except Exception as e:
+            for popen, _ in self._running:
+                popen.kill()
+                popen.wait()
+            self.setException(e)
+            self.stop()
+            return
+
+        if not self._running:
+            self.stop()
+            return
+
+        self.setProgress(float(self._encoded) / len(self.paths))
+        self.schedule(0.1, self._poll)
+
+
 class TaggingTask(task.Task):
     # TODO: Wizzup: Do we really want this as 'Task'...?
     # I only made it a task for now because that it's easier to integrate in
@@ -81,11 +131,33 @@ class TaggingTask(task.Task):
         self.schedule(0.0, self._tag)
 
     def _tag(self):
-        w = FLAC(self.track_path)
+        tag(self.track_path, self.tags)
+        self.stop()
 
-        for k, v in list(self.tags.items()):
-            w[k] = v
 
-        w.save()
+def tag(track_path, tags):
+    """
+    Write the given tags to a FLAC file.
 
-        self.stop()
+    @param tags: a dict of tags
+    """
+    w = FLAC(track_path)
+
+    for k, v in list(tags.items()):
+        w[k] = v
+
+    w.save()
+
+
+def streaminfo_md5(track_path):
+    """
+    Return the MD5 sum of the audio data the encoder stored in the
+    STREAMINFO block of a FLAC file, without decoding it.
+
+    @returns: the MD5 sum as a hex string, or None if none was stored
+    @rtype:   str or None
+    """
+    md5 = FLAC(track_path).info.md5_signature
+    if not md5:
+        return None
+    return '%032x' % md5
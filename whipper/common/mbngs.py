@@ -21,9 +21,14 @@
 """
 Handles communication with the MusicBrainz server using NGS.
 """
+import json
+import multiprocessing
+import threading
+import time
 import urllib2
 
 import whipper
+from whipper.common import cache, pipeline
 
 import logging
 logger = logging.getLogger(__name__)
@@ -31,6 +36,12 @@ logger = logging.getLogger(__name__)
 
 VA_ID = "89ad4ac3-39f7-470e-963a-56509c546377"  # Various Artists
 
+# defaults for the cache options of the [musicbrainz] config section
+CACHE_TTL = 7  # days looked up releases are used without asking again
+CACHE_SIZE = 64  # MiB the cached lookups may take up
+
+FETCHES = 8  # most releases fetched at the same time
+
 
 class MusicBrainzException(Exception):
 
@@ -85,6 +96,77 @@ class DiscMetadata(object):
         self.tracks = []
 
 
+class RateLimiter(object):
+    """
+    I hand out the right to make a request at a steady rate, to as many
+    threads as want one: a token bucket, holding at most burst tokens.
+
+    Unlike the rate limiting of musicbrainzngs, I only space out the starts
+    of requests; one can start while another is still waiting for its
+    response.
+
+    Once shared, I keep to the rate across processes forked after that too.
+    """
+
+    def __init__(self, rate=1.0, burst=1):
+        """
+        @param rate:  requests per second
+        @type  rate:  float
+        @param burst: requests that may start at once after a pause
+        @type  burst: int
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        # tokens left, and when they were counted
+        self._state = [float(burst), time.time()]
+        self._lock = threading.Lock()
+
+    def share(self):
+        """
+        Keep my state in shared memory, so that processes forked from now
+        on take turns with each other, and not only with their own threads.
+        """
+        with self._lock:
+            if isinstance(self._state, list):
+                self._state = multiprocessing.Array('d', self._state)
+                self._lock = self._state.get_lock()
+
+    def acquire(self):
+        """
+        Wait until a request may start.
+        """
+        with self._lock:
+            tokens, last = self._state[0], self._state[1]
+            now = time.time()
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            # a negative count reserves the next tokens for waiting threads
+            tokens -= 1
+            self._state[0], self._state[1] = tokens, now
+            wait = -tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+_limiter = RateLimiter()
+
+
+def set_rate_limit(rate):
+    """
+    Set how many requests per second may be made to the MusicBrainz server;
+    musicbrainz.org allows one.
+    """
+    global _limiter
+    _limiter = RateLimiter(rate)
+
+
+def share_rate_limit():
+    """
+    Keep to the MusicBrainz rate limit across the processes forked from
+    now on, for example to rip with several drives at once.
+    """
+    _limiter.share()
+
+
 def _record(record, which, name, what):
     # optionally record to disc as a JSON serialization
     if record:
@@ -252,34 +334,62 @@ def _getMetadata(releaseShort, release, discid, country=None):
     return discMD
 
 
-# see http://bugs.musicbrainz.org/browser/python-musicbrainz2/trunk/examples/
-#     ripper.py
-
+def open_cache(conf):
+    """
+    Return the cache for MusicBrainz lookups, as set up with cache_ttl (in
+    days) and cache_size (in MiB) in the [musicbrainz] section of the
+    config file.
 
-def musicbrainz(discid, country=None, record=False):
+    @type conf: L{whipper.common.config.Config}
+    @rtype:     L{cache.FileCache}
     """
-    Based on a MusicBrainz disc id, get a list of DiscMetadata objects
-    for the given disc id.
+    return cache.from_config(conf, 'musicbrainz', 'musicbrainz',
+                             CACHE_TTL, CACHE_SIZE)
 
-    Example disc id: Mj48G109whzEmAbPBoGvd4KyCS4-
 
-    @type  discid: str
+def _cached(c, key, refresh, offline):
+    # the parsed JSON stored for key, or None to look it up
+    if c is None or (refresh and not offline):
+        return None
+    data = c.get(key, stale=offline)
+    return data and json.loads(data)
 
-    @rtype: list of L{DiscMetadata}
+
+def _store(c, key, what):
+    if c is not None:
+        c.put(key, json.dumps(what))
+
+
+def _getReleases(discid, c, refresh, offline):
     """
-    logger.debug('looking up results for discid %r', discid)
-    import musicbrainzngs
+    Get the releases for the disc id, as a list of dicts with the id and
+    release-group type of each, or None for a CD stub.
 
-    musicbrainzngs.set_useragent("whipper", whipper.__version__,
-                                 "https://github.com/whipper-team/whipper")
-    ret = []
+    This is all that is cached for a disc id, so that a release found for
+    several disc ids is cached only once.
+
+    @returns: the result of get_releases_by_discid, or None if cached; and
+              the releases
+    """
+    key = 'discid/%s.json' % discid
+    releases = _cached(c, key, refresh, offline)
+    if releases is not None:
+        if not releases:
+            raise NotFoundException('%s not in MusicBrainz (cached)' % discid)
+        return None, releases
+    if offline:
+        raise NotFoundException('%s not in cache' % discid)
+
+    import musicbrainzngs
 
     try:
+        _limiter.acquire()
         result = musicbrainzngs.get_releases_by_discid(
             discid, includes=["artists", "recordings", "release-groups"])
     except musicbrainzngs.ResponseError as e:
         if isinstance(e.cause, urllib2.HTTPError):
             if e.cause.code == 404:
+                _store(c, key, [])
                 raise NotFoundException(e)
             else:
                 logger.debug('received bad response from the server')
@@ -287,38 +397,130 @@ def musicbrainz(discid, country=None, record=False):
         raise MusicBrainzException(e)
 
     # The result can either be a "disc" or a "cdstub"
-    if result.get('disc'):
-        logger.debug('found %d releases for discid %r',
-                     len(result['disc']['release-list']), discid)
-        _record(record, 'releases', discid, result)
+    if not result.get('disc'):
+        if result.get('cdstub'):
+            logger.debug('query returned cdstub: ignored')
+        return result, None
 
-        # Display the returned results to the user.
+    logger.debug('found %d releases for discid %r',
+                 len(result['disc']['release-list']), discid)
 
-        import json
-        for release in result['disc']['release-list']:
-            formatted = json.dumps(release, sort_keys=False, indent=4)
-            logger.debug('result %s: artist %r, title %r' % (
-                formatted, release['artist-credit-phrase'], release['title']))
-
-            # to get titles of recordings, we need to query the release with
-            # artist-credits
-
-            res = musicbrainzngs.get_release_by_id(
-                release['id'], includes=["artists", "artist-credits",
-                                         "recordings", "discids", "labels"])
-            _record(record, 'release', release['id'], res)
-            releaseDetail = res['release']
-            formatted = json.dumps(releaseDetail, sort_keys=False, indent=4)
-            logger.debug('release %s' % formatted)
-
-            md = _getMetadata(release, releaseDetail, discid, country)
-            if md:
-                logger.debug('duration %r', md.duration)
-                ret.append(md)
-
-        return ret
-    elif result.get('cdstub'):
-        logger.debug('query returned cdstub: ignored')
-        return None
-    else:
+    # Display the returned results to the user.
+
+    releases = []
+    for release in result['disc']['release-list']:
+        formatted = json.dumps(release, sort_keys=False, indent=4)
+        logger.debug('result %s: artist %r, title %r' % (
+            formatted, release['artist-credit-phrase'], release['title']))
+        releases.append({
+            'id': release['id'],
+            'release-group': {
+                'type': release.get('release-group', {}).get('type'),
+            },
+        })
+
+    _store(c, key, releases)
+    return result, releases
+
+
+def _getRelease(releaseId, c, refresh, offline):
+    """
+    Get the release with its recordings, as the value for key release
+    returned from get_release_by_id.
+
+    @returns: the result of get_release_by_id, or None if cached; and the
+              release
+    """
+    key = 'release/%s.json' % releaseId
+    release = _cached(c, key, refresh, offline)
+    if release is not None:
+        return None, release
+    if offline:
+        raise NotFoundException('release %s not in cache' % releaseId)
+
+    import musicbrainzngs
+
+    # to get titles of recordings, we need to query the release with
+    # artist-credits
+
+    _limiter.acquire()
+    res = musicbrainzngs.get_release_by_id(
+        releaseId, includes=["artists", "artist-credits",
+                             "recordings", "discids", "labels"])
+    _store(c, key, res['release'])
+    return res, res['release']
+
+
+class _ReleaseJob(object):
+    """
+    I get a release for L{pipeline.Worker}.
+    """
+
+    res = None
+    releaseDetail = None
+
+    def __init__(self, release, c, refresh, offline):
+        self.release = release
+        self._args = (c, refresh, offline)
+
+    def run(self):
+        self.res, self.releaseDetail = _getRelease(self.release['id'],
+                                                   *self._args)
+
+# see http://bugs.musicbrainz.org/browser/python-musicbrainz2/trunk/examples/
+#     ripper.py
+
+
+def musicbrainz(discid, country=None, record=False, cache=None,
+                refresh=False, offline=False):
+    """
+    Based on a MusicBrainz disc id, get a list of DiscMetadata objects
+    for the given disc id.
+
+    Example disc id: Mj48G109whzEmAbPBoGvd4KyCS4-
+
+    With a cache, fresh lookups in it are used instead of asking
+    MusicBrainz again, and lookups from MusicBrainz are stored in it.
+
+    @type  discid:  str
+    @type  cache:   L{whipper.common.cache.FileCache} or None
+    @param refresh: whether to ask MusicBrainz even for what is cached
+    @param offline: whether to use only what is cached, even if expired
+
+    @rtype: list of L{DiscMetadata}
+    """
+    logger.debug('looking up results for discid %r', discid)
+    import musicbrainzngs
+
+    musicbrainzngs.set_useragent("whipper", whipper.__version__,
+                                 "https://github.com/whipper-team/whipper")
+    # _limiter keeps to the rate instead, without making each request wait
+    # for the one before it to finish
+    musicbrainzngs.set_rate_limit(False)
+    ret = []
+
+    result, releases = _getReleases(discid, cache, refresh, offline)
+    if result:
+        _record(record, 'releases', discid, result)
+    if releases is None:
         return None
+
+    def got(job):
+        if job.res:
+            _record(record, 'release', job.release['id'], job.res)
+        formatted = json.dumps(job.releaseDetail, sort_keys=False, indent=4)
+        logger.debug('release %s' % formatted)
+
+        md = _getMetadata(job.release, job.releaseDetail, discid, country)
+        if md:
+            logger.debug('duration %r', md.duration)
+            ret.append(md)
+
+    # fetch the releases at the same time, but keep them in order
+    worker = pipeline.Worker(size=max(len(releases), 1),
+                             threads=max(min(len(releases), FETCHES), 1))
+    for release in releases:
+        worker.put(_ReleaseJob(release, cache, refresh, offline), got)
+    worker.join()
+
+    return ret
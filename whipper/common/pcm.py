@@ -0,0 +1,197 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_pcm -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is part of whipper.
+#
+# whipper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# whipper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with whipper.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import io
+import subprocess
+import wave
+
+from mutagen.flac import FLAC
+
+from whipper.common import common
+from whipper.program import flac
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def open(path, sampleStart=0, sampleLength=-1, is_wave=None):
+    """
+    Open the raw CD audio in a .wav or FLAC file for reading.
+
+    @param sampleStart:  the first sample to read
+    @param sampleLength: the number of samples to read; -1 for all samples
+                         up to the end
+    @param is_wave:      whether path is a .wav file rather than a FLAC
+                         file; guessed from its name if not given
+
+    @raises common.MissingFrames: if the file ends before the range does
+
+    @rtype: L{WaveSource} or L{FlacSource}
+    """
+    if is_wave is None:
+        is_wave = not path.endswith('.flac')
+    if is_wave:
+        return WaveSource(path, sampleStart, sampleLength)
+    return FlacSource(path, sampleStart, sampleLength)
+
+
+def length(path, is_wave=None):
+    """
+    Return the number of samples in a .wav or FLAC file, from its header.
+
+    @param is_wave: whether path is a .wav file rather than a FLAC file;
+                    guessed from its name if not given
+
+    @rtype: int
+    """
+    if is_wave is None:
+        is_wave = not path.endswith('.flac')
+    if not is_wave:
+        return FLAC(path).info.total_samples
+    w = wave.open(path)
+    try:
+        return w.getnframes()
+    finally:
+        w.close()
+
+
+def _length(path, samples, sampleStart, sampleLength):
+    left = max(0, samples - sampleStart)
+    if sampleLength < 0:
+        return left
+    if sampleLength > left:
+        raise common.MissingFrames('%d of %d samples in %r' % (
+            left, sampleLength, path))
+    return sampleLength
+
+
+class WaveSource(object):
+    """
+    I read the raw CD audio of a range of samples of a .wav file.
+
+    @ivar samples: the number of samples in the range
+    """
+
+    def __init__(self, path, sampleStart=0, sampleLength=-1):
+        self.path = path
+        # the header is read from our own file, which is then left at the
+        # start of the audio data
+        self._file = io.open(path, 'rb', buffering=0)
+        try:
+            w = wave.open(self._file)
+            self.samples = _length(path, w.getnframes(), sampleStart,
+                                   sampleLength)
+            self._file.seek(sampleStart * 4, io.SEEK_CUR)
+        except Exception:
+            self._file.close()
+            raise
+        self._left = self.samples * 4
+
+    def readinto(self, b):
+        """
+        Read audio into the writable buffer b, stopping at the end of the
+        range.
+
+        @returns: the number of bytes read; 0 at the end
+        @rtype:   int
+        """
+        size = min(len(b), self._left)
+        if not size:
+            return 0
+        size = self._file.readinto(memoryview(b)[:size])
+        self._left -= size
+        return size
+
+    def close(self):
+        """
+        Stop reading.
+
+        @raises common.MissingFrames: if the file ended before the range
+        """
+        self._file.close()
+        if self._left:
+            raise common.MissingFrames('%d of %d samples in %r' % (
+                self.samples - self._left / 4, self.samples, self.path))
+
+    def abort(self):
+        """
+        Stop reading without checking whether all audio was read.
+        """
+        self._file.close()
+
+
+class FlacSource(object):
+    """
+    I read the raw CD audio of a range of samples of a FLAC file, as it is
+    decoded by flac to a pipe, without writing it to a file.
+
+    @ivar samples: the number of samples in the range
+    """
+
+    def __init__(self, path, sampleStart=0, sampleLength=-1):
+        self.path = path
+        self.samples = _length(path, length(path, is_wave=False),
+                               sampleStart, sampleLength)
+        self._command = flac.decode_command(path, skip=sampleStart,
+                                            length=sampleLength)
+        logger.debug('executing %r', self._command)
+        try:
+            self._popen = subprocess.Popen(self._command,
+                                           stdout=subprocess.PIPE)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise common.MissingDependencyException('flac')
+            raise
+        self._read = 0
+
+    def readinto(self, b):
+        """
+        Read audio into the writable buffer b.
+
+        @returns: the number of bytes read; 0 at the end
+        @rtype:   int
+        """
+        size = self._popen.stdout.readinto(b)
+        self._read += size
+        return size
+
+    def close(self):
+        """
+        Stop reading, and wait for flac to exit.
+
+        @raises subprocess.CalledProcessError: if flac failed
+        @raises common.MissingFrames:          if less audio was decoded
+                                               than expected
+        """
+        self._popen.stdout.close()
+        returncode = self._popen.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self._command)
+        if self._read != self.samples * 4:
+            raise common.MissingFrames('%d of %d samples in %r' % (
+                self._read / 4, self.samples, self.path))
+
+    def abort(self):
+        """
+        Stop flac without waiting for it to decode the rest.
+        """
+        self._popen.stdout.close()
+        if self._popen.poll() is None:
+            self._popen.kill()
+        self._popen.wait()
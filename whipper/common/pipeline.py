@@ -0,0 +1,129 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_pipeline -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is part of whipper.
+#
+# whipper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# whipper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with whipper.  If not, see <http://www.gnu.org/licenses/>.
+
+import Queue
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Worker(object):
+    """
+    I run jobs in background threads, in the order they were put, so that
+    the caller can go on with other work.
+
+    A job is an object with a run() method. Once it has run, the callback
+    it was put with is called from the caller's thread, on the next call to
+    collect() or join(); callbacks are called in the order the jobs were
+    put, even if a later job finishes first. If the job failed, its
+    errback is called instead, or the exception is raised if it has none.
+
+    At most size jobs wait to be run; putting another one blocks until the
+    oldest one is started.
+    """
+
+    def __init__(self, size=1, threads=1):
+        """
+        @param size:    the number of jobs that can wait to be run
+        @param threads: the number of jobs run at the same time
+        """
+        self._jobs = Queue.Queue(maxsize=size)
+        self._done = Queue.Queue()
+        self._put = 0  # sequence number of the next job put
+        self._collected = 0  # sequence number of the next job collected
+        # sequence number -> (job, callback, errback, exception)
+        self._finished = {}
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._run,
+                                      name='whipper worker %d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                return
+            number, job, callback, errback = item
+            exception = None
+            try:
+                job.run()
+            except Exception as e:
+                logger.debug('job %r failed', job, exc_info=True)
+                exception = e
+            self._done.put((number, job, callback, errback, exception))
+
+    def put(self, job, callback=None, errback=None):
+        """
+        Queue a job to be run.
+
+        @param callback: called with the job once it has run successfully
+        @param errback:  called with the job and the exception if it failed
+        """
+        self._jobs.put((self._put, job, callback, errback))
+        self._put += 1
+
+    def collect(self, block=False):
+        """
+        Call the callbacks of the jobs that have run.
+
+        @param block: whether to wait for all jobs to have run first
+
+        @raises Exception: the first exception raised by a job without an
+                           errback, after calling the callbacks of all
+                           other jobs
+        """
+        failed = None
+        while self._collected < self._put:
+            if self._collected not in self._finished:
+                try:
+                    item = self._done.get(block)
+                except Queue.Empty:
+                    break
+                self._finished[item[0]] = item[1:]
+                continue
+
+            job, callback, errback, exception = self._finished.pop(
+                self._collected)
+            self._collected += 1
+            if exception:
+                if errback:
+                    errback(job, exception)
+                else:
+                    failed = failed or exception
+            elif callback:
+                callback(job)
+
+        if failed:
+            raise failed
+
+    def join(self):
+        """
+        Wait for all jobs to have run, call their callbacks, and stop the
+        threads.
+        """
+        try:
+            self.collect(block=True)
+        finally:
+            for thread in self._threads:
+                self._jobs.put(None)
+            for thread in self._threads:
+                thread.join()
@@ -26,22 +26,72 @@ import musicbrainzngs
 import re
 import os
 import sys
+import tempfile
+import threading
 import time
 
-from whipper.common import accurip, checksum, common, mbngs, path
+from whipper.common import accurip, cache, checksum, common, directory
+from whipper.common import encode, mbngs, path, pipeline
 from whipper.program import cdrdao, cdparanoia
 from whipper.image import image
+from whipper.image.toc import TocFile
 from whipper.extern import freedb
 from whipper.extern.task import task
-from whipper.result import result
+from whipper.result import journal, result
 
 import logging
 logger = logging.getLogger(__name__)
 
+TABLE_CACHE_SIZE = 4 * 1024 * 1024  # bytes the tables read before take up
+
 
 # FIXME: should Program have a runner ?
 
 
+class _Lookup(object):
+    """
+    I look up a disc in an online database for L{pipeline.Worker}, and keep
+    the result, or the exception raised, until it is needed.
+
+    @ivar name:     which lookup I am
+    @ivar key:      what identifies the disc being looked up
+    @ivar fallback: the lookup to run after me only if I found nothing
+    @ivar skipped:  whether I was not run, as the lookup I am the fallback
+                    of found something
+    @ivar done:     set once I have run or was skipped
+    @type done:     L{threading.Event}
+    """
+
+    result = None
+    exception = None
+    fallback = None
+    skipped = False
+
+    def __init__(self, name, key, function, *args, **kwargs):
+        self.name = name
+        self.key = key
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self._function(*self._args, **self._kwargs)
+        except Exception as e:
+            logger.debug('%s lookup failed', self.name, exc_info=True)
+            self.exception = e
+        finally:
+            self.done.set()
+
+        if self.fallback:
+            if self.result:
+                self.fallback.skipped = True
+                self.fallback.done.set()
+            else:
+                self.fallback.run()
+
+
 class Program:
     """
     I maintain program state and functionality.
@@ -61,12 +111,18 @@ class Program:
     result = None
 
     _stdout = None
+    _prefetcher = None
+    _tocfile = None
+    _journal = None
 
-    def __init__(self, config, record=False, stdout=sys.stdout):
+    def __init__(self, config, record=False, stdout=sys.stdout,
+                 offline=False):
         """
         @param record: whether to record results of API calls for playback.
+        @param offline: whether to only use cached results of API calls.
         """
         self._record = record
+        self._offline = offline
         self._stdout = stdout
         self._config = config
 
@@ -84,6 +140,7 @@ class Program:
             d[key] = value
 
         self._filter = path.PathFilter(**d)
+        self._prefetched = {}
 
     def setWorkingDirectory(self, workingDirectory):
         if workingDirectory:
@@ -110,42 +167,212 @@ class Program:
         return toc
 
     def getTable(self, runner, cddbdiscid, mbdiscid, device, offset,
-                 toc_path):
+                 toc_path=None, ittoc=None):
         """
         Retrieve the Table from the drive.
 
+        Given the fast TOC, a table read before for the same disc is used
+        instead, if it agrees with the fast TOC. cdrdao's TOC does not
+        depend on the read offset, so neither does the cached table; the
+        offset is not used.
+
+        @param toc_path: where to save cdrdao's TOC file; if None, it is
+                         kept until saveToc() is called
+        @param ittoc:    the fast TOC of the disc
+        @type  ittoc:    L{table.Table}
+
         @rtype: L{table.Table}
         """
-        itable = None
-        tdict = {}
-        
+        # only cdrdao's TOC file is kept, and parsed again like a fresh one
+        key = '%s.toc' % mbdiscid
+        tables = cache.FileCache(directory.cache_path('table'),
+                                 size=TABLE_CACHE_SIZE)
+
+        tocdata = ittoc and tables.get(key)
+        if tocdata:
+            fd, tocfile = tempfile.mkstemp(suffix=u'.cdrdao.read-toc.whipper')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(tocdata)
+            try:
+                tocFile = TocFile(tocfile)
+                tocFile.parse()
+                itable = tocFile.table
+            except Exception as e:
+                logger.warning('could not parse cached table: %r', e)
+                itable = None
+            if itable and self._tableMatches(itable, ittoc):
+                logger.info('using table read before for disc %s', mbdiscid)
+                self._keepToc(tocfile, toc_path)
+                self.result.table = itable
+                return itable
+            os.unlink(tocfile)
+
         t = cdrdao.ReadTOC_Task(device)
         t.description = "Reading table"
-        t.toc_path = toc_path
+        t.keep_toc = True
         runner.run(t)
         itable = t.toc.table
-        tdict[offset] = itable
         logger.debug('getTable: read table %r' % itable)
 
         assert itable.hasTOC()
 
+        with open(t.tocfile, 'rb') as f:
+            tables.put(key, f.read())
+        self._keepToc(t.tocfile, toc_path)
+
         self.result.table = itable
 
         logger.debug('getTable: returning table with mb id %s' %
                      itable.getMusicBrainzDiscId())
         return itable
 
-    def getRipResult(self, cddbdiscid):
+    def _tableMatches(self, itable, ittoc):
+        # whether a table read before is one of the disc with the fast TOC
+        if itable.instanceVersion != itable.classVersion:
+            return False
+        if (itable.getMusicBrainzDiscId() != ittoc.getMusicBrainzDiscId() or
+                itable.getCDDBDiscId() != ittoc.getCDDBDiscId() or
+                itable.accuraterip_path() != ittoc.accuraterip_path() or
+                itable.leadout != ittoc.leadout or
+                len(itable.tracks) != len(ittoc.tracks)):
+            logger.warning('table read before does not match the disc')
+            return False
+        for number in range(1, len(ittoc.tracks) + 1):
+            if itable.getTrackStart(number) != ittoc.getTrackStart(number):
+                logger.warning('table read before does not match the disc')
+                return False
+        return True
+
+    def _keepToc(self, tocfile, toc_path):
+        # saved to toc_path already, or else kept for saveToc()
+        if toc_path is None:
+            self._tocfile = tocfile
+        else:
+            cdrdao.copy_toc(tocfile, toc_path)
+            os.unlink(tocfile)
+
+    def saveToc(self, toc_path):
         """
-        Return a RipResult object.
+        Save the TOC file kept by getTable(), or only remove it if toc_path
+        is None.
+        """
+        if self._tocfile is None:
+            return
+        if toc_path is not None:
+            cdrdao.copy_toc(self._tocfile, toc_path)
+        os.unlink(self._tocfile)
+        self._tocfile = None
+
+    def prefetch(self, ittoc, country=None, refresh=False,
+                 accuraterip=False):
+        """
+        Start looking up the disc on MusicBrainz and, optionally,
+        AccurateRip in the background, so that this overlaps with reading
+        the full table. FreeDB is only looked up if MusicBrainz found
+        nothing. getMusicBrainz(), getCDDB() and verifyImage() use the
+        results, each waiting only for its own lookup.
+
+        @type  ittoc: L{whipper.image.table.Table}
+        """
+        mbdiscid = ittoc.getMusicBrainzDiscId()
+        musicbrainz = _Lookup('musicbrainz', mbdiscid, mbngs.musicbrainz,
+                              mbdiscid, country=country, record=self._record,
+                              cache=mbngs.open_cache(self._config),
+                              refresh=refresh, offline=self._offline)
+        lookups = [musicbrainz]
+        if not self._offline:
+            cddbdiscid = ittoc.getCDDBValues()
+            # run in the same job, once MusicBrainz found nothing
+            musicbrainz.fallback = _Lookup('freedb', cddbdiscid,
+                                           freedb.perform_lookup, cddbdiscid,
+                                           'freedb.freedb.org', 80)
+            self._prefetched['freedb'] = musicbrainz.fallback
+        if accuraterip:
+            arpath = ittoc.accuraterip_path()
+            lookups.append(_Lookup('accurip', arpath, accurip.get_db_entry,
+                                   arpath, accurip.open_cache(self._config),
+                                   offline=self._offline))
+
+        self._prefetcher = pipeline.Worker(size=len(lookups),
+                                           threads=len(lookups))
+        for lookup in lookups:
+            self._prefetched[lookup.name] = lookup
+            self._prefetcher.put(lookup)
+
+    def _lookup(self, name, key, function, *args, **kwargs):
+        """
+        Return what function returns when called with args, or the result
+        of the same lookup started by prefetch().
+        """
+        lookup = self._prefetched.pop(name, None)
+        if lookup:
+            lookup.done.wait()
+        if self._prefetcher and all(other.done.is_set()
+                                    for other in self._prefetched.values()):
+            self._prefetcher.join()
+            self._prefetcher = None
+
+        if lookup is None or lookup.skipped or lookup.key != key:
+            return function(*args, **kwargs)
+        if lookup.exception:
+            raise lookup.exception
+        return lookup.result
+
+    def getRipResult(self, cddbdiscid, offset=None, overread=None,
+                     resume=True):
+        """
+        Return a RipResult object, holding the results of the tracks ripped
+        before for the same disc, with the same read offset and overread
+        setting, by a rip that did not finish.
+
+        @type offset:   int
+        @type overread: bool
+        @param resume:  whether to use the rip journal at all; if not, the
+                        result starts out empty
 
         @rtype: L{result.RipResult}
         """
         assert self.result is None
         self.result = result.RipResult()
+        if not resume:
+            return self.result
+
+        self._journal = journal.Journal(os.path.join(
+            directory.cache_path('journal'), u'%s.jsonl' % cddbdiscid),
+            offset=offset, overread=overread)
+        self.result.tracks = self._journal.load()
+        if self.result.tracks:
+            logger.info('found results of %d tracks ripped before',
+                        len(self.result.tracks))
 
         return self.result
 
+    def saveRipResult(self):
+        """
+        Write the results of the tracks ripped so far to the rip journal,
+        for getRipResult() to pick up if the rip does not finish.
+        """
+        if self._journal:
+            self._journal.append(self.result.tracks)
+
+    def removeRipResult(self):
+        """
+        Remove the rip journal, once the rip has finished.
+        """
+        if self._journal:
+            self._journal.remove()
+            self._journal = None
+
+    def trackUnchanged(self, trackResult):
+        """
+        Return whether the track was ripped before to the same file, and
+        the file has not changed since, so it needs no verifying.
+
+        @type trackResult: L{result.TrackResult}
+        """
+        return bool(self._journal and
+                    self._journal.isUnchanged(trackResult))
+
     def addDisambiguation(self, template_part, metadata):
         "Add disambiguation to template path part string."
         if metadata.catalogNumber:
@@ -230,9 +457,12 @@ class Program:
 
         @rtype: str
         """
-        # FIXME: convert to nonblocking?
+        if self._offline:
+            return None
+
         try:
-            md = freedb.perform_lookup(cddbdiscid, 'freedb.freedb.org', 80)
+            md = self._lookup('freedb', cddbdiscid, freedb.perform_lookup,
+                              cddbdiscid, 'freedb.freedb.org', 80)
             logger.debug('CDDB query result: %r', md)
             return [item['DTITLE'] for item in md if 'DTITLE' in item] or None
 
@@ -249,9 +479,11 @@ class Program:
         return None
 
     def getMusicBrainz(self, ittoc, mbdiscid, release=None, country=None,
-                       prompt=False):
+                       prompt=False, refresh=False):
         """
         @type  ittoc: L{whipper.image.table.Table}
+        @param refresh: whether to look up the disc again even if it was
+                        looked up recently
         """
         # look up disc on MusicBrainz
         self._stdout.write('Disc duration: %s, %d audio tracks\n' % (
@@ -266,9 +498,14 @@ class Program:
 
         for _ in range(0, 4):
             try:
-                metadatas = mbngs.musicbrainz(mbdiscid,
-                                              country=country,
-                                              record=self._record)
+                metadatas = self._lookup('musicbrainz', mbdiscid,
+                                         mbngs.musicbrainz, mbdiscid,
+                                         country=country,
+                                         record=self._record,
+                                         cache=mbngs.open_cache(
+                                             self._config),
+                                         refresh=refresh,
+                                         offline=self._offline)
                 break
             except mbngs.NotFoundException as e:
                 logger.warning("release not found: %r" % (e, ))
@@ -461,7 +698,29 @@ class Program:
         return (start, stop)
 
     def verifyTrack(self, runner, trackResult):
+        """
+        Verify a track ripped before against the checksums stored in
+        trackResult.
+
+        A FLAC file is verified against the MD5 sum of its audio data the
+        encoder stored in it, if the rip recorded one; it is only decoded to
+        check its CRC32 checksum if they differ.
+
+        @type trackResult: L{result.TrackResult}
+        """
         is_wave = not trackResult.filename.endswith('.flac')
+        if not is_wave and trackResult.md5:
+            try:
+                md5 = encode.streaminfo_md5(trackResult.filename)
+            except Exception as e:
+                logger.debug('could not read MD5 sum of %r: %r',
+                             trackResult.filename, e)
+                md5 = None
+            logger.debug('verifyTrack: track result md5 %r, file md5 %r',
+                         trackResult.md5, md5)
+            if md5 == trackResult.md5:
+                return True
+
         t = checksum.CRC32Task(trackResult.filename, is_wave=is_wave)
 
         try:
@@ -480,13 +739,29 @@ class Program:
         return ret
 
     def ripTrack(self, runner, trackResult, offset, device, taglist,
-                 overread, what=None):
+                 overread, what=None, stream=False, worker=None,
+                 callback=None, errback=None):
         """
         Ripping the track may change the track's filename as stored in
         trackResult.
 
+        Given a worker, I return as soon as the track has been read and
+        verified, and leave encoding it to the worker; the peak level and
+        AccurateRip checksums are stored in trackResult once that is done,
+        right before calling the callback.
+
         @param trackResult: the object to store information in.
         @type  trackResult: L{result.TrackResult}
+        @param stream:      whether to stream the audio instead of using
+                            temporary .wav files
+        @type  stream:      bool
+        @param worker:      the worker to encode the track in
+        @type  worker:      L{whipper.common.pipeline.Worker}
+        @param callback:    called without arguments once the track is
+                            encoded, when using a worker
+        @param errback:     called with the exception if encoding the
+                            track failed, when using a worker; its partial
+                            output has been removed
         """
         if trackResult.number == 0:
             start, stop = self.getHTOA()
@@ -507,7 +782,10 @@ class Program:
                                            offset=offset,
                                            device=device,
                                            taglist=taglist,
-                                           what=what)
+                                           what=what,
+                                           number=trackResult.number,
+                                           stream=stream,
+                                           encode=worker is None)
 
         runner.run(t)
 
@@ -518,7 +796,6 @@ class Program:
             t.copyspeed, t.copyduration))
         trackResult.testcrc = t.testchecksum
         trackResult.copycrc = t.copychecksum
-        trackResult.peak = t.peak
         trackResult.quality = t.quality
         trackResult.testspeed = t.testspeed
         trackResult.copyspeed = t.copyspeed
@@ -530,7 +807,31 @@ class Program:
             trackResult.filename = t.path
             logger.info('Filename changed to %r', trackResult.filename)
 
-    def verifyImage(self, runner, table):
+        if worker is None:
+            self._setEncoded(trackResult, t)
+            return
+
+        def encoded(job):
+            self._setEncoded(trackResult, job)
+            if callback:
+                callback()
+
+        def failed(job, exception):
+            logger.debug('encoding %s failed: %r', what, exception)
+            if errback:
+                errback(exception)
+            else:
+                raise exception
+        worker.put(t.job, encoded, failed)
+
+    def _setEncoded(self, trackResult, t):
+        trackResult.peak = t.peak
+        trackResult.md5 = t.md5
+        if t.archecksums:
+            trackResult.AR['v1']['CRC'] = "%08x" % t.archecksums[0]
+            trackResult.AR['v2']['CRC'] = "%08x" % t.archecksums[1]
+
+    def verifyImage(self, runner, table, cueImage=None):
         """
         verify table against accuraterip and cue_path track lengths
         Verify our image against the given AccurateRip responses.
@@ -539,22 +840,41 @@ class Program:
         Will set accurip and friends on each TrackResult.
 
         Populates self.result.tracks with above TrackResults.
+
+        @param cueImage: the image of self.cuePath, if it was set up
+                         already, so its track lengths need not be read
+                         again
+        @type  cueImage: L{image.Image}
         """
-        cueImage = image.Image(self.cuePath)
-        # assigns track lengths
-        verifytask = image.ImageVerifyTask(cueImage)
-        runner.run(verifytask)
-        if verifytask.exception:
-            logger.error(verifytask.exceptionMessage)
-            return False
+        if cueImage is None or cueImage.table is None:
+            cueImage = image.Image(self.cuePath)
+            # assigns track lengths
+            verifytask = image.ImageVerifyTask(cueImage)
+            runner.run(verifytask)
+            if verifytask.exception:
+                logger.error(verifytask.exceptionMessage)
+                return False
 
-        responses = accurip.get_db_entry(table.accuraterip_path())
+        arpath = table.accuraterip_path()
+        responses = self._lookup('accurip', arpath, accurip.get_db_entry,
+                                 arpath, accurip.open_cache(self._config),
+                                 offline=self._offline)
         logger.info('%d AccurateRip response(s) found' % len(responses))
 
-        checksums = accurip.calculate_checksums([
-            os.path.join(os.path.dirname(self.cuePath), t.indexes[1].path)
-            for t in [t for t in cueImage.cue.table.tracks if t.number != 0]
-        ])
+        tracks = [t for t in cueImage.cue.table.tracks if t.number != 0]
+        trackResults = [self.result.getTrackResult(t.number) for t in tracks]
+        if all(r and r.AR['v1']['CRC'] and r.AR['v2']['CRC']
+               for r in trackResults):
+            # calculated while ripping, no need to read the tracks again
+            checksums = {
+                'v1': [r.AR['v1']['CRC'] for r in trackResults],
+                'v2': [r.AR['v2']['CRC'] for r in trackResults],
+            }
+        else:
+            checksums = accurip.calculate_checksums([
+                os.path.join(os.path.dirname(self.cuePath), t.indexes[1].path)
+                for t in tracks
+            ])
         if not (checksums and any(checksums['v1']) and any(checksums['v2'])):
             return False
         return accurip.verify_result(self.result, responses, checksums)
@@ -27,13 +27,19 @@ class LoggableMultiSeparateTask(task.MultiSeparateTask):
 class PopenTask(task.Task):
     """
     I am a task that runs a command using Popen.
+
+    I read the command's output as the runner reports it available,
+    instead of polling for it.
     """
 
     logCategory = 'PopenTask'
     bufsize = 1024
+    readsize = 65536  # most bytes read from a pipe at once
     command = None
     cwd = None
 
+    _readers = ()
+
     def start(self, runner):
         task.Task.start(self, runner)
 
@@ -54,39 +60,32 @@ class PopenTask(task.Task):
         logger.debug('Started %r with pid %d', self.command,
                      self._popen.pid)
 
-        self.schedule(1.0, self._read, runner)
+        self._readers = {}
+        for which in ('stdout', 'stderr'):
+            fd = getattr(self._popen, which).fileno()
+            self._readers[which] = fd
+            self.addReader(fd, self._read, which)
 
-    def _read(self, runner):
+    def _read(self, which):
         try:
-            read = False
-
-            ret = self._popen.recv()
+            ret = self._popen.recv_ready(which, self.readsize)
 
             if ret:
-                logger.debug("read from stdout: %s", ret)
-                self.readbytesout(ret)
-                read = True
-
-            ret = self._popen.recv_err()
-
-            if ret:
-                logger.debug("read from stderr: %s", ret)
-                self.readbyteserr(ret)
-                read = True
-
-            # if we read anything, we might have more to read, so
-            # reschedule immediately
-            if read and self.runner:
-                self.schedule(0.0, self._read, runner)
+                # stdout may be audio, so only its size is logged
+                if which == 'stdout':
+                    logger.debug("read %d bytes from stdout", len(ret))
+                    self.readbytesout(ret)
+                else:
+                    logger.debug("read from stderr: %s", ret)
+                    self.readbyteserr(ret)
                 return
 
-            # if we didn't read anything, give the command more time to
-            # produce output
-            if self._popen.poll() is None and self.runner:
-                # not finished yet
-                self.schedule(1.0, self._read, runner)
+            # the command closed the pipe
+            self.removeReader(self._readers.pop(which))
+            if self._readers or not self.runner:
                 return
 
+            self._popen.wait()
             self._done()
         except Exception as e:
             logger.debug('exception during _read(): %r', str(e))
@@ -112,6 +111,13 @@ class PopenTask(task.Task):
         self.stop()
         return
 
+    def stop(self):
+        # whatever is left to read, nobody is listening anymore
+        for fd in self._readers.values():
+            self.removeReader(fd)
+        self._readers = {}
+        task.Task.stop(self)
+
     def abort(self):
         logger.debug('Aborting, sending SIGTERM to %d', self._popen.pid)
         os.kill(self._popen.pid, signal.SIGTERM)
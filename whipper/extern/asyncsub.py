@@ -31,6 +31,24 @@ class Popen(subprocess.Popen):
     def send_recv(self, input='', maxsize=None):
         return self.send(input), self.recv(maxsize), self.recv_err(maxsize)
 
+    def recv_ready(self, which, maxsize=None):
+        """
+        Read from 'stdout' or 'stderr' once an event loop has reported it
+        readable, without polling it again: returns up to maxsize bytes,
+        as much as the pipe holds, or None once the other end closed it.
+        """
+        conn, maxsize = self.get_conn_maxsize(which, maxsize)
+        if conn is None:
+            return None
+
+        r = os.read(conn.fileno(), maxsize)
+        if not r:
+            return self._close(which)
+
+        if self.universal_newlines:
+            r = self._translate_newlines(r)
+        return r
+
     def get_conn_maxsize(self, which, maxsize):
         if maxsize is None:
             maxsize = 1024
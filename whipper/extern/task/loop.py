@@ -0,0 +1,118 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_extern_task -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is part of whipper.
+#
+# whipper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# whipper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with whipper.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import heapq
+import itertools
+import select
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+_READ_EVENTS = select.POLLIN | select.POLLPRI | select.POLLHUP | \
+    select.POLLERR
+
+
+class EventLoop(object):
+    """
+    I am a minimal event loop.
+
+    I call functions after a delay, or when a file descriptor has data to
+    read, and sleep in poll() in between, so nothing wakes up unless there
+    is something to do.
+    """
+
+    def __init__(self):
+        self._timers = []  # heap of (when, sequence, callable, args)
+        self._sequence = itertools.count()
+        self._readers = {}  # fd -> (callable, args)
+        self._poll = select.poll()
+        self._running = False
+
+    def call_later(self, delay, callable, *args):
+        """
+        Call callable with args after delay seconds.
+        """
+        heapq.heappush(self._timers, (time.time() + delay,
+                                      next(self._sequence), callable, args))
+
+    def add_reader(self, fd, callable, *args):
+        """
+        Call callable with args whenever fd has data to read, or is closed
+        on the other end.
+        """
+        if fd in self._readers:
+            self._poll.modify(fd, _READ_EVENTS)
+        else:
+            self._poll.register(fd, _READ_EVENTS)
+        self._readers[fd] = (callable, args)
+
+    def remove_reader(self, fd):
+        """
+        Stop watching fd.
+
+        @returns: whether fd was being watched
+        """
+        if fd not in self._readers:
+            return False
+        del self._readers[fd]
+        self._poll.unregister(fd)
+        return True
+
+    def run(self):
+        """
+        Run until stop() is called, or there is nothing left to wait for.
+        """
+        self._running = True
+        while self._running:
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.time()) * 1000
+            elif self._readers:
+                timeout = None
+            else:
+                logger.debug('nothing left to wait for')
+                break
+
+            try:
+                events = self._poll.poll(timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+
+            for fd, event in events:
+                if not self._running:
+                    break
+                # an earlier callback may have removed it
+                if fd in self._readers:
+                    callable, args = self._readers[fd]
+                    callable(*args)
+
+            now = time.time()
+            while self._running and self._timers and \
+                    self._timers[0][0] <= now:
+                _, _, callable, args = heapq.heappop(self._timers)
+                callable(*args)
+        self._running = False
+
+    def stop(self):
+        """
+        Make run() return after the current callback.
+        """
+        self._running = False
@@ -21,10 +21,7 @@
 import logging
 import sys
 
-try:
-    from gi.repository import GLib as gobject
-except ImportError:
-    import gobject
+from whipper.extern.task import loop
 
 logger = logging.getLogger(__name__)
 
@@ -219,6 +216,22 @@ class Task(LogStub):
             return
         self.runner.schedule(self, delta, callable, *args, **kwargs)
 
+    def addReader(self, fd, callable, *args, **kwargs):
+        """
+        Call callable whenever fd has data to read, or is closed on the
+        other end, until removeReader is called.
+        """
+        if not self.runner:
+            print("ERROR: adding a reader to a task that's already stopped")
+            import traceback
+            traceback.print_stack()
+            return
+        self.runner.addReader(self, fd, callable, *args, **kwargs)
+
+    def removeReader(self, fd):
+        if self.runner:
+            self.runner.removeReader(fd)
+
     def addListener(self, listener):
         """
         Add a listener for task status changes.
@@ -412,6 +425,52 @@ class MultiSeparateTask(BaseMultiTask):
             description, self._task, len(self.tasks)))
 
 
+class MultiParallelTask(BaseMultiTask):
+    """
+    I perform multiple tasks at the same time.
+    I track progress as the combined progress of all tasks, and stop once
+    all of them have stopped, with the exception of the first one that
+    failed, if any.
+    """
+
+    description = 'Doing various tasks at the same time'
+
+    def start(self, runner):
+        Task.start(self, runner)
+
+        self._progress = {}
+        self._running = len(self.tasks)
+        if not self.tasks:
+            self.warning('no tasks')
+            self.stop()
+            return
+
+        for task in list(self.tasks):
+            task.addListener(self)
+            try:
+                task.start(runner)
+            except Exception as e:
+                task.setException(e)
+                self.stopped(task)
+
+    # ITaskListener methods
+    def progressed(self, task, value):
+        self._progress[task] = value
+        self.setProgress(sum(self._progress.values()) / len(self.tasks))
+
+    def described(self, task, description):
+        pass
+
+    def stopped(self, task):
+        self._running -= 1
+        if task.exception and not self.exception:
+            self.exception = task.exception
+            self.exceptionMessage = task.exceptionMessage
+            self.exceptionTraceback = task.exceptionTraceback
+        if not self._running:
+            self.stop()
+
+
 class MultiCombinedTask(BaseMultiTask):
     """
     I perform multiple tasks.
@@ -458,10 +517,27 @@ class TaskRunner(LogStub):
         """
         raise NotImplementedError
 
+    def addReader(self, task, fd, callable, *args, **kwargs):
+        """
+        Call callable whenever fd has data to read, or is closed on the
+        other end, until removeReader is called.
+
+        Subclasses should implement this.
+        """
+        raise NotImplementedError
+
+    def removeReader(self, fd):
+        """
+        Stop calling the reader added for fd.
+
+        Subclasses should implement this.
+        """
+        raise NotImplementedError
+
 
 class SyncRunner(TaskRunner, ITaskListener):
     """
-    I run the task synchronously in a gobject MainLoop.
+    I run the task synchronously in an L{loop.EventLoop}.
     """
 
     def __init__(self, verbose=True):
@@ -476,11 +552,12 @@ class SyncRunner(TaskRunner, ITaskListener):
             self._verboseRun = verbose
         self._skip = skip
 
-        self._loop = gobject.MainLoop()
+        self._loop = loop.EventLoop()
+        self._stopped = False
         self._task.addListener(self)
         # only start the task after going into the mainloop,
         # otherwise the task might complete before we are in it
-        gobject.timeout_add(0L, self._startWrap, self._task)
+        self._loop.call_later(0, self._startWrap, self._task)
         self.debug('run loop')
         self._loop.run()
 
@@ -494,6 +571,12 @@ class SyncRunner(TaskRunner, ITaskListener):
             if task.exceptionTraceback:
                 msg += "\n" + task.exceptionTraceback
             raise TaskException(task.exception, message=msg)
+        if not self._stopped:
+            # nothing was left for the task to wait for, yet it never
+            # stopped: it would never have finished
+            msg = 'task %r did not stop' % task
+            self.debug(msg)
+            raise TaskException(RuntimeError(msg), message=msg)
 
     def _startWrap(self, task):
         # wrap task start such that we can report any exceptions and
@@ -508,23 +591,33 @@ class SyncRunner(TaskRunner, ITaskListener):
             self.debug('exception during start: %r', task.exceptionMessage)
             self.stopped(task)
 
-    def schedule(self, task, delta, callable, *args, **kwargs):
+    def _wrap(self, task, callable, args, kwargs):
+        # stop the loop with the task's exception if callable fails
         def c():
             try:
-                self.log('schedule: calling %r(*args=%r, **kwargs=%r)',
+                self.log('calling %r(*args=%r, **kwargs=%r)',
                          callable, args, kwargs)
                 callable(*args, **kwargs)
-                return False
             except Exception as e:
-                self.debug('exception when calling scheduled callable %r',
-                           callable)
+                self.debug('exception when calling %r', callable)
                 task.setException(e)
                 self.stopped(task)
-                raise
+        return c
+
+    def schedule(self, task, delta, callable, *args, **kwargs):
         self.log('schedule: scheduling %r(*args=%r, **kwargs=%r)',
                  callable, args, kwargs)
 
-        gobject.timeout_add(int(delta * 1000L), c)
+        self._loop.call_later(delta, self._wrap(task, callable, args, kwargs))
+
+    def addReader(self, task, fd, callable, *args, **kwargs):
+        self.log('addReader: reading %r with %r(*args=%r, **kwargs=%r)',
+                 fd, callable, args, kwargs)
+
+        self._loop.add_reader(fd, self._wrap(task, callable, args, kwargs))
+
+    def removeReader(self, fd):
+        self._loop.remove_reader(fd)
 
     # ITaskListener methods
     def progressed(self, task, value):
@@ -558,8 +651,9 @@ class SyncRunner(TaskRunner, ITaskListener):
 
     def stopped(self, task):
         self.debug('stopped task %r', task)
+        self._stopped = True
         self.progressed(task, 1.0)
-        self._loop.quit()
+        self._loop.stop()
 
     def _report(self):
         self._output('%s %3d %%' % (
@@ -174,18 +174,22 @@ class ImageVerifyTask(task.MultiSeparateTask):
 
 class ImageEncodeTask(task.MultiSeparateTask):
     """
-    I encode a disk image to a different format.
+    I encode a disk image to a different format, encoding several tracks
+    at the same time.
     """
 
     description = "Encoding tracks"
 
-    def __init__(self, image, outdir):
+    def __init__(self, image, outdir, jobs=None):
+        """
+        @param jobs: number of tracks to encode at once; defaults to the
+                     number of CPUs
+        """
         task.MultiSeparateTask.__init__(self)
 
         self._image = image
         cue = image.cue
-        self._tasks = []
-        self.lengths = {}
+        paths = []
 
         def add(index):
 
@@ -195,10 +199,7 @@ class ImageEncodeTask(task.MultiSeparateTask):
             root, ext = os.path.splitext(os.path.basename(path))
             outpath = os.path.join(outdir, root + '.' + 'flac')
             logger.debug('schedule encode to %r', outpath)
-            taskk = encode.FlacEncodeTask(path,
-                                          os.path.join(outdir,
-                                                       root + '.' + 'flac'))
-            self.addTask(taskk)
+            paths.append((path, outpath))
 
         try:
             htoa = cue.table.tracks[0].indexes[0]
@@ -212,3 +213,5 @@ class ImageEncodeTask(task.MultiSeparateTask):
             logger.debug('encoding track %d', trackIndex + 1)
             index = track.indexes[1]
             add(index)
+
+        self.addTask(encode.FlacEncodePoolTask(paths, jobs=jobs))
@@ -23,13 +23,11 @@ import os
 import re
 import shutil
 import stat
-import subprocess
 import tempfile
 import time
 
 from whipper.common import common
 from whipper.common import task as ctask
-from whipper.extern import asyncsub
 from whipper.extern.task import task
 
 import logging
@@ -66,14 +64,17 @@ class ChecksumException(Exception):
 
 # example:
 # ##: 0 [read] @ 24696
+# only [read] and [wrote] are of interest, so other lines fail to match
+# as early as possible; matched with match(), so anchored at the start
 _PROGRESS_RE = re.compile(r"""
-    ^\#\#: (?P<code>.+)\s         # function code
-    \[(?P<function>.*)\]\s@\s     # [function name] @
-    (?P<offset>\d+)               # offset in words (2-byte one channel value)
+    \#\#:\ [^[]+\s                  # function code
+    \[(?P<function>read|wrote)\]\s@\s  # [function name] @
+    (?P<offset>\d+)                   # offset in words (2-byte one channel
+                                      # value)
+    |
+    (?P<error>scsi_read\ error:)
 """, re.VERBOSE)
 
-_ERROR_RE = re.compile("^scsi_read error:")
-
 # from reading cdparanoia source code, it looks like offset is reported in
 # number of single-channel samples, ie. 2 bytes (word) per unit, and absolute
 
@@ -100,29 +101,51 @@ class ProgressParser:
         self.read = start
 
         self._reads = {}  # read count for each sector
+        self._partial = ""  # fed characters after the last full line
 
     def parse(self, line):
         """
         Parse a line.
         """
-        m = _PROGRESS_RE.search(line)
-        if m:
-            # code = int(m.group('code'))
-            function = m.group('function')
-            wordOffset = int(m.group('offset'))
-            if function == 'read':
-                self._parse_read(wordOffset)
-            elif function == 'wrote':
-                self._parse_wrote(wordOffset)
-
-        m = _ERROR_RE.search(line)
-        if m:
+        m = _PROGRESS_RE.match(line)
+        if not m:
+            return
+
+        function = m.group('function')
+        if function == 'read':
+            self._parse_read(int(m.group('offset')))
+        elif function == 'wrote':
+            self._parse_wrote(int(m.group('offset')))
+        else:
             self.errors += 1
 
+    def feed(self, data):
+        """
+        Parse the lines completed by data, as read from cdparanoia's
+        standard error; an unfinished last line is kept for the next call.
+
+        @returns: the number of lines parsed
+        @rtype:   int
+        """
+        end = data.rfind('\n')
+        if end < 0:
+            self._partial += data
+            return 0
+
+        # only the new data gets scanned for line ends
+        lines = data[:end].split('\n')
+        lines[0] = self._partial + lines[0]
+        self._partial = data[end + 1:]
+
+        parse = self.parse
+        for line in lines:
+            parse(line)
+        return len(lines)
+
     def _parse_read(self, wordOffset):
         if wordOffset % common.WORDS_PER_FRAME != 0:
-            logger.debug('THOMAS: not a multiple of %d: %d' % (
-                common.WORDS_PER_FRAME, wordOffset))
+            logger.debug('THOMAS: not a multiple of %d: %d',
+                         common.WORDS_PER_FRAME, wordOffset)
             return
 
         frameOffset = wordOffset / common.WORDS_PER_FRAME
@@ -203,10 +226,18 @@ class ProgressParser:
 # FIXME: handle errors
 
 
-class ReadTrackTask(task.Task):
+class ReadTrackTask(ctask.PopenTask):
     """
     I am a task that reads a track using cdparanoia.
 
+    Without a path, cdparanoia writes raw little-endian PCM to its standard
+    output instead of a .wav file, and I feed it to the given digest as it
+    arrives.
+
+    Given the block checksums of an earlier read of the same range, I
+    compare the data read against them as it comes in, and stop
+    cdparanoia at the first block that differs.
+
     @ivar reads: how many reads were done to rip the track
     """
 
@@ -218,12 +249,14 @@ class ReadTrackTask(task.Task):
     _MAXERROR = 100  # number of errors detected by parser
 
     def __init__(self, path, table, start, stop, overread, offset=0,
-                 device=None, action="Reading", what="track"):
+                 device=None, action="Reading", what="track", digest=None,
+                 reference=None):
         """
         Read the given track.
 
-        @param path:   where to store the ripped track
-        @type  path:   unicode
+        @param path:   where to store the ripped track, or None to stream it
+                       to digest
+        @type  path:   unicode or None
         @param table:  table of contents of CD
         @type  table:  L{table.Table}
         @param start:  first frame to rip
@@ -238,10 +271,24 @@ class ReadTrackTask(task.Task):
         @type  action: str
         @param what:   a string representing what's being read; e.g. Track
         @type  what:   str
+        @param digest: what to feed the audio data to when streaming
+        @type  digest: L{whipper.common.checksum.TrackDigest}
+        @param reference: block checksums of an earlier read to compare
+                          against; may still be filled in before I start
+        @type  reference: list of int
         """
-        assert isinstance(path, unicode), "%r is not unicode" % path
+        if path is None:
+            assert digest, "streaming needs a digest"
+        else:
+            assert isinstance(path, unicode), "%r is not unicode" % path
 
         self.path = path
+        self._digest = digest
+        self._pcm = ""  # streamed bytes not yet making up a whole sample
+        self._pcmLength = 0
+        self._reference = reference
+        self._compared = 0  # number of blocks compared to the reference
+        self._blocks = None  # block digest of the .wav file being written
         self._table = table
         self._start = start
         self._stop = stop
@@ -251,13 +298,10 @@ class ReadTrackTask(task.Task):
         self._start_time = None
         self._overread = overread
 
-        self._buffer = ""  # accumulate characters
         self._errors = []
         self.description = "%s %s" % (action, what)
 
     def start(self, runner):
-        task.Task.start(self, runner)
-
         # find on which track the range starts and stops
         startTrack = 0
         startOffset = 0
@@ -279,7 +323,6 @@ class ReadTrackTask(task.Task):
         logger.debug('Stopping at track %d, offset %d',
                      stopTrack, stopOffset)
 
-        bufsize = 1024
         if self._overread:
             argv = ["cd-paranoia", "--stderr-progress",
                     "--sample-offset=%d" % self._offset, "--force-overread", ]
@@ -288,52 +331,49 @@ class ReadTrackTask(task.Task):
                     "--sample-offset=%d" % self._offset, ]
         if self._device:
             argv.extend(["--force-cdrom-device", self._device, ])
+        if self.path is None:
+            argv.append("--output-raw-little-endian")
         argv.extend(["%d[%s]-%d[%s]" % (
             startTrack, common.framesToHMSF(startOffset),
             stopTrack, common.framesToHMSF(stopOffset)),
-            self.path])
-        logger.debug('Running %s' % (" ".join(argv), ))
-        try:
-            self._popen = asyncsub.Popen(argv,
-                                         bufsize=bufsize,
-                                         stdin=subprocess.PIPE,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE,
-                                         close_fds=True)
-        except OSError as e:
-            import errno
-            if e.errno == errno.ENOENT:
-                raise common.MissingDependencyException('cd-paranoia')
-
-            raise
+            self.path or "-"])
+        if self.path is not None and self._reference is not None:
+            from whipper.common import checksum
+            self._blocks = checksum.BlockCRC32Digest()
+            # so that no earlier contents get compared
+            open(self.path, 'wb').close()
+            self._tailed = 44  # skip the wav header
 
+        logger.debug('Running %s' % (" ".join(argv), ))
+        self.command = argv
         self._start_time = time.time()
-        self.schedule(1.0, self._read, runner)
-
-    def _read(self, runner):
-        ret = self._popen.recv_err()
-        if not ret:
-            if self._popen.poll() is not None:
-                self._done()
-                return
-            self.schedule(0.01, self._read, runner)
-            return
+        ctask.PopenTask.start(self, runner)
 
-        self._buffer += ret
+    def commandMissing(self):
+        raise common.MissingDependencyException('cd-paranoia')
 
-        # parse buffer into lines if possible, and parse them
-        if "\n" in self._buffer:
-            lines = self._buffer.split('\n')
-            if lines[-1] != "\n":
-                # last line didn't end yet
-                self._buffer = lines[-1]
-                del lines[-1]
-            else:
-                self._buffer = ""
+    def readbytesout(self, bytes):
+        # when writing to a file, there is nothing to digest
+        if self._digest is None:
+            return
+        try:
+            self._stream(bytes)
+            if self._reference is not None:
+                self._compare(self._digest.blockchecksums)
+        except Exception:
+            self._terminate()
+            raise
 
-            for line in lines:
-                self._parser.parse(line)
+    def readbyteserr(self, bytes):
+        try:
+            if self._blocks:
+                self._tail()
+                self._compare(self._blocks.checksums)
+        except Exception:
+            self._terminate()
+            raise
 
+        if self._parser.feed(bytes):
             # fail if too many errors
             if self._parser.errors > self._MAXERROR:
                 logger.debug('%d errors, terminating', self._parser.errors)
@@ -347,26 +387,70 @@ class ReadTrackTask(task.Task):
             if progress < 1.0:
                 self.setProgress(progress)
 
-        # 0 does not give us output before we complete, 1.0 gives us output
-        # too late
-        self.schedule(0.01, self._read, runner)
+    def _terminate(self):
+        """
+        Stop cdparanoia, and drop what was digested so far.
+        """
+        logger.debug('terminating cdparanoia')
+        self._popen.terminate()
+        self._popen.wait()
+        if self._digest:
+            self._digest.abort()
 
-    def _poll(self, runner):
-        if self._popen.poll() is None:
-            self.schedule(1.0, self._poll, runner)
+    def _stream(self, data):
+        """
+        Feed audio data read from standard output to the digest.
+        """
+        self._pcmLength += len(data)
+        # the digest only takes whole stereo samples
+        data = self._pcm + data
+        cut = len(data) - len(data) % 4
+        self._pcm = data[cut:]
+        self._digest.update(data[:cut])
+
+    def _tail(self):
+        """
+        Feed the whole blocks cdparanoia wrote to the .wav file since the
+        last call to the block digest.
+        """
+        size = os.stat(self.path)[stat.ST_SIZE] - self._tailed
+        size -= size % self._blocks.blockSize
+        if size <= 0:
             return
 
-        self._done()
+        with open(self.path, 'rb') as f:
+            f.seek(self._tailed)
+            data = f.read(size)
+        self._blocks.update(data)
+        self._tailed += len(data)
+
+    def _compare(self, blocks):
+        """
+        Compare the blocks read so far to the reference.
+
+        @raises ChecksumException: at the first block that differs
+        """
+        count = min(len(blocks), len(self._reference))
+        for i in range(self._compared, count):
+            if blocks[i] != self._reference[i]:
+                logger.info('Block %d checksums do not match, %08x %08x',
+                            i, self._reference[i], blocks[i])
+                raise ChecksumException(
+                    'read and verify failed: block %d differs' % i)
+        self._compared = count
 
-    def _done(self):
+    def done(self):
         end_time = time.time()
-        self.setProgress(1.0)
 
         # check if the length matches
-        size = os.stat(self.path)[stat.ST_SIZE]
-        # wav header is 44 bytes
         offsetLength = self._stop - self._start + 1
-        expected = offsetLength * common.BYTES_PER_FRAME + 44
+        if self.path is None:
+            size = self._pcmLength
+            expected = offsetLength * common.BYTES_PER_FRAME
+        else:
+            size = os.stat(self.path)[stat.ST_SIZE]
+            # wav header is 44 bytes
+            expected = offsetLength * common.BYTES_PER_FRAME + 44
         if size != expected:
             # FIXME: handle errors better
             logger.warning('file size %d did not match expected size %d',
@@ -377,6 +461,8 @@ class ReadTrackTask(task.Task):
             else:
                 logger.warning('non-integral amount of frames difference')
 
+            if self._digest:
+                self._digest.abort()
             self.setAndRaiseException(FileSizeError(self.path,
                                                     "File size %d did not "
                                                     "match expected "
@@ -390,12 +476,22 @@ class ReadTrackTask(task.Task):
                 logger.warning('exit code %r', self._popen.returncode)
                 self.exception = ReturnCodeError(self._popen.returncode)
 
+        if self._digest:
+            if self.exception:
+                self._digest.abort()
+            else:
+                try:
+                    self._digest.close()
+                except Exception as e:
+                    self.exception = e
+
         self.quality = self._parser.getTrackQuality()
         self.duration = end_time - self._start_time
         self.speed = (offsetLength / 75.0) / self.duration
 
-        self.stop()
-        return
+    def failed(self):
+        # done() tells apart why cdparanoia failed
+        self.done()
 
 
 class ReadVerifyTrackTask(task.MultiSeparateTask):
@@ -406,6 +502,17 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
     The path where the file is stored can be changed if necessary, for
     example if the file name is too long.
 
+    When streaming, both reads are checksummed as cdparanoia produces them,
+    and the verify read is encoded on the fly, so no temporary .wav file is
+    written.
+
+    The verify read is compared block by block against the test read while
+    it is going on, and stopped as soon as they differ.
+
+    Without encoding, I only read and verify the track into a temporary
+    .wav file, and leave the rest to an L{EncodeJob}, so that it can be
+    done while the drive reads the next track.
+
     @ivar path:         the path where the file is to be stored.
     @ivar checksum:     the checksum of the track; set if they match.
     @ivar testchecksum: the test checksum of the track.
@@ -417,23 +524,32 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
     @ivar testduration: the test duration of the track, in seconds.
     @ivar copyduration: the copy duration of the track, in seconds.
     @ivar peak:         the peak level of the track
+    @ivar md5:          the MD5 sum of the audio data of the track
+    @ivar archecksums:  tuple of the AccurateRip v1 and v2 checksums of the
+                        track, or None if no track number was given
+    @ivar job:          the job finishing the track when not encoding;
+                        set if the checksums match
     """
 
     checksum = None
     testchecksum = None
     copychecksum = None
     peak = None
+    md5 = None
+    archecksums = None
     quality = None
     testspeed = None
     copyspeed = None
     testduration = None
     copyduration = None
+    job = None
 
     _tmpwavpath = None
     _tmppath = None
 
     def __init__(self, path, table, start, stop, overread, offset=0,
-                 device=None, taglist=None, what="track"):
+                 device=None, taglist=None, what="track", number=None,
+                 stream=False, encode=True):
         """
         @param path:    where to store the ripped track
         @type  path:    str
@@ -449,31 +565,23 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
         @type  device:  str
         @param taglist: a dict of tags
         @type  taglist: dict
+        @param number:  the track number, to calculate AccurateRip checksums
+        @type  number:  int
+        @param stream:  whether to stream the audio instead of using a
+                        temporary .wav file
+        @type  stream:  bool
+        @param encode:  whether to encode and tag the track, instead of
+                        leaving that to L{job}; needs encoding when
+                        streaming
+        @type  encode:  bool
         """
         task.MultiSeparateTask.__init__(self)
+        assert encode or not stream, "streaming needs encoding"
 
         logger.debug('Creating read and verify task on %r', path)
 
         if taglist:
             logger.debug('read and verify with taglist %r', taglist)
-        # FIXME: choose a dir on the same disk/dir as the final path
-        fd, tmppath = tempfile.mkstemp(suffix='.whipper.wav')
-        tmppath = unicode(tmppath)
-        os.close(fd)
-        self._tmpwavpath = tmppath
-
-        from whipper.common import checksum
-
-        self.tasks = []
-        self.tasks.append(
-            ReadTrackTask(tmppath, table, start, stop, overread,
-                          offset=offset, device=device, what=what))
-        self.tasks.append(checksum.CRC32Task(tmppath))
-        t = ReadTrackTask(tmppath, table, start, stop, overread,
-                          offset=offset, device=device, action="Verifying",
-                          what=what)
-        self.tasks.append(t)
-        self.tasks.append(checksum.CRC32Task(tmppath))
 
         # encode to the final path + '.part'
         try:
@@ -488,19 +596,60 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
         self._tmppath = tmpoutpath
         self.path = path
 
-        from whipper.common import encode
+        from whipper.common import checksum
 
-        self.tasks.append(encode.FlacEncodeTask(tmppath, tmpoutpath))
+        trackCount = None
+        if number:
+            trackCount = table.getAudioTracks()
+        self._encode = encode
+        self._jobArgs = (number, trackCount, taglist)
 
-        # MerlijnWajer: XXX: We run the CRC32Task on the wav file, because it's
-        # in general stupid to run the CRC32 on the flac file since it already
-        # has --verify. We should just get rid of this CRC32 step.
-        # make sure our encoding is accurate
-        self.tasks.append(checksum.CRC32Task(tmppath))
-        self.tasks.append(encode.SoxPeakTask(tmppath))
+        self.tasks = []
+        if stream:
+            sampleCount = (stop - start + 1) * common.SAMPLES_PER_FRAME
+            self._test = checksum.TrackDigest(sampleCount)
+            self._copy = checksum.TrackDigest(
+                sampleCount, encodePath=tmpoutpath, trackNumber=number,
+                trackCount=trackCount)
+            self._testRead = ReadTrackTask(
+                None, table, start, stop, overread, offset=offset,
+                device=device, what=what, digest=self._test)
+            self._copyRead = ReadTrackTask(
+                None, table, start, stop, overread, offset=offset,
+                device=device, action="Verifying", what=what,
+                digest=self._copy, reference=self._test.blockchecksums)
+            self.tasks.extend([self._testRead, self._copyRead])
+        else:
+            # FIXME: choose a dir on the same disk/dir as the final path
+            fd, tmppath = tempfile.mkstemp(suffix='.whipper.wav')
+            tmppath = unicode(tmppath)
+            os.close(fd)
+            self._tmpwavpath = tmppath
+
+            self._testRead = ReadTrackTask(
+                tmppath, table, start, stop, overread, offset=offset,
+                device=device, what=what)
+            self._test = checksum.CRC32Task(tmppath)
+            self._copyRead = ReadTrackTask(
+                tmppath, table, start, stop, overread, offset=offset,
+                device=device, action="Verifying", what=what,
+                reference=self._test.blockchecksums)
+            if encode:
+                # read the verified track only once: checksum it, calculate
+                # its AccurateRip checksums and peak level, and encode it,
+                # all at once
+                self._copy = checksum.TrackDigestTask(
+                    tmppath, encodePath=tmpoutpath, trackNumber=number,
+                    trackCount=trackCount, what=what)
+            else:
+                self._copy = checksum.CRC32Task(tmppath)
+            self.tasks.extend([self._testRead, self._test, self._copyRead,
+                               self._copy])
 
-        # TODO: Move tagging outside of cdparanoia
-        self.tasks.append(encode.TaggingTask(tmpoutpath, taglist))
+        if encode:
+            # TODO: Move tagging outside of cdparanoia
+            from whipper.common import encode as cencode
+            self.tasks.append(cencode.TaggingTask(tmpoutpath, taglist))
 
         self.checksum = None
 
@@ -509,17 +658,20 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
         # we chain up should be handled by a parent class function ?
         try:
             if not self.exception:
-                self.quality = max(self.tasks[0].quality,
-                                   self.tasks[2].quality)
-                self.peak = self.tasks[6].peak
-                logger.debug('peak: %r', self.peak)
-                self.testspeed = self.tasks[0].speed
-                self.copyspeed = self.tasks[2].speed
-                self.testduration = self.tasks[0].duration
-                self.copyduration = self.tasks[2].duration
-
-                self.testchecksum = c1 = self.tasks[1].checksum
-                self.copychecksum = c2 = self.tasks[3].checksum
+                self.quality = max(self._testRead.quality,
+                                   self._copyRead.quality)
+                if self._encode:
+                    self.peak = self._copy.peak
+                    logger.debug('peak: %r', self.peak)
+                    self.md5 = self._copy.md5
+                    self.archecksums = self._copy.archecksums
+                self.testspeed = self._testRead.speed
+                self.copyspeed = self._copyRead.speed
+                self.testduration = self._testRead.duration
+                self.copyduration = self._copyRead.duration
+
+                self.testchecksum = c1 = self._test.checksum
+                self.copychecksum = c2 = self._copy.checksum
                 if c1 == c2:
                     logger.info('Checksums match, %08x' % c1)
                     self.checksum = self.testchecksum
@@ -530,14 +682,19 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
                     self.exception = ChecksumException(
                         'read and verify failed: test checksum')
 
-                if self.tasks[5].checksum != self.checksum:
-                    self.exception = ChecksumException(
-                        'Encoding failed, checksum does not match')
-
-                # delete the unencoded file
-                os.unlink(self._tmpwavpath)
+                if self.exception:
+                    self._cleanup()
+                elif not self._encode:
+                    # the job takes over the unencoded file
+                    number, trackCount, taglist = self._jobArgs
+                    self.job = EncodeJob(self._tmpwavpath, self._tmppath,
+                                         self.path, self.checksum,
+                                         number, trackCount, taglist)
+                else:
+                    # delete the unencoded file
+                    if self._tmpwavpath:
+                        os.unlink(self._tmpwavpath)
 
-                if not self.exception:
                     try:
                         logger.debug('Moving to final path %r', self.path)
                         os.rename(self._tmppath, self.path)
@@ -545,15 +702,83 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
                         logger.debug('Exception while moving to final '
                                      'path %r: %r', self.path, str(e))
                         self.exception = e
-                else:
-                    os.unlink(self._tmppath)
             else:
                 logger.debug('stop: exception %r', self.exception)
+                self._cleanup()
         except Exception as e:
             print('WARNING: unhandled exception %r' % (e, ))
 
         task.MultiSeparateTask.stop(self)
 
+    def _cleanup(self):
+        # don't leave a file behind for every failed try
+        for path in [self._tmpwavpath, self._tmppath]:
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+
+class EncodeJob(object):
+    """
+    I am the part of ripping a track that does not need the drive: I
+    encode a read and verified .wav file, checksumming it and calculating
+    its AccurateRip checksums and peak level along the way, tag it and move
+    it to its final path.
+
+    I do not need a task runner, so I can run in a
+    L{whipper.common.pipeline.Worker} thread.
+
+    @ivar peak:         the peak level of the track
+    @ivar md5:          the MD5 sum of the audio data of the track
+    @ivar archecksums:  tuple of the AccurateRip v1 and v2 checksums of the
+                        track, or None if no track number was given
+    """
+
+    peak = None
+    md5 = None
+    archecksums = None
+
+    def __init__(self, wavpath, tmppath, path, checksum, number=None,
+                 trackCount=None, taglist=None):
+        """
+        @param wavpath:  the read and verified .wav file; removed when done
+        @param tmppath:  where to encode to
+        @param path:     where to move the encoded file to
+        @param checksum: the CRC32 checksum the .wav file was verified with
+        """
+        self.wavpath = wavpath
+        self.tmppath = tmppath
+        self.path = path
+        self.checksum = checksum
+        self._number = number
+        self._trackCount = trackCount
+        self._taglist = taglist
+
+    def run(self):
+        from whipper.common import checksum, encode
+
+        try:
+            digest = checksum.digestFile(self.wavpath,
+                                         encodePath=self.tmppath,
+                                         trackNumber=self._number,
+                                         trackCount=self._trackCount)
+            if digest.checksum != self.checksum:
+                raise ChecksumException(
+                    'encode failed: checksum %08x, expected %08x' % (
+                        digest.checksum, self.checksum))
+            encode.tag(self.tmppath, self._taglist)
+            logger.debug('Moving to final path %r', self.path)
+            os.rename(self.tmppath, self.path)
+        except Exception:
+            if os.path.exists(self.tmppath):
+                os.unlink(self.tmppath)
+            raise
+        finally:
+            os.unlink(self.wavpath)
+
+        self.peak = digest.peak
+        self.md5 = digest.md5
+        self.archecksums = digest.archecksums
+
 
 _VERSION_RE = re.compile(
     "^cdparanoia (?P<version>.+) release (?P<release>.+)")
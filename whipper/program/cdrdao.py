@@ -3,14 +3,12 @@ import sys
 import re
 import shutil
 import tempfile
-import subprocess
 import time
 from subprocess import Popen, PIPE
 
+from whipper.common import task as ctask
 from whipper.common.common import EjectError, truncate_filename
 from whipper.image.toc import TocFile
-from whipper.extern.task import task
-from whipper.extern import asyncsub
 
 import logging
 logger = logging.getLogger(__name__)
@@ -51,12 +49,13 @@ class ProgressParser:
         self.oldline = line
         
 
-class ReadTOC_Task(task.Task):
+class ReadTOC_Task(ctask.PopenTask):
     """
     Task that reads the TOC of the disc using cdrdao
     """
     description = "Reading TOC"
     toc = None
+    keep_toc = False  # leave tocfile for the caller to save with copy_toc
     
     def __init__(self, device, fast_toc=False, toc_path=None):
         """
@@ -74,7 +73,6 @@ class ReadTOC_Task(task.Task):
         self._parser = ProgressParser()
         self.fd, self.tocfile = tempfile.mkstemp(suffix=u'.cdrdao.read-toc.whipper.task')
     def start(self, runner):
-        task.Task.start(self, runner)
         ## TODO: Remove these hardcoded values (for testing)
         fast_toc = self.fast_toc
         device = self.device
@@ -86,25 +84,12 @@ class ReadTOC_Task(task.Task):
         cmd = [CDRDAO, 'read-toc'] + (['--fast-toc'] if fast_toc else []) + [
             '--device', device, self.tocfile]
         
-        self._popen = asyncsub.Popen(cmd,
-                                     bufsize=1024,
-                                     stdin=subprocess.PIPE,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE,
-                                     close_fds=True)
-
+        self.command = cmd
         self._start_time = time.time()
-        self.schedule(1.0, self._read, runner)
-        
-    def _read(self, runner):
-        ret = self._popen.recv_err()
-        if not ret:
-            if self._popen.poll() is not None:
-                self._done()
-                return
-            self.schedule(0.01, self._read, runner)
-            return
-        self._buffer += ret
+        ctask.PopenTask.start(self, runner)
+
+    def readbyteserr(self, bytes):
+        self._buffer += bytes
             
         # parse buffer into lines if possible, and parse them
         if "\n" in self._buffer:
@@ -122,37 +107,32 @@ class ReadTOC_Task(task.Task):
                     progress = float('%d' % self._parser.currentTrack) / float(self._parser.tracks)
                     if progress < 1.0:
                         self.setProgress(progress)
-        # 0 does not give us output before we complete, 1.0 gives us output
-        # too late
-        self.schedule(0.01, self._read, runner)
-
-
-    def _poll(self, runner):
-
-        sys.stdout.write("_poll\n")
-        if self._popen.poll() is None:
-            self.schedule(1.0, self._poll, runner)
-            return
-
-        self._done()
 
-
-    def _done(self):
+    def done(self):
         end_time = time.time()
-        self.setProgress(1.0)
         self.toc = TocFile(self.tocfile)
         self.toc.parse()
         if self.toc_path is not None:
-            t_comp = os.path.abspath(self.toc_path).split(os.sep)
-            t_dirn = os.sep.join(t_comp[:-1])
-            # If the output path doesn't exist, make it recursively
-            if not os.path.isdir(t_dirn):
-                os.makedirs(t_dirn)
-            t_dst = truncate_filename(os.path.join(t_dirn, t_comp[-1] + '.toc'))
-            shutil.copy(self.tocfile, os.path.join(t_dirn, t_dst))
-        os.unlink(self.tocfile)
-        self.stop()
-        return
+            copy_toc(self.tocfile, self.toc_path)
+        if not self.keep_toc:
+            os.unlink(self.tocfile)
+
+    def failed(self):
+        # the TOC file tells whether anything could be read
+        self.done()
+
+def copy_toc(tocfile, toc_path):
+    """
+    Copy the TOC file cdrdao wrote to toc_path with a .toc extension.
+    """
+    t_comp = os.path.abspath(toc_path).split(os.sep)
+    t_dirn = os.sep.join(t_comp[:-1])
+    # If the output path doesn't exist, make it recursively
+    if not os.path.isdir(t_dirn):
+        os.makedirs(t_dirn)
+    t_dst = truncate_filename(os.path.join(t_dirn, t_comp[-1] + '.toc'))
+    shutil.copy(tocfile, os.path.join(t_dirn, t_dst))
+
 
 def version():
     """
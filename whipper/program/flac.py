@@ -1,8 +1,37 @@
-from subprocess import check_call, CalledProcessError
+from subprocess import check_call, CalledProcessError, Popen, PIPE
 
 import logging
 logger = logging.getLogger(__name__)
 
+# raw CD audio: little-endian, signed 16 bit stereo at 44.1 kHz
+RAW_FORMAT = ['--force-raw-format', '--endian=little', '--sign=signed',
+              '--channels=2', '--bps=16', '--sample-rate=44100']
+
+
+def encode_command(infile, outfile):
+    """
+    Returns the command encoding infile to outfile, with flac.
+    Uses '-f' because whipper already creates the file.
+    """
+    return ['flac', '--silent', '--verify', '-o', outfile, '-f', infile]
+
+
+def decode_command(infile, skip=0, length=-1):
+    """
+    Returns the command decoding infile to raw CD audio on stdout, with
+    flac.
+
+    @param skip:   number of samples to skip at the start
+    @param length: number of samples to decode; -1 for all
+    """
+    command = ['flac', '--silent', '--decode', '--stdout',
+               '--force-raw-format', '--endian=little', '--sign=signed']
+    if skip:
+        command.append('--skip=%d' % skip)
+    if length >= 0:
+        command.append('--until=+%d' % length)
+    return command + [infile]
+
 
 def encode(infile, outfile):
     """
@@ -12,8 +41,41 @@ def encode(infile, outfile):
     try:
         # TODO: Replace with Popen so that we can catch stderr and write it to
         # logging
-        check_call(['flac', '--silent', '--verify', '-o', outfile,
-                    '-f', infile])
+        check_call(encode_command(infile, outfile))
     except CalledProcessError:
         logger.exception('flac failed')
         raise
+
+
+class PipeEncoder(object):
+    """
+    I encode raw CD audio, written to me in pieces, to outfile with flac.
+    Uses '-f' because whipper already creates the file.
+    """
+
+    def __init__(self, outfile):
+        self._command = ['flac', '--silent', '--verify'] + RAW_FORMAT + [
+            '-o', outfile, '-f', '-']
+        logger.debug('executing %r', self._command)
+        self._popen = Popen(self._command, stdin=PIPE)
+
+    def write(self, data):
+        self._popen.stdin.write(data)
+
+    def close(self):
+        """
+        Finish encoding; raises CalledProcessError if flac failed.
+        """
+        self._popen.stdin.close()
+        returncode = self._popen.wait()
+        if returncode != 0:
+            logger.error('flac failed with return code %d', returncode)
+            raise CalledProcessError(returncode, self._command)
+
+    def abort(self):
+        """
+        Stop encoding without waiting for a complete file.
+        """
+        if self._popen.poll() is None:
+            self._popen.kill()
+        self._popen.wait()
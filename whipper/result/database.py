@@ -0,0 +1,123 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_result_database -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is part of whipper.
+#
+# whipper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# whipper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with whipper.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(paths):
+    """
+    Describe the files of an image, so that a later change to any of them
+    can be told apart.
+
+    Each file is described by its path, size and modification time. This
+    does not read the audio, so it can not tell that it rotted.
+
+    @type paths: list of unicode
+
+    @rtype: list of list
+    """
+    files = []
+    for path in paths:
+        st = os.stat(path)
+        files.append([path, st.st_size, st.st_mtime])
+    return files
+
+
+class Disc(object):
+    """
+    I am the result of the last verification of an image.
+
+    @ivar files:    the L{fingerprint} of the files of the image
+    @ivar verified: whether the image verified
+    @ivar report:   the report printed when verifying it
+    @ivar checked:  when it was verified, in seconds since the epoch
+    """
+
+    def __init__(self, files, verified, report, checked):
+        self.files = files
+        self.verified = verified
+        self.report = report
+        self.checked = checked
+
+
+class VerifyDatabase(object):
+    """
+    I keep the results of verifying images in an SQLite database, by the
+    path of their .cue file, so that images that verified and have not
+    changed since do not need to be verified again.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: the database file; it is created if it does not exist
+        @type  path: unicode
+        """
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS discs ('
+            'cue_path TEXT PRIMARY KEY, '
+            'files TEXT NOT NULL, '
+            'verified INTEGER NOT NULL, '
+            'report TEXT, '
+            'checked REAL NOT NULL)')
+        self._connection.commit()
+
+    def get(self, cuePath):
+        """
+        Get the result of the last verification of an image.
+
+        @type cuePath: unicode
+
+        @rtype: L{Disc} or None
+        """
+        row = self._connection.execute(
+            'SELECT files, verified, report, checked FROM discs '
+            'WHERE cue_path = ?', (cuePath, )).fetchone()
+        if row is None:
+            return None
+        files, verified, report, checked = row
+        return Disc(json.loads(files), bool(verified), report, checked)
+
+    def store(self, cuePath, files, verified, report=None):
+        """
+        Store the result of verifying an image, replacing the earlier one.
+
+        @type cuePath: unicode
+        @param files:  the L{fingerprint} of the files of the image
+        """
+        logger.debug('storing result %r for %s', verified, cuePath)
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO discs '
+                '(cue_path, files, verified, report, checked) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (cuePath, json.dumps(files), int(verified), report,
+                 time.time()))
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,175 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_result_journal -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is part of whipper.
+#
+# whipper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# whipper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with whipper.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import errno
+import json
+import os
+
+from whipper.result import result
+
+import logging
+logger = logging.getLogger(__name__)
+
+# the TrackResult attributes kept in the journal
+FIELDS = ('number', 'filename', 'pregap', 'pre_emphasis', 'peak', 'quality',
+          'testspeed', 'copyspeed', 'testduration', 'copyduration',
+          'testcrc', 'copycrc', 'md5', 'AR')
+
+
+class Journal(object):
+    """
+    I keep the results of the tracks of a rip in a file as they are
+    ripped, so that an interrupted rip can go on where it stopped.
+
+    The file is only ever appended to, one JSON object per line, each
+    written out to disk before going on; a later line for a track replaces
+    the earlier ones. A line cut short by a crash is ignored.
+
+    Each line also records the size and modification time of the track
+    file, so that a file changed since can be told apart, and the read
+    offset and overread setting of the rip, so that tracks ripped with
+    other ones are ripped again.
+    """
+
+    def __init__(self, path, offset=None, overread=None):
+        """
+        @param path:     the journal file; it does not need to exist
+        @type  path:     unicode
+        @param offset:   the read offset of the rip
+        @type  offset:   int
+        @param overread: whether the rip overreads into the lead-out
+        @type  overread: bool
+        """
+        self.path = path
+        self.offset = offset
+        self.overread = overread
+        self._records = {}  # track number -> last record written
+
+    def load(self):
+        """
+        Read the journal.
+
+        @returns: the last result written for each track, by track number
+        @rtype:   list of L{result.TrackResult}
+        """
+        self._records = {}
+        try:
+            with open(self.path, 'rb') as f:
+                lines = f.readlines()
+        except IOError:
+            return []
+
+        for i, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+                number = record['number']
+            except (ValueError, KeyError, TypeError):
+                logger.warning('ignoring line %d of rip journal %s',
+                               i + 1, self.path)
+                continue
+            if (record.get('offset') != self.offset or
+                    record.get('overread') != self.overread):
+                logger.info('track %r was ripped with read offset %r and '
+                            'overread %r, ripping it again', number,
+                            record.get('offset'), record.get('overread'))
+                self._records.pop(number, None)
+                continue
+            self._records[number] = record
+
+        trackResults = []
+        for number in sorted(self._records):
+            trackResult = result.TrackResult()
+            for field in FIELDS:
+                if field in self._records[number]:
+                    setattr(trackResult, field, self._records[number][field])
+            if trackResult.filename is not None:
+                trackResult.filename = unicode(trackResult.filename)
+            trackResults.append(trackResult)
+        return trackResults
+
+    def _record(self, trackResult):
+        record = dict((field, copy.deepcopy(getattr(trackResult, field)))
+                      for field in FIELDS)
+        record['offset'] = self.offset
+        record['overread'] = self.overread
+        try:
+            st = os.stat(trackResult.filename)
+            record['size'] = st.st_size
+            record['mtime'] = st.st_mtime
+        except (TypeError, OSError):
+            pass
+        return record
+
+    def append(self, trackResults):
+        """
+        Write the results of the given tracks that changed since they were
+        last written.
+
+        @type trackResults: list of L{result.TrackResult}
+        """
+        lines = []
+        for trackResult in trackResults:
+            if trackResult.number is None:
+                continue
+            record = self._record(trackResult)
+            if self._records.get(trackResult.number) == record:
+                continue
+            lines.append(json.dumps(record) + '\n')
+            self._records[trackResult.number] = record
+
+        if not lines:
+            return
+
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.path, 'ab') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        """
+        Remove the journal, once the rip it is about has finished.
+        """
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning('could not remove rip journal %s: %s',
+                               self.path, e)
+        self._records = {}
+
+    def isUnchanged(self, trackResult):
+        """
+        Return whether the track was written to the journal with the same
+        file name, and the file has not changed since.
+
+        @type trackResult: L{result.TrackResult}
+        """
+        record = self._records.get(trackResult.number)
+        if (not record or trackResult.filename is None or
+                record.get('filename') != trackResult.filename):
+            return False
+        try:
+            st = os.stat(trackResult.filename)
+        except OSError:
+            return False
+        return (record.get('size') == st.st_size and
+                record.get('mtime') == st.st_mtime)
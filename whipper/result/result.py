@@ -36,6 +36,8 @@ class TrackResult:
     # 4 byte CRCs for the test and copy reads
     testcrc = None
     copycrc = None
+    # MD5 sum of the audio data, as FLAC stores it in the encoded file
+    md5 = None
     AR = None
     classVersion = 3
 
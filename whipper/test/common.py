@@ -3,7 +3,10 @@
 
 import re
 import os
+import random
+import struct
 import sys
+import wave
 
 import whipper
 
@@ -41,6 +44,33 @@ def diffStrings(orig, new, desc='input'):
                  desc=desc)
 
 
+def randomPCM(samples, seed=0):
+    """
+    Make up 16 bit stereo audio, the same for the same seed.
+
+    @param samples: length, in samples
+    @type  samples: int
+
+    @rtype: str
+    """
+    r = random.Random(seed)
+    return ''.join(struct.pack('<hh', r.randint(-32768, 32767),
+                               r.randint(-32768, 32767))
+                   for _ in range(samples))
+
+
+def writeWav(path, data):
+    """
+    Write 16 bit stereo audio to a .wav file.
+    """
+    w = wave.open(path, 'wb')
+    w.setnchannels(2)
+    w.setsampwidth(2)
+    w.setframerate(44100)
+    w.writeframes(data)
+    w.close()
+
+
 class TestCase(unittest.TestCase):
     # unittest.TestCase.failUnlessRaises does not return the exception,
     # and we'd like to check for the actual exception under TaskException,
@@ -1,16 +1,25 @@
 # -*- Mode: Python; test-case-name: whipper.test.test_common_accurip -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import os
+import shutil
+import struct
 import sys
+import tempfile
 from StringIO import StringIO
 from os.path import dirname, join
 from unittest import TestCase
 
+from accuraterip import compute
+
+from whipper.common import cache, checksum, common
 from whipper.common.accurip import (
     calculate_checksums, get_db_entry, print_report, verify_result,
-    _split_responses, EntryNotFound
+    search_offsets, _split_responses, EntryNotFound, OffsetChecksums,
+    ResponseIndex
 )
 from whipper.result.result import RipResult, TrackResult
+from whipper.test.common import randomPCM, writeWav
 
 
 class TestAccurateRipResponse(TestCase):
@@ -26,6 +35,23 @@ class TestAccurateRipResponse(TestCase):
         with self.assertRaises(EntryNotFound):
             get_db_entry('definitely_a_404')
 
+    def test_uses_cache_offline(self):
+        path = tempfile.mkdtemp(suffix=u'.whipper.test')
+        try:
+            c = cache.FileCache(path)
+            with self.assertRaises(EntryNotFound):
+                get_db_entry(self.path, c, offline=True)
+            c.put(self.path, open(join(dirname(__file__),
+                                       self.path[6:])).read())
+            self.assertEqual(get_db_entry(self.path, c, offline=True),
+                             self.entry)
+            # remembered as not in the database
+            c.put(self.other_path, '')
+            with self.assertRaises(EntryNotFound):
+                get_db_entry(self.other_path, c, offline=True)
+        finally:
+            shutil.rmtree(path)
+
     def test_AccurateRipResponse_parses_correctly(self):
         responses = get_db_entry(self.path)
         self.assertEqual(len(responses), 2)
@@ -48,7 +74,44 @@ class TestAccurateRipResponse(TestCase):
         self.assertEqual(responses[1].checksums[0], 'dc77f9ab')
         self.assertEqual(responses[1].checksums[1], 'dd97d2c3')
 
-# XXX: test arc.py
+
+def _entry(*responses):
+    # pack (checksums, confidences) pairs like a database entry
+    data = ''
+    for checksums, confidences in responses:
+        data += struct.pack('<BLLL', len(checksums), 1, 2, 3)
+        for crc, confidence in zip(checksums, confidences):
+            data += struct.pack('<BLL', confidence, crc, 0)
+    return data
+
+
+class TestResponseIndex(TestCase):
+    def setUp(self):
+        self.responses = _split_responses(_entry(
+            ([0x10, 0x20], [3, 4]),
+            ([0x11, 0x20], [7, 9]),
+            ([0x12, 0x20], [7, 2]),
+        ))
+        self.index = ResponseIndex(self.responses)
+
+    def test_parses_packed_entry(self):
+        self.assertEqual(len(self.responses), 3)
+        self.assertEqual(self.responses[1].checksums,
+                         ['00000011', '00000020'])
+        self.assertEqual(list(self.responses[1].confidences), [7, 9])
+        self.assertEqual(self.responses[2].cddbDiscId, '00000003')
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup(0, 0x10), (3, 0))
+        self.assertEqual(self.index.lookup(0, '00000011'), (7, 1))
+        self.assertEqual(self.index.lookup(1, 0x20), (9, 1))
+        self.assertEqual(self.index.lookup(1, 0x10), None)
+        self.assertEqual(self.index.lookup(0, None), None)
+        self.assertEqual(self.index.lookup(2, 0x10), None)
+
+    def test_max_confidence_first_wins(self):
+        self.assertEqual(self.index.maxConfidence(0), (7, '00000011'))
+        self.assertEqual(self.index.maxConfidence(1), (9, '00000020'))
 
 
 class TestCalculateChecksums(TestCase):
@@ -58,7 +121,94 @@ class TestCalculateChecksums(TestCase):
             {'v1': [None], 'v2': [None]}
         )
 
-    # TODO: test success when file exists
+    def test_returns_checksums_for_flac(self):
+        path = join(dirname(__file__), u'track.flac')
+        self.assertEqual(
+            calculate_checksums([path]),
+            {'v1': ['72426e48'], 'v2': ['72427242']}
+        )
+        self.assertEqual(
+            calculate_checksums([path, path]),
+            {'v1': ['d60e55e1', '7271db39'], 'v2': ['d6712d2a', '7292bc65']}
+        )
+
+
+class TestOffsetChecksums(TestCase):
+    def setUp(self):
+        self.samples = common.SAMPLES_PER_FRAME * 12 + 7
+        # 50 samples before the track, 60 after it
+        self.data = randomPCM(50 + self.samples + 60, seed=1)
+
+    def _expected(self, number, count, offset):
+        start = (50 + offset) * 4
+        data = self.data[max(0, start):start + self.samples * 4]
+        # samples before the read don't count for the first track
+        data = '\0' * max(0, -start) + data
+        digest = checksum.AccurateRipDigest(number, count, self.samples)
+        digest.update(data)
+        return digest.v1, digest.v2
+
+    def test_offsets(self):
+        for number, count, offsets in [(1, 3, (-2989, 60)),
+                                       (2, 3, (-50, 60)),
+                                       (3, 3, (-50, 3000))]:
+            arcs = OffsetChecksums(self.data, 50, self.samples, number, count)
+            self.assertEqual(arcs.offsets(), offsets)
+
+    def test_checksums(self):
+        for number, count in [(1, 3), (2, 3), (3, 3), (1, 1)]:
+            arcs = OffsetChecksums(self.data, 50, self.samples, number, count)
+            v1 = arcs.v1(-50, 60)
+            self.assertEqual(sorted(v1), range(-50, 61))
+            for offset in range(-50, 61):
+                expected = self._expected(number, count, offset)
+                self.assertEqual(v1[offset], expected[0])
+                self.assertEqual(arcs.checksums(offset), expected)
+
+    def test_out_of_range(self):
+        arcs = OffsetChecksums(self.data, 50, self.samples, 2, 3)
+        self.assertRaises(ValueError, arcs.checksums, 61)
+        self.assertRaises(ValueError, arcs.v1, -51, 0)
+
+
+class TestSearchOffsets(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(suffix=u'.whipper.test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.dir, name)
+        writeWav(path, data)
+        return path
+
+    def test_finds_wrong_offset(self):
+        lengths = [common.SAMPLES_PER_FRAME * 11 + 5,
+                   common.SAMPLES_PER_FRAME * 7 + 3,
+                   common.SAMPLES_PER_FRAME * 12]
+        disc = randomPCM(sum(lengths) + 200, seed=2)
+
+        checksums = []
+        # the tracks as they should have been ripped, and read 30 samples
+        # too far
+        paths = []
+        start = 100
+        for i, length in enumerate(lengths):
+            correct = self._write('correct.wav',
+                                  disc[start * 4:(start + length) * 4])
+            checksums.append(compute(correct, i + 1, len(lengths))[0])
+            paths.append(self._write('%d.wav' % i,
+                                     disc[(start + 30) * 4:
+                                          (start + 30 + length) * 4]))
+            start += length
+        response = _split_responses(
+            _entry((checksums, [1] * len(checksums))))[0]
+
+        offsets = search_offsets(paths, [response], margin=100)
+        self.assertEqual(offsets, [[-30], [-30], [-30]])
+        self.assertEqual(search_offsets(paths, [response], margin=10),
+                         [[], [], []])
 
 
 class TestVerifyResult(TestCase):
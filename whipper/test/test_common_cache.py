@@ -0,0 +1,57 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_cache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import os
+import shutil
+import tempfile
+import time
+
+from whipper.common import cache
+from whipper.test import common as tcommon
+
+
+class FileCacheTestCase(tcommon.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=u'.whipper.test')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _age(self, c, key, seconds):
+        path = c._path(key)
+        then = time.time() - seconds
+        os.utime(path, (then, then))
+
+    def testGetPut(self):
+        c = cache.FileCache(self.path)
+        self.assertEqual(c.get('a/b.bin'), None)
+        c.put('a/b.bin', 'data')
+        self.assertEqual(c.get('a/b.bin'), 'data')
+        c.put('a/b.bin', '')
+        self.assertEqual(c.get('a/b.bin'), '')
+
+    def testExpired(self):
+        c = cache.FileCache(self.path, ttl=60)
+        c.put('a', 'data')
+        self._age(c, 'a', 120)
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(c.get('a', stale=True), 'data')
+
+    def testEvict(self):
+        c = cache.FileCache(self.path, size=10)
+        c.put('a', '1234')
+        c.put('b', '1234')
+        self._age(c, 'a', 20)
+        self._age(c, 'b', 10)
+        # using a makes b the least recently used one
+        c.get('a')
+        c.put('c', '1234')
+        self.assertEqual(c.get('a'), '1234')
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('c'), '1234')
+
+    def testInvalidKey(self):
+        c = cache.FileCache(self.path)
+        self.assertRaises(ValueError, c.get, '../a')
+        self.assertRaises(ValueError, c.put, '/a', 'data')
@@ -0,0 +1,120 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_checksum -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import binascii
+import hashlib
+import os
+import struct
+import tempfile
+
+import accuraterip
+
+from whipper.common import checksum, common
+from whipper.extern.task import task
+from whipper.test import common as tcommon
+
+
+class DigestTestCase(tcommon.TestCase):
+
+    def setUp(self):
+        # 12 frames and a bit, so both the first and last track skip
+        # something at both ends
+        self.samples = common.SAMPLES_PER_FRAME * 12 + 7
+        self.data = tcommon.randomPCM(self.samples)
+        fd, self.path = tempfile.mkstemp(suffix=u'.whipper.test.wav')
+        os.close(fd)
+        tcommon.writeWav(self.path, self.data)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def _feed(self, digest, size):
+        for i in range(0, len(self.data), size):
+            digest.update(self.data[i:i + size])
+
+    def testCRC32(self):
+        digest = checksum.CRC32Digest()
+        self._feed(digest, 4 * 1000)
+        self.assertEqual(digest.checksum,
+                         binascii.crc32(self.data) & 0xffffffff)
+
+    def testAccurateRip(self):
+        for number, count in [(1, 3), (2, 3), (3, 3), (1, 1)]:
+            digest = checksum.AccurateRipDigest(number, count, self.samples)
+            self._feed(digest, 4 * 999)
+            self.assertEqual((digest.v1, digest.v2),
+                             accuraterip.compute(self.path, number, count))
+
+    def testPeak(self):
+        digest = checksum.PeakDigest()
+        self._feed(digest, 4 * 1000)
+        peak = max(abs(s) for s in struct.unpack(
+            '<%dh' % (self.samples * 2), self.data))
+        self.assertEqual(digest.peak, peak)
+
+    def testTrackDigestTask(self):
+        t = checksum.TrackDigestTask(self.path)
+        task.SyncRunner(verbose=False).run(t)
+        samples = struct.unpack('<%dh' % (self.samples * 2), self.data)
+        self.assertEqual(t.peak, max(abs(s) for s in samples))
+        self.assertEqual(t.checksum, binascii.crc32(self.data) & 0xffffffff)
+
+    def testTrackDigest(self):
+        digest = checksum.TrackDigest(self.samples, trackNumber=2,
+                                      trackCount=3)
+        self._feed(digest, 4 * 1000)
+        digest.close()
+        self.assertEqual(digest.checksum,
+                         binascii.crc32(self.data) & 0xffffffff)
+        self.assertEqual(digest.archecksums,
+                         accuraterip.compute(self.path, 2, 3))
+        self.assertEqual(digest.md5, hashlib.md5(self.data).hexdigest())
+
+    def testTrackDigestShort(self):
+        digest = checksum.TrackDigest(self.samples + 1)
+        self._feed(digest, 4 * 1000)
+        self.assertEqual(digest.archecksums, None)
+        self.assertRaises(common.MissingFrames, digest.close)
+
+    def testBlocks(self):
+        size = checksum.BLOCK_FRAMES * common.BYTES_PER_FRAME
+        data = tcommon.randomPCM(size / 4 * 2 + 100)
+        digest = checksum.BlockCRC32Digest()
+        for i in range(0, len(data), 4 * 1000):
+            digest.update(data[i:i + 4 * 1000])
+        # the trailing partial block is left out
+        self.assertEqual(digest.checksums, [
+            binascii.crc32(data[:size]) & 0xffffffff,
+            binascii.crc32(data[size:2 * size]) & 0xffffffff])
+
+    def testCRC32Task(self):
+        runner = task.SyncRunner(verbose=False)
+        t = checksum.CRC32Task(self.path)
+        runner.run(t)
+        self.assertEqual(t.checksum, binascii.crc32(self.data) & 0xffffffff)
+        self.assertEqual(len(t.blockchecksums), 0)
+
+        t = checksum.CRC32Task(self.path, sampleStart=1000,
+                               sampleLength=2000)
+        runner.run(t)
+        self.assertEqual(t.checksum,
+                         binascii.crc32(self.data[4000:12000]) & 0xffffffff)
+
+        t = checksum.CRC32Task(self.path, sampleStart=1000)
+        runner.run(t)
+        self.assertEqual(t.checksum,
+                         binascii.crc32(self.data[4000:]) & 0xffffffff)
+
+    def testCRC32TaskShort(self):
+        runner = task.SyncRunner(verbose=False)
+        t = checksum.CRC32Task(self.path, sampleStart=1000,
+                               sampleLength=self.samples)
+        e = self.assertRaises(task.TaskException, runner.run, t)
+        self.assertIsInstance(e.exception, common.MissingFrames)
+
+    def testDigestFile(self):
+        digest = checksum.digestFile(self.path, trackNumber=1, trackCount=1)
+        self.assertEqual(digest.checksum,
+                         binascii.crc32(self.data) & 0xffffffff)
+        self.assertEqual(digest.archecksums,
+                         accuraterip.compute(self.path, 1, 1))
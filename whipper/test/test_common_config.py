@@ -92,3 +92,21 @@ class ConfigTestCase(tcommon.TestCase):
         self.assertRaises(KeyError, self._config.get_musicbrainz_server)
 
         self._config._parser.remove_section('musicbrainz')
+
+    def test_get_musicbrainz_rate(self):
+        self.assertEqual(self._config.get_musicbrainz_rate(), 1.0,
+                         msg='Default value is correct')
+
+        self._config._parser.add_section('musicbrainz')
+
+        self._config._parser.set('musicbrainz', 'rate', '20')
+        self._config.write()
+        self.assertEqual(self._config.get_musicbrainz_rate(), 20.0,
+                         msg='Correctly returns user-set value')
+
+        for rate in ('0', '-1', 'fast'):
+            self._config._parser.set('musicbrainz', 'rate', rate)
+            self._config.write()
+            self.assertRaises(KeyError, self._config.get_musicbrainz_rate)
+
+        self._config._parser.remove_section('musicbrainz')
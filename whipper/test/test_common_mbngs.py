@@ -3,10 +3,15 @@
 
 import os
 import json
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
 
 import unittest
 
-from whipper.common import mbngs
+from whipper.common import cache, mbngs
 
 
 class MetadataTestCase(unittest.TestCase):
@@ -187,3 +192,80 @@ class MetadataTestCase(unittest.TestCase):
         self.assertEqual(track2.mbidArtist,
                          u'38bfaa7f-ee98-48cb-acd0-946d7aeecd76'
                          ';4b462375-c508-432a-8c88-ceeec38b16ae')
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=u'.whipper.test')
+        self.cache = cache.FileCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testOffline(self):
+        discid = "f7XO36a7n1LCCskkCiulReWbwZA-"
+        releaseId = 'a76714e0-32b1-4ed4-b28e-f86d99642193'
+        self.assertRaises(mbngs.NotFoundException, mbngs.musicbrainz,
+                          discid, cache=self.cache, offline=True)
+
+        filename = 'whipper.release.%s.json' % releaseId
+        path = os.path.join(os.path.dirname(__file__), filename)
+        with open(path, "rb") as handle:
+            response = json.loads(handle.read())
+        self.cache.put('discid/%s.json' % discid, json.dumps([
+            {'id': releaseId, 'release-group': {'type': 'Album'}}]))
+        self.cache.put('release/%s.json' % releaseId,
+                       json.dumps(response['release']))
+
+        metadatas = mbngs.musicbrainz(discid, cache=self.cache,
+                                      offline=True)
+        self.assertEqual(len(metadatas), 1)
+        self.assertEqual(metadatas[0].mbid, releaseId)
+        self.assertEqual(metadatas[0].releaseType, 'Album')
+        self.assertEqual(metadatas[0].release, u'2001-10-15')
+
+    def testNotFound(self):
+        discid = "f7XO36a7n1LCCskkCiulReWbwZA-"
+        self.cache.put('discid/%s.json' % discid, '[]')
+        self.assertRaises(mbngs.NotFoundException, mbngs.musicbrainz,
+                          discid, cache=self.cache)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def testRate(self):
+        limiter = mbngs.RateLimiter(rate=50)
+        started = []
+
+        def request():
+            limiter.acquire()
+            started.append(time.time())
+
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the first one starts right away, then one every 20 ms
+        self.assertTrue(max(started) - min(started) >= 0.07)
+
+    def testShared(self):
+        limiter = mbngs.RateLimiter(rate=20)
+        limiter.share()
+        started = multiprocessing.Array('d', 3)
+
+        def request(i):
+            limiter.acquire()
+            started[i] = time.time()
+
+        processes = [multiprocessing.Process(target=request, args=(i, ))
+                     for i in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # the processes took turns: one right away, then one every 50 ms
+        self.assertTrue(max(started) - min(started) >= 0.09)
@@ -0,0 +1,61 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_pcm -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import os
+import tempfile
+import wave
+
+from whipper.common import common, pcm
+from whipper.test import common as tcommon
+
+
+class WaveSourceTestCase(tcommon.TestCase):
+
+    def setUp(self):
+        self.data = ''.join(chr(i % 256) for i in range(4 * 1000))
+        fd, self.path = tempfile.mkstemp(suffix=u'.whipper.test.wav')
+        os.close(fd)
+        w = wave.open(self.path, 'wb')
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(self.data)
+        w.close()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def _read(self, source, size=4 * 64):
+        b = bytearray(size)
+        data = ''
+        while True:
+            n = source.readinto(b)
+            if not n:
+                break
+            data += str(b[:n])
+        source.close()
+        return data
+
+    def testAll(self):
+        source = pcm.open(self.path)
+        self.assertIsInstance(source, pcm.WaveSource)
+        self.assertEqual(source.samples, 1000)
+        self.assertEqual(self._read(source), self.data)
+
+    def testRange(self):
+        source = pcm.open(self.path, sampleStart=10, sampleLength=100)
+        self.assertEqual(source.samples, 100)
+        self.assertEqual(self._read(source), self.data[40:440])
+
+        source = pcm.open(self.path, sampleStart=990)
+        self.assertEqual(self._read(source, size=4 * 3), self.data[3960:])
+
+    def testTooLong(self):
+        self.assertRaises(common.MissingFrames, pcm.open, self.path,
+                          sampleStart=10, sampleLength=1000)
+
+    def testTruncated(self):
+        source = pcm.open(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 4 * 10)
+        self.assertRaises(common.MissingFrames, self._read, source)
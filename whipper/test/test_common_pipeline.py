@@ -0,0 +1,68 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_pipeline -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+from whipper.common import pipeline
+from whipper.test import common as tcommon
+
+
+class _Job(object):
+
+    def __init__(self, ran, number, fail=False):
+        self._ran = ran
+        self.number = number
+        self._fail = fail
+
+    def run(self):
+        if self._fail:
+            raise ValueError(self.number)
+        self._ran.append(self.number)
+
+
+class WorkerTestCase(tcommon.TestCase):
+
+    def testOrder(self):
+        ran = []
+        done = []
+        worker = pipeline.Worker(size=2)
+        for i in range(10):
+            worker.put(_Job(ran, i), lambda job: done.append(job.number))
+        worker.join()
+        self.assertEqual(ran, list(range(10)))
+        self.assertEqual(done, list(range(10)))
+
+    def testFailure(self):
+        ran = []
+        done = []
+        worker = pipeline.Worker()
+        worker.put(_Job(ran, 0), lambda job: done.append(job.number))
+        worker.put(_Job(ran, 1, fail=True), lambda job: done.append(-1))
+        worker.put(_Job(ran, 2), lambda job: done.append(job.number))
+        self.assertRaises(ValueError, worker.join)
+        # the other jobs still ran and got called back
+        self.assertEqual(ran, [0, 2])
+        self.assertEqual(done, [0, 2])
+
+    def testErrback(self):
+        ran = []
+        done = []
+        failed = []
+        worker = pipeline.Worker()
+        worker.put(_Job(ran, 0), lambda job: done.append(job.number))
+        worker.put(_Job(ran, 1, fail=True), lambda job: done.append(-1),
+                   lambda job, e: failed.append((job.number, e.args)))
+        worker.put(_Job(ran, 2), lambda job: done.append(job.number))
+        # handled by the errback, so not raised
+        worker.join()
+        self.assertEqual(done, [0, 2])
+        self.assertEqual(failed, [(1, (1, ))])
+
+    def testThreads(self):
+        ran = []
+        done = []
+        worker = pipeline.Worker(size=4, threads=3)
+        for i in range(20):
+            worker.put(_Job(ran, i), lambda job: done.append(job.number))
+        worker.join()
+        self.assertEqual(sorted(ran), list(range(20)))
+        # called back in the order the jobs were put
+        self.assertEqual(done, list(range(20)))
@@ -2,9 +2,11 @@
 # vi:si:et:sw=4:sts=4:ts=4
 
 
+import os
 import unittest
 
 from whipper.common import program, mbngs, config
+from whipper.result import result
 from whipper.command.cd import DEFAULT_DISC_TEMPLATE
 
 
@@ -40,3 +42,17 @@ class PathTestCase(unittest.TestCase):
         path = prog.getPath(u'/tmp', u'%A/%d', 'mbdiscid', md, 0)
         self.assertEqual(path,
                          u'/tmp/Jeff Buckley/Grace')
+
+
+class VerifyTrackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.prog = program.Program(config.Config())
+        self.trackResult = result.TrackResult()
+        self.trackResult.filename = os.path.join(os.path.dirname(__file__),
+                                                 u'track.flac')
+
+    def testMD5(self):
+        # no runner needed, the file is not decoded
+        self.trackResult.md5 = '1fcd5986ff5f7829d34ebcd25b264a5f'
+        self.assertTrue(self.prog.verifyTrack(None, self.trackResult))
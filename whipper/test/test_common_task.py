@@ -0,0 +1,48 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_task -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+from whipper.common import task as ctask
+from whipper.test import common as tcommon
+
+
+class _ShellTask(ctask.PopenTask):
+
+    def __init__(self, script):
+        self.command = ['sh', '-c', script]
+        self.out = ''
+        self.err = ''
+        self.result = None
+
+    def readbytesout(self, bytes):
+        self.out += bytes
+
+    def readbyteserr(self, bytes):
+        self.err += bytes
+
+    def done(self):
+        self.result = 'done'
+
+    def failed(self):
+        self.result = 'failed'
+
+
+class PopenTaskTestCase(tcommon.TestCase):
+
+    def testOutput(self):
+        t = _ShellTask('echo out; echo err >&2; sleep 0.1; echo more')
+        ctask.SyncRunner(verbose=False).run(t)
+        self.assertEqual(t.out, 'out\nmore\n')
+        self.assertEqual(t.err, 'err\n')
+        self.assertEqual(t.result, 'done')
+
+    def testLarge(self):
+        # more than fits in a pipe, so it has to be read while running
+        t = _ShellTask('head -c 300000 /dev/zero')
+        ctask.SyncRunner(verbose=False).run(t)
+        self.assertEqual(len(t.out), 300000)
+        self.assertEqual(t.result, 'done')
+
+    def testFailed(self):
+        t = _ShellTask('exit 3')
+        ctask.SyncRunner(verbose=False).run(t)
+        self.assertEqual(t.result, 'failed')
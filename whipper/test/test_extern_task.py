@@ -0,0 +1,110 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_extern_task -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import os
+
+from whipper.extern.task import loop, task
+from whipper.test import common as tcommon
+
+
+class EventLoopTestCase(tcommon.TestCase):
+
+    def testTimers(self):
+        called = []
+        ev = loop.EventLoop()
+        ev.call_later(0.02, called.append, 2)
+        ev.call_later(0.01, called.append, 1)
+        ev.call_later(0, called.append, 0)
+        # returns when there is nothing left to wait for
+        ev.run()
+        self.assertEqual(called, [0, 1, 2])
+
+    def testReader(self):
+        read = []
+        r, w = os.pipe()
+        ev = loop.EventLoop()
+
+        def reader():
+            data = os.read(r, 1024)
+            if not data:
+                ev.remove_reader(r)
+                return
+            read.append(data)
+
+        ev.add_reader(r, reader)
+        ev.call_later(0.01, os.write, w, 'whip')
+        ev.call_later(0.02, os.close, w)
+        ev.run()
+        os.close(r)
+        self.assertEqual(read, ['whip'])
+
+    def testStop(self):
+        called = []
+        ev = loop.EventLoop()
+        ev.call_later(0, ev.stop)
+        ev.call_later(0.01, called.append, 1)
+        ev.run()
+        self.assertEqual(called, [])
+
+
+class _CountTask(task.Task):
+
+    def __init__(self, steps, fail=False):
+        self._steps = steps
+        self._fail = fail
+
+    def start(self, runner):
+        task.Task.start(self, runner)
+        self._step = 0
+        self.schedule(0, self._count)
+
+    def _count(self):
+        self._step += 1
+        if self._step == self._steps:
+            if self._fail:
+                self.setException(ValueError(self._steps))
+            self.stop()
+            return
+        self.setProgress(float(self._step) / self._steps)
+        self.schedule(0.001, self._count)
+
+
+class MultiParallelTaskTestCase(tcommon.TestCase):
+
+    def setUp(self):
+        self.runner = task.SyncRunner(verbose=False)
+
+    def testAll(self):
+        t = task.MultiParallelTask()
+        tasks = [_CountTask(n) for n in (3, 5, 7)]
+        for sub in tasks:
+            t.addTask(sub)
+        self.runner.run(t)
+        self.assertFalse(any(sub.running for sub in tasks))
+
+    def testFailure(self):
+        t = task.MultiParallelTask()
+        ok = _CountTask(10)
+        t.addTask(_CountTask(3, fail=True))
+        t.addTask(ok)
+        self.assertRaises(task.TaskException, self.runner.run, t)
+        # the other task still ran to completion
+        self.assertEqual(ok._step, 10)
+
+
+class _StuckTask(task.Task):
+
+    def start(self, runner):
+        task.Task.start(self, runner)
+        # forgets to stop() after this
+        self.schedule(0, self.setProgress, 0.5)
+
+
+class SyncRunnerTestCase(tcommon.TestCase):
+
+    def testNotStopped(self):
+        runner = task.SyncRunner(verbose=False)
+        e = self.assertRaises(task.TaskException, runner.run, _StuckTask())
+        self.assertTrue(isinstance(e.exception, RuntimeError))
+        # a task that does stop still runs fine with the same runner
+        runner.run(_CountTask(3))
@@ -27,6 +27,15 @@ class ParseTestCase(common.TestCase):
         q = '%.01f %%' % (self._parser.getTrackQuality() * 100.0, )
         self.assertEqual(q, '99.6 %')
 
+    def testFeed(self):
+        # chunks as read from the pipe, splitting lines anywhere
+        data = self._handle.read()
+        for i in range(0, len(data), 1000):
+            self._parser.feed(data[i:i + 1000])
+
+        q = '%.01f %%' % (self._parser.getTrackQuality() * 100.0, )
+        self.assertEqual(q, '99.6 %')
+
 
 class Parse1FrameTestCase(common.TestCase):
 
@@ -89,3 +98,12 @@ class CacheTestCase(common.TestCase):
         t = AnalyzeFileTask(path)
         self.runner.run(t)
         self.assertTrue(t.defeatsCache)
+
+
+class ReadTrackTestCase(common.TestCase):
+
+    def testOutputWithoutDigest(self):
+        # writing to a file, stray output on stdout is not digested
+        t = cdparanoia.ReadTrackTask(u'/tmp/track.wav', None, 0, 10, False)
+        t.readbytesout('\0' * 6)
+        self.assertEqual(t._pcmLength, 0)
@@ -0,0 +1,53 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_result_database -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import os
+import shutil
+import tempfile
+
+from whipper.result import database
+from whipper.test import common as tcommon
+
+
+class VerifyDatabaseTestCase(tcommon.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(suffix=u'.whipper.test')
+        self.path = os.path.join(self.dir, u'db', u'verify.sqlite3')
+        self.cue = os.path.join(self.dir, u'disc.cue')
+        with open(self.cue, 'wb') as f:
+            f.write('FILE "track.flac" WAVE\n')
+        self.flac = os.path.join(self.dir, u'track.flac')
+        shutil.copy(os.path.join(os.path.dirname(__file__), u'track.flac'),
+                    self.flac)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testFingerprint(self):
+        files = database.fingerprint([self.cue, self.flac])
+        self.assertEqual([f[0] for f in files], [self.cue, self.flac])
+        self.assertEqual(files[0][1], os.stat(self.cue).st_size)
+        self.assertEqual(files[1][2], os.stat(self.flac).st_mtime)
+
+        st = os.stat(self.flac)
+        os.utime(self.flac, (st.st_atime, st.st_mtime + 1))
+        self.assertNotEqual(database.fingerprint([self.cue, self.flac]),
+                            files)
+
+    def testStore(self):
+        files = database.fingerprint([self.cue, self.flac])
+        db = database.VerifyDatabase(self.path)
+        self.assertEqual(db.get(self.cue), None)
+        db.store(self.cue, files, False, 'track  1: rip NOT accurate\n')
+        db.store(self.cue, files, True, 'track  1: rip accurate\n')
+        db.close()
+
+        # kept across connections, the last result replacing the earlier
+        db = database.VerifyDatabase(self.path)
+        disc = db.get(self.cue)
+        self.assertEqual(disc.files, files)
+        self.assertEqual(disc.verified, True)
+        self.assertEqual(disc.report, 'track  1: rip accurate\n')
+        self.assertEqual(db.get(os.path.join(self.dir, u'other.cue')), None)
+        db.close()
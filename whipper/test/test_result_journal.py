@@ -0,0 +1,87 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_result_journal -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import os
+import shutil
+import tempfile
+
+from whipper.result import journal, result
+from whipper.test import common as tcommon
+
+
+class JournalTestCase(tcommon.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(suffix=u'.whipper.test')
+        self.path = os.path.join(self.dir, u'journal.jsonl')
+        self.track = os.path.join(self.dir, u'01.flac')
+        with open(self.track, 'wb') as f:
+            f.write('flac')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _trackResult(self, number, filename=None):
+        trackResult = result.TrackResult()
+        trackResult.number = number
+        trackResult.filename = filename
+        trackResult.testcrc = trackResult.copycrc = 0x12345678
+        return trackResult
+
+    def testResume(self):
+        j = journal.Journal(self.path)
+        self.assertEqual(j.load(), [])
+        first = self._trackResult(1, self.track)
+        j.append([first])
+        first.AR['v1']['CRC'] = 'deadbeef'
+        j.append([first, self._trackResult(2)])
+        # nothing changed, nothing written
+        j.append([first])
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        j = journal.Journal(self.path)
+        trackResults = j.load()
+        self.assertEqual([t.number for t in trackResults], [1, 2])
+        self.assertEqual(trackResults[0].filename, self.track)
+        self.assertEqual(trackResults[0].testcrc, 0x12345678)
+        self.assertEqual(trackResults[0].AR['v1']['CRC'], 'deadbeef')
+        self.assertTrue(j.isUnchanged(trackResults[0]))
+        self.assertFalse(j.isUnchanged(trackResults[1]))
+
+        with open(self.track, 'ab') as f:
+            f.write('more')
+        self.assertFalse(j.isUnchanged(trackResults[0]))
+
+    def testCutShort(self):
+        j = journal.Journal(self.path)
+        j.append([self._trackResult(1, self.track),
+                  self._trackResult(2, self.track)])
+        with open(self.path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.path) - 10)
+
+        trackResults = journal.Journal(self.path).load()
+        self.assertEqual([t.number for t in trackResults], [1])
+
+    def testOtherSettings(self):
+        j = journal.Journal(self.path, offset=6, overread=False)
+        j.append([self._trackResult(1, self.track)])
+
+        self.assertEqual(
+            len(journal.Journal(self.path, offset=6, overread=False).load()),
+            1)
+        # ripped with another read offset or overread setting
+        j = journal.Journal(self.path, offset=48, overread=False)
+        self.assertEqual(j.load(), [])
+        self.assertFalse(j.isUnchanged(self._trackResult(1, self.track)))
+        self.assertEqual(
+            journal.Journal(self.path, offset=6, overread=True).load(), [])
+
+    def testRemove(self):
+        j = journal.Journal(self.path)
+        j.append([self._trackResult(1, self.track)])
+        j.remove()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(journal.Journal(self.path).load(), [])
+        # already gone
+        j.remove()